@@ -0,0 +1,70 @@
+"""
+Throughput of the answering path with N students asking at the same time, against a stubbed model.
+
+Compares the old blocking path (the synchronous chain call made inside the event loop) with `OpenAI.answer`.
+Also reports the worst event loop stall, i.e. how long every other update had to wait.
+
+Usage:
+    python benchmarks/answer_concurrency.py --latency 1 --users 1,5,10,25,50 --limit 10
+"""
+import argparse
+import asyncio
+import time
+
+from stubs import make_openai
+
+QUESTION = "Что такое таргетированная реклама?"
+
+
+async def watch_loop(stop: asyncio.Event, interval: float = 0.01) -> float:
+    """
+    Returns the longest delay between two ticks of the event loop while `stop` is not set.
+    """
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def run_blocking(helper, users: int) -> None:
+    async def ask():
+        helper.get_chain('ru').invoke({'query': QUESTION})
+
+    await asyncio.gather(*(ask() for _ in range(users)))
+
+
+async def run_async(helper, users: int) -> None:
+    await asyncio.gather(*(helper.answer(QUESTION, 'ru') for _ in range(users)))
+
+
+async def measure(runner, helper, users: int):
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop))
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    await runner(helper, users)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return elapsed, await watcher
+
+
+async def main(args) -> None:
+    helper = make_openai(args.latency, args.limit)
+    await helper.answer(QUESTION, 'ru')  # build the chain outside of the measurements
+
+    print(f"model latency {args.latency:.2f}s, concurrency limit {args.limit}")
+    print(f"{'users':>6} {'mode':>9} {'wall, s':>9} {'answers/s':>10} {'max stall, s':>13}")
+    for users in args.users:
+        for mode, runner in (('blocking', run_blocking), ('async', run_async)):
+            elapsed, stall = await measure(runner, helper, users)
+            print(f"{users:>6} {mode:>9} {elapsed:>9.2f} {users / elapsed:>10.2f} {stall:>13.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency', type=float, default=1.0, help='stubbed model latency in seconds')
+    parser.add_argument('--users', type=lambda value: [int(n) for n in value.split(',')], default=[1, 5, 10, 25, 50])
+    parser.add_argument('--limit', type=int, default=10, help='MAX_CONCURRENT_ANSWERS')
+    asyncio.run(main(parser.parse_args()))
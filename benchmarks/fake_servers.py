@@ -0,0 +1,304 @@
+"""
+Local HTTP stand-ins for the Telegram Bot API, the OpenAI API and Google Drive/Sheets.
+
+Each fake is an aiohttp application that answers after a configurable latency and counts the
+calls it gets, so the bot can run unmodified against them by pointing its base URLs here.
+"""
+import asyncio
+import base64
+import glob
+import json
+import os
+import re
+import time
+from collections import Counter
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+from stubs import ANSWER, HashingEmbeddings
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+
+UZBEK_LESSON = """# Maqsadli reklama
+
+Maqsadli reklama — bu e'lonlarni tanlangan mezonlar bo'yicha saralangan auditoriyaga ko'rsatish.
+Auditoriyani yosh, qiziqishlar va joylashuv bo'yicha sozlash mumkin.
+
+# Piksel
+
+Piksel saytdagi foydalanuvchilarning e'londan keyingi harakatlarini kuzatish imkonini beradi.
+"""
+
+
+async def serve(app: web.Application) -> (web.AppRunner, str):
+    """
+    Starts an application on a free local port and returns its runner and base URL.
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+class FakeBotApi:
+    """
+    Telegram Bot API: every method succeeds after `latency` seconds.
+    Serve it and use `<base URL>/bot` as the bot's base URL.
+
+    Updates given to `push` are delivered like Telegram does: posted to the webhook with its
+    secret token if one is set, otherwise returned by the next (long-polling) getUpdates.
+
+    Attributes:
+        on_call (callable): Called with the method name and parameters of every request, if set.
+    """
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = 0
+        self.on_call = None
+        self.pending = []
+        self.updates_available = asyncio.Event()
+        self.webhook = None
+        self.session = None
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post('/bot{token}/{method}', self.handle)
+        self.app.on_shutdown.append(self.close)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = await request.post()
+        self.calls[method] += 1
+        if self.on_call is not None:
+            self.on_call(method, params)
+        if method == 'getUpdates':
+            return web.json_response({'ok': True, 'result': await self.get_updates(params)})
+        await asyncio.sleep(self.latency)
+        return web.json_response({'ok': True, 'result': self.result(method, params)})
+
+    async def get_updates(self, params) -> list:
+        offset = int(params.get('offset') or 0)
+        self.pending = [update for update in self.pending if update['update_id'] >= offset]
+        if not self.pending and float(params.get('timeout') or 0) > 0:
+            self.updates_available.clear()
+            try:
+                await asyncio.wait_for(self.updates_available.wait(), float(params['timeout']))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:int(params.get('limit') or 100)]
+
+    async def push(self, update: dict, secret_token: str = None) -> int:
+        """
+        Delivers an update, returning the webhook's HTTP status (200 when queued for getUpdates).
+        `secret_token` overrides the one the webhook was set with.
+        """
+        if self.webhook is None:
+            self.pending.append(update)
+            self.updates_available.set()
+            return 200
+        url, token = self.webhook
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token or token or ''}
+        async with self.session.post(url, json=update, headers=headers) as response:
+            return response.status
+
+    async def close(self, app: web.Application = None) -> None:
+        # Answers pending long polls, and stops pushing to the webhook
+        self.updates_available.set()
+        if self.session is not None:
+            await self.session.close()
+
+    def result(self, method: str, params) -> object:
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bot', 'username': 'load_test_bot'}
+        if method == 'setWebhook':
+            self.webhook = (params['url'], params.get('secret_token'))
+            return True
+        if method == 'deleteWebhook':
+            self.webhook = None
+            return True
+        if method == 'getWebhookInfo':
+            return {'url': self.webhook[0] if self.webhook else '', 'has_custom_certificate': False,
+                    'pending_update_count': len(self.pending)}
+        if method in ('answerCallbackQuery', 'deleteMessage'):
+            return True
+        self.message_ids += 1
+        message = {
+            'message_id': self.message_ids,
+            'date': int(time.time()),
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+        }
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': f"photo-{self.message_ids}", 'file_unique_id': str(self.message_ids),
+                                 'width': 1, 'height': 1}]
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f"document-{self.message_ids}", 'file_unique_id': str(self.message_ids)}
+        elif method == 'sendSticker':
+            message['sticker'] = {'file_id': params.get('sticker'), 'file_unique_id': 's', 'width': 1, 'height': 1,
+                                  'is_animated': False, 'is_video': False, 'type': 'regular'}
+        else:
+            message['text'] = params.get('text', '')
+        return message
+
+
+class FakeOpenAI:
+    """
+    OpenAI chat completions (plain and streamed) and embeddings.
+    Serve it and use `<base URL>/v1` as the API base URL.
+    """
+
+    def __init__(self, chat_latency: float = 1.0, embedding_latency: float = 0.05, dimension: int = 256):
+        self.chat_latency = chat_latency
+        self.embedding_latency = embedding_latency
+        self.embedder = HashingEmbeddings(dimension)
+        self.calls = Counter()
+        self.app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.app.router.add_post('/v1/chat/completions', self.chat)
+        self.app.router.add_post('/v1/embeddings', self.embeddings)
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.calls['chat'] += 1
+        if not body.get('stream'):
+            await asyncio.sleep(self.chat_latency)
+            return web.json_response({
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': ANSWER}}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            })
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = ANSWER.split(' ')
+        for number, word in enumerate(words):
+            await asyncio.sleep(self.chat_latency / len(words))
+            chunk = {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': body['model'],
+                'choices': [{'index': 0, 'finish_reason': None,
+                             'delta': {'role': 'assistant', 'content': word if number == 0 else ' ' + word}}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.calls['embeddings'] += 1
+        texts = body['input'] if isinstance(body['input'], list) else [body['input']]
+        await asyncio.sleep(self.embedding_latency)
+        data = []
+        for number, text in enumerate(texts):
+            # Token arrays are expected to be code points, see `load_benchmark.offline_tiktoken`
+            vector = self.embedder.embed(text if isinstance(text, str) else ''.join(map(chr, text)))
+            if body.get('encoding_format') == 'base64':
+                vector = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode()
+            data.append({'object': 'embedding', 'index': number, 'embedding': vector})
+        return web.json_response({'object': 'list', 'model': body['model'], 'data': data,
+                                  'usage': {'prompt_tokens': 0, 'total_tokens': 0}})
+
+
+class FakeGoogle:
+    """
+    Google Drive v3 and Sheets v4: the course documents, checklist folders and the access list.
+
+    Use `<base URL>/drive/v3/` and `<base URL>/sheets/` as the API endpoints.
+
+    Attributes:
+        ids (dict): Drive ids of the folders and documents the bot is configured with.
+    """
+
+    ids = {
+        'embeddings_folder_id': 'embeddings',
+        'content_id_rus': 'content-ru',
+        'content_id_uz': 'content-uz',
+        'users': 'users-sheet',
+        'checklists_folder_jpg_rus': 'jpg-ru',
+        'checklists_folder_jpg_uz': 'jpg-uz',
+        'checklists_folder_pdf_rus': 'pdf-ru',
+        'checklists_folder_pdf_uz': 'pdf-uz',
+        'checklists_file_id_text_rus': 'checklists-text-ru',
+        'checklists_file_id_text_uz': 'checklists-text-uz',
+    }
+
+    def __init__(self, usernames: list, latency: float = 0.05, file_size: int = 200 * 1024):
+        self.usernames = usernames
+        self.latency = latency
+        self.calls = Counter()
+        self.folders = {'embeddings': [], 'jpg-ru': [], 'jpg-uz': [], 'pdf-ru': [], 'pdf-uz': []}
+        self.contents = {}
+        for path in sorted(glob.glob(os.path.join(FIXTURES, 'corpus', '*.md'))):
+            doc_id = os.path.splitext(os.path.basename(path))[0]
+            with open(path, encoding='utf-8') as file:
+                self.contents[doc_id] = file.read().encode('utf-8')
+            self.folders['embeddings'].append(self.file(doc_id, doc_id, GOOGLE_DOC_MIME_TYPE))
+        self.contents['targeting-uz'] = UZBEK_LESSON.encode('utf-8')
+        self.folders['embeddings'].append(self.file('targeting-uz', 'targeting-uz', GOOGLE_DOC_MIME_TYPE))
+        self.contents['content-ru'] = "Урок 1. Таргетинг\nУрок 2. Пиксель\nУрок 3. Аудитории\nУрок 4. Бюджет".encode()
+        self.contents['content-uz'] = "1-dars. Targeting\n2-dars. Piksel\n3-dars. Auditoriya\n4-dars. Byudjet".encode()
+        for language in ('ru', 'uz'):
+            self.contents[f'checklists-text-{language}'] = " ".join(
+                f"{number}) Чек-лист {number}" for number in range(1, 9)).encode()
+            for kind, extension in (('jpg', 'jpg'), ('pdf', 'pdf')):
+                folder = f'{kind}-{language}'
+                for number in range(1, 9):
+                    file_id = f'{folder}-{number}'
+                    self.contents[file_id] = os.urandom(file_size)
+                    self.folders[folder].append(self.file(file_id, f"{number}_checklist.{extension}", 'application/octet-stream'))
+
+        self.app = web.Application()
+        self.app.router.add_get('/drive/v3/files', self.list_files)
+        self.app.router.add_get('/drive/v3/files/{file_id}', self.get_file)
+        self.app.router.add_get('/drive/v3/files/{file_id}/export', self.export_file)
+        self.app.router.add_get('/drive/v3/changes/startPageToken', self.start_page_token)
+        self.app.router.add_get('/drive/v3/changes', self.list_changes)
+        self.app.router.add_get('/sheets/v4/spreadsheets/{sheet_id}/values/{range}', self.get_values)
+
+    @staticmethod
+    def file(file_id: str, name: str, mime_type: str) -> dict:
+        return {'id': file_id, 'name': name, 'mimeType': mime_type, 'modifiedTime': '2024-03-01T00:00:00.000Z',
+                'version': '1'}
+
+    async def call(self, name: str) -> None:
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+
+    async def list_files(self, request: web.Request) -> web.Response:
+        await self.call('files.list')
+        folder_id = re.search(r"'([^']+)' in parents", request.query.get('q', '')).group(1)
+        files = self.folders.get(folder_id, [])
+        mime_type = re.search(r"mimeType='([^']+)'", request.query.get('q', ''))
+        if mime_type:
+            files = [file for file in files if file['mimeType'] == mime_type.group(1)]
+        return web.json_response({'files': files})
+
+    async def get_file(self, request: web.Request) -> web.Response:
+        file_id = request.match_info['file_id']
+        if request.query.get('alt') == 'media':
+            await self.call('files.get_media')
+            return web.Response(body=self.contents[file_id])
+        await self.call('files.get')
+        return web.json_response(self.file(file_id, file_id, GOOGLE_DOC_MIME_TYPE))
+
+    async def export_file(self, request: web.Request) -> web.Response:
+        await self.call('files.export')
+        return web.Response(body=self.contents[request.match_info['file_id']])
+
+    async def start_page_token(self, request: web.Request) -> web.Response:
+        await self.call('changes.getStartPageToken')
+        return web.json_response({'startPageToken': '1'})
+
+    async def list_changes(self, request: web.Request) -> web.Response:
+        await self.call('changes.list')
+        return web.json_response({'changes': [], 'newStartPageToken': '1'})
+
+    async def get_values(self, request: web.Request) -> web.Response:
+        await self.call('values.get')
+        return web.json_response({'values': [[f"@{username}"] for username in self.usernames]})
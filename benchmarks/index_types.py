@@ -0,0 +1,91 @@
+"""
+Memory, build time, query latency and recall of the FAISS index types against the flat baseline.
+
+Vectors are synthetic: normalized points scattered around random cluster centres, which is
+closer to real embeddings than uniform noise. Each index is saved and loaded back the way the
+bot loads it (memory-mapped when possible), and recall@k is measured against exact search.
+
+Usage:
+    python benchmarks/index_types.py --vectors 50000 --dimension 1536
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from vector_index import INDEX_TYPES, VectorIndex  # noqa: E402
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def make_vectors(count: int, dimension: int, clusters: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, count)] + 0.3 * rng.standard_normal((count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', type=int, default=20000)
+    parser.add_argument('--dimension', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=4)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--ef-search', type=int, default=64)
+    parser.add_argument('--pq-m', type=int, default=64)
+    args = parser.parse_args()
+
+    points = make_vectors(args.vectors + args.queries, args.dimension, clusters=max(1, args.vectors // 100))
+    vectors, queries = points[:args.vectors], points[args.vectors:]
+    exact = faiss.IndexFlatL2(args.dimension)
+    exact.add(vectors)
+    _, truth = exact.search(queries, args.k)
+
+    print(f"{args.vectors} vectors of {args.dimension} dimensions, {args.queries} queries, k={args.k}")
+    print(f"{'index':>6} {'file MB':>8} {'load RSS MB':>12} {'build s':>8} {'query ms':>9} {'recall@k':>9}")
+    for index_type in INDEX_TYPES:
+        vector_index = VectorIndex(index_type, nprobe=args.nprobe, hnsw_ef_search=args.ef_search, pq_m=args.pq_m)
+        started = time.perf_counter()
+        index = vector_index.create_index(vectors)
+        index.add(vectors)
+        build_time = time.perf_counter() - started
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'index.faiss')
+            faiss.write_index(index, path)
+            del index
+            rss_before = rss_mb()
+            try:
+                index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                index = faiss.read_index(path)
+            load_rss = rss_mb() - rss_before
+            vector_index.configure(index)
+            file_mb = os.path.getsize(path) / 2 ** 20
+
+            started = time.perf_counter()
+            for query in queries:
+                _, found = index.search(query[None, :], args.k)
+            query_ms = (time.perf_counter() - started) / len(queries) * 1000
+            _, found = index.search(queries, args.k)
+            recall = np.mean([len(set(found[i]) & set(truth[i])) / args.k for i in range(len(queries))])
+            del index
+
+        print(f"{index_type:>6} {file_mb:>8.1f} {load_rss:>12.1f} {build_time:>8.2f} {query_ms:>9.3f} {recall:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
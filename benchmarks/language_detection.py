@@ -0,0 +1,107 @@
+"""
+Memory and per-call latency of the language detection backends.
+
+Each model is measured in a fresh process, so the reported RSS growth is the model's alone.
+Latency is measured for uncached predictions and for cache hits.
+
+Usage:
+    python benchmarks/language_detection.py lid.176.bin lid.176.ftz --labels ru,uz
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+SAMPLES = [
+    "Что такое таргетированная реклама?",
+    "Как настроить пиксель на сайте?",
+    "Сколько стоит запуск рекламной кампании",
+    "Targetlangan reklama nima?",
+    "Pikselni saytga qanday o‘rnatish mumkin?",
+    "Reklama kampaniyasini ishga tushirish qancha turadi",
+    "Привет",
+    "Salom",
+]
+
+
+def rss_mb() -> float:
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def measure(model_path: str, labels: list, threshold: float, rounds: int) -> dict:
+    from language_detector import LanguageDetector
+
+    rss_before = rss_mb()
+    detector = LanguageDetector(model_path=model_path, labels=labels, threshold=threshold)
+    started = time.perf_counter()
+    detector.load()
+    load_time = time.perf_counter() - started
+    rss_after = rss_mb()
+
+    texts = [f"{sample} {number}" for number in range(rounds) for sample in SAMPLES]
+    started = time.perf_counter()
+    for text in texts:
+        detector.predict(detector.normalize(text))
+    uncached = (time.perf_counter() - started) / len(texts)
+
+    for sample in SAMPLES:
+        detector.detect(sample)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for sample in SAMPLES:
+            detector.detect(sample)
+    cached = (time.perf_counter() - started) / (rounds * len(SAMPLES))
+
+    return {
+        'model': model_path,
+        'rss_mb': rss_after - rss_before,
+        'load_s': load_time,
+        'uncached_us': uncached * 1e6,
+        'cached_us': cached * 1e6,
+        'predictions': {sample: detector.detect(sample) for sample in SAMPLES},
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('models', nargs='+', help='paths to fastText language-id models')
+    parser.add_argument('--labels', default='', help='restrict predictions to these languages, e.g. ru,uz')
+    parser.add_argument('--threshold', type=float, default=0.0)
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    labels = [label for label in args.labels.split(',') if label]
+
+    if args.child:
+        print(json.dumps(measure(args.models[0], labels, args.threshold, args.rounds), ensure_ascii=False))
+        return
+
+    results = []
+    for model in args.models:
+        output = subprocess.run(
+            [sys.executable, __file__, model, '--labels', args.labels, '--threshold', str(args.threshold),
+             '--rounds', str(args.rounds), '--child'],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'model':<20} {'RSS, MB':>8} {'load, s':>8} {'uncached, us':>13} {'cached, us':>11}")
+    for result in results:
+        print(f"{os.path.basename(result['model']):<20} {result['rss_mb']:>8.1f} {result['load_s']:>8.2f} "
+              f"{result['uncached_us']:>13.1f} {result['cached_us']:>11.2f}")
+    for result in results:
+        print(f"\n{os.path.basename(result['model'])} predictions:")
+        for sample, language in result['predictions'].items():
+            print(f"  {language or '?':>4}  {sample}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""
+End-to-end load test: N students use the bot at once, against local fake Telegram, OpenAI and Google servers.
+
+The real `ChatGPTTelegramBot` handlers process the updates: every student sends /start, picks a
+language, asks questions and opens the course content, then the checklist broadcast goes out to
+all of them. The course index is built from the fixture corpus through the fake Drive and
+embeddings API. Reports p50/p95/p99 latency per handler, update throughput, broadcast time and
+the process RSS (the fake servers run in the same process, on their own thread and event loop).
+
+With `--task-queue`, answers and the broadcast go through the celery tasks, executed eagerly by
+an in-process worker.
+
+Without `--model-ft`, languages are told apart by script (Cyrillic is Russian, Latin-only is Uzbek)
+instead of loading a fastText model.
+
+Usage:
+    python benchmarks/load_benchmark.py --users 10,50,100 --questions 3 --llm-latency 1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import resource
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import tiktoken
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build
+from langchain_openai.embeddings import base as openai_embeddings
+from telegram import Update
+
+from fake_servers import FIXTURES, FakeBotApi, FakeGoogle, FakeOpenAI, serve
+
+import celery_app  # noqa: E402
+from google_services import GoogleApiClient, GoogleServices  # noqa: E402  (bot/ is put on the path by stubs)
+from openai_helper import OpenAI  # noqa: E402
+from telegram_bot import ChatGPTTelegramBot  # noqa: E402
+
+UZBEK_QUESTIONS = [
+    "Maqsadli reklama nima?",
+    "Piksel nima uchun kerak?",
+    "Auditoriyani qanday sozlash mumkin?",
+]
+
+CYRILLIC = re.compile(r'[а-яё]', re.IGNORECASE)
+LATIN = re.compile(r'[a-z]', re.IGNORECASE)
+
+
+class ScriptDetector:
+    """
+    Stand-in for `LanguageDetector`: Russian if the text has Cyrillic letters, else Uzbek (Latin script).
+    """
+
+    model = 'script'
+
+    def load(self) -> None:
+        pass
+
+    def detect(self, text: str):
+        if CYRILLIC.search(text):
+            return 'ru'
+        return 'uz' if LATIN.search(text) else None
+
+
+class CodePoints:
+    """
+    Offline stand-in for a tiktoken encoding: one token per character, its code point.
+    """
+
+    def encode(self, text: str, **kwargs) -> list:
+        return [ord(character) for character in text]
+
+
+def offline_tiktoken() -> None:
+    """
+    Lets `OpenAIEmbeddings` run when tiktoken can not download its encodings: texts are sent as
+    code points, which the fake embeddings API turns back into text.
+    """
+    try:
+        tiktoken.get_encoding('cl100k_base')
+    except Exception:
+        openai_embeddings.tiktoken = SimpleNamespace(encoding_for_model=lambda name: CodePoints(),
+                                                     get_encoding=lambda name: CodePoints())
+
+
+class FakeServers:
+    """
+    Runs the fake servers on a background thread with its own event loop.
+    """
+
+    def __init__(self, args, usernames):
+        self.bot_api = FakeBotApi(latency=args.telegram_latency)
+        self.openai = FakeOpenAI(chat_latency=args.llm_latency, embedding_latency=args.embedding_latency)
+        self.google = FakeGoogle(usernames, latency=args.google_latency)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fake-servers', daemon=True)
+        self.thread.start()
+        self.runners = []
+        self.urls = {name: self.start(fake.app) for name, fake in
+                     (('telegram', self.bot_api), ('openai', self.openai), ('google', self.google))}
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the servers' event loop, returning an awaitable of its result.
+        """
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def start(self, app) -> str:
+        runner, url = asyncio.run_coroutine_threadsafe(serve(app), self.loop).result()
+        self.runners.append(runner)
+        return url
+
+    def calls(self):
+        return self.bot_api.calls + self.openai.calls + self.google.calls
+
+    def stop(self) -> None:
+        for runner in self.runners:
+            asyncio.run_coroutine_threadsafe(runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def make_services(google_url: str, workers: int) -> GoogleServices:
+    """
+    Builds the shared Google API clients against the fake Drive and Sheets servers.
+    """
+    services = GoogleServices.__new__(GoogleServices)
+    services.service_account_file = None
+    services.creds = AnonymousCredentials()
+    services.sheets = build('sheets', 'v4', credentials=services.creds, static_discovery=True,
+                            client_options={'api_endpoint': f"{google_url}/sheets/"})
+    services.drive = build('drive', 'v3', credentials=services.creds, static_discovery=True,
+                           client_options={'api_endpoint': f"{google_url}/drive/v3/"})
+    services.client = GoogleApiClient(services.creds, max_workers=workers)
+    return services
+
+
+def make_configs(args, urls, directory):
+    """
+    Returns the OpenAI and Telegram configurations `main.py` would build, pointed at the fake servers.
+    """
+    stickers_path = os.path.join(directory, 'stickers.txt')
+    with open(stickers_path, 'w') as file:
+        file.write('\n'.join(f"sticker-{number}" for number in range(5)))
+
+    openai_config = {
+        'api_key': 'sk-load-test',
+        'api_base': f"{urls['openai']}/v1",
+        'temperature': 0,
+        'model': 'gpt-3.5-turbo',
+        'service_account': None,
+        'index_path': os.path.join(directory, 'faiss_index'),
+        'embedding_model': 'text-embedding-ada-002',
+        'embedding_cache_path': os.path.join(directory, 'embedding_cache'),
+        'chunk_size': 250,
+        'chunk_overlap': 0,
+        'chunk_separators': [" ", ",", "\n"],
+        'chunk_header_levels': 2,
+        'model_ft': args.model_ft or 'lid.176.bin',
+        'index_type': 'flat',
+        'index_mmap': True,
+        'embedding_batch_size': 2048,
+        'max_connections': 20,
+        'keepalive_expiry': 60,
+        'request_timeout': 120,
+        'max_concurrent_answers': args.max_concurrent_answers,
+        'index_wait_timeout': 60,
+        'stream_answers': args.stream,
+        'retrieval_candidates': 6,
+        'context_token_budget': 1000,
+        'context_token_budgets': {},
+        'context_duplicate_threshold': 0.8,
+        'answer_cache_size': args.answer_cache_size,
+        'answer_cache_threshold': 0.95,
+        'answer_cache_ttl': 86400,
+        'coalesce_questions': not args.no_coalesce,
+        'google_api_workers': args.google_workers,
+        **{key: FakeGoogle.ids[key] for key in ('embeddings_folder_id', 'content_id_rus', 'content_id_uz')},
+    }
+    telegram_config = {
+        'users': FakeGoogle.ids['users'],
+        'token': '123456:load-test',
+        'bot_api_url': f"{urls['telegram']}/bot",
+        'bot_language': 'ru',
+        'service_account': None,
+        'stickers_ids': stickers_path,
+        'model_ft': args.model_ft or 'lid.176.bin',
+        'language_labels': ['ru', 'uz'],
+        'language_threshold': 0,
+        'index_refresh_interval': 0,
+        'access_refresh_interval': 300,
+        'course_content_ttl': 600,
+        'file_id_cache_path': os.path.join(directory, 'file_id_cache.json'),
+        'folder_listing_cache_path': os.path.join(directory, 'folder_listing_cache.json'),
+        'broadcast_concurrency': 20,
+        'broadcast_rate': args.broadcast_rate,
+        'broadcast_per_chat_interval': 1.0,
+        'broadcast_max_retries': 3,
+        'user_store_path': os.path.join(directory, 'users.sqlite3'),
+        'user_store_flush_interval': 2,
+        'stream_answers': args.stream,
+        'stream_edit_interval': 1.5,
+        'slow_request_threshold': 0,
+        'user_max_in_flight': args.user_max_in_flight,
+        'user_max_queued': args.user_max_queued,
+        'webhook_url': None,
+        'webhook_listen': '127.0.0.1',
+        'webhook_port': 0,
+        'webhook_path': 'telegram',
+        'webhook_secret_token': None,
+        'webhook_max_connections': 40,
+        'task_queue': args.task_queue,
+        'task_timeout': 300,
+        'broadcast_timeout': 900,
+        **{key: value for key, value in FakeGoogle.ids.items() if key.startswith('checklists_')},
+    }
+    return openai_config, telegram_config
+
+
+class Student:
+    """
+    Builds the updates one student sends, as JSON as Telegram would deliver them.
+    """
+
+    update_ids = 0
+
+    def __init__(self, number: int):
+        self.user_id = 100000 + number
+        self.username = f"student{number}"
+        self.language = 'ru' if number % 2 == 0 else 'uz'
+
+    def update(self, **payload) -> dict:
+        Student.update_ids += 1
+        return {'update_id': Student.update_ids, **payload}
+
+    def message(self, text: str, command: bool = False) -> dict:
+        message = {
+            'message_id': Student.update_ids,
+            'date': int(time.time()),
+            'chat': {'id': self.user_id, 'type': 'private'},
+            'from': {'id': self.user_id, 'is_bot': False, 'first_name': 'Student', 'username': self.username},
+            'text': text,
+        }
+        if command:
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return self.update(message=message)
+
+    def choose_language(self) -> dict:
+        return self.update(callback_query={
+            'id': str(Student.update_ids),
+            'from': {'id': self.user_id, 'is_bot': False, 'first_name': 'Student', 'username': self.username},
+            'chat_instance': str(self.user_id),
+            'data': self.language,
+            'message': {
+                'message_id': Student.update_ids,
+                'date': int(time.time()),
+                'chat': {'id': self.user_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Bot'},
+                'text': "Привет! Выберите язык / Salom! Tilni tanlang.",
+            },
+        })
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def rss_mb() -> float:
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def start_bot(args, servers: FakeServers, directory: str) -> (ChatGPTTelegramBot, float):
+    """
+    Builds the bot against the fake servers, keeping its files in `directory`, and loads the
+    course index and the whitelist. Returns the bot and the time the index took to build.
+    """
+    loop = asyncio.get_running_loop()
+    openai_config, telegram_config = make_configs(args, servers.urls, directory)
+    services = make_services(servers.urls['google'], args.google_workers)
+    helper = OpenAI(openai_config, services)
+    if not args.model_ft:
+        helper.db_instance.language_detector = ScriptDetector()
+        helper.db_instance.chunk_language_detector = ScriptDetector()
+
+    started = time.perf_counter()
+    await loop.run_in_executor(None, helper.refresh_database)
+    index_seconds = time.perf_counter() - started
+
+    bot = ChatGPTTelegramBot(telegram_config, helper)
+    if not args.model_ft:
+        bot.language_detector = ScriptDetector()
+    await loop.run_in_executor(None, bot.access_control.refresh)
+    if args.task_queue:
+        celery_app.app.conf.task_always_eager = True
+        celery_app.worker = celery_app.Worker(bot)
+    return bot, index_seconds
+
+
+async def run(args, servers: FakeServers, users: int, questions: dict) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        bot, index_seconds = await start_bot(args, servers, directory)
+        application = bot.build_application()
+        errors = []
+
+        async def count_errors(update, context):
+            errors.append(context.error)
+
+        application.add_error_handler(count_errors)
+        await application.initialize()
+
+        latencies = defaultdict(list)
+
+        async def process(kind: str, update: dict) -> None:
+            started = time.perf_counter()
+            await application.process_update(Update.de_json(update, application.bot))
+            latencies[kind].append(time.perf_counter() - started)
+
+        async def student(number: int) -> None:
+            student = Student(number)
+            await asyncio.sleep(args.ramp * number / users)
+            await process('start', student.message('/start', command=True))
+            await process('button', student.choose_language())
+            language_questions = questions[student.language]
+            for question in range(args.questions):
+                await asyncio.sleep(args.think)
+                await process('question', student.message(language_questions[(number + question) % len(language_questions)]))
+            await process('course_content', student.message('/course_content', command=True))
+
+        calls_before = servers.calls()
+        started = time.perf_counter()
+        await asyncio.gather(*(student(number) for number in range(users)))
+        elapsed = time.perf_counter() - started
+        updates = sum(len(values) for values in latencies.values())
+
+        started = time.perf_counter()
+        await bot.send_files_by_counter(bot.service)
+        broadcast_seconds = time.perf_counter() - started
+        calls = servers.calls() - calls_before
+
+        await application.shutdown()
+        bot.user_store.close()
+
+    print(f"\n{users} users: index built in {index_seconds:.2f}s, {updates} updates in {elapsed:.2f}s "
+          f"({updates / elapsed:.1f} updates/s), {len(errors)} handler errors, RSS {rss_mb():.0f} MB")
+    print(f"{'handler':>15} {'count':>6} {'p50, s':>8} {'p95, s':>8} {'p99, s':>8} {'max, s':>8}")
+    for kind, values in latencies.items():
+        print(f"{kind:>15} {len(values):>6} {percentile(values, 0.5):>8.3f} {percentile(values, 0.95):>8.3f} "
+              f"{percentile(values, 0.99):>8.3f} {max(values):>8.3f}")
+    print(f"{'broadcast':>15} {users:>6} {'':>8} {'':>8} {'':>8} {broadcast_seconds:>8.3f}")
+    print("API calls: " + ", ".join(f"{name} {count}" for name, count in sorted(calls.items())))
+
+
+async def main(args) -> None:
+    with open(os.path.join(FIXTURES, 'questions.json'), encoding='utf-8') as file:
+        questions = {'ru': [item['question'] for item in json.load(file)], 'uz': UZBEK_QUESTIONS}
+
+    logging.getLogger().setLevel(args.log_level)
+    offline_tiktoken()
+    servers = FakeServers(args, [f"student{number}" for number in range(max(args.users))])
+    try:
+        print(f"model latency {args.llm_latency:.2f}s, Telegram latency {args.telegram_latency:.3f}s, "
+              f"Google latency {args.google_latency:.3f}s, concurrency limit {args.max_concurrent_answers}, "
+              f"answer cache {args.answer_cache_size}, streaming {'on' if args.stream else 'off'}, "
+              f"task queue {'on' if args.task_queue else 'off'}")
+        for users in args.users:
+            await run(args, servers, users, questions)
+    finally:
+        servers.stop()
+
+
+def add_bot_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the options of the fake servers and of the bot's configuration.
+    """
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='chat completion latency in seconds')
+    parser.add_argument('--embedding-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--google-latency', type=float, default=0.05)
+    parser.add_argument('--max-concurrent-answers', type=int, default=10, help='MAX_CONCURRENT_ANSWERS')
+    parser.add_argument('--answer-cache-size', type=int, default=500, help='ANSWER_CACHE_SIZE, 0 disables')
+    parser.add_argument('--no-coalesce', action='store_true', help='COALESCE_QUESTIONS=false')
+    parser.add_argument('--user-max-in-flight', type=int, default=1, help='USER_MAX_IN_FLIGHT')
+    parser.add_argument('--user-max-queued', type=int, default=1, help='USER_MAX_QUEUED')
+    parser.add_argument('--google-workers', type=int, default=8, help='GOOGLE_API_WORKERS')
+    parser.add_argument('--broadcast-rate', type=float, default=25, help='BROADCAST_RATE')
+    parser.add_argument('--stream', action='store_true', help='STREAM_ANSWERS')
+    parser.add_argument('--task-queue', action='store_true',
+                        help='TASK_QUEUE, with eager celery tasks run by a worker in this process')
+    parser.add_argument('--log-level', default='WARNING', help="the bot's log level during the run")
+    parser.add_argument('--model-ft', help='fastText language model to use instead of telling languages by script')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=lambda value: [int(n) for n in value.split(',')], default=[10, 50, 100])
+    parser.add_argument('--questions', type=int, default=3, help='questions asked by every student')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which the students arrive')
+    parser.add_argument('--think', type=float, default=0.0, help='seconds a student waits before each question')
+    add_bot_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
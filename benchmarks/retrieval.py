@@ -0,0 +1,104 @@
+"""
+Offline retrieval quality and cost of chunking settings.
+
+The fixture corpus in `benchmarks/fixtures/corpus` is split with each chunking setting and
+indexed with a deterministic local embedder, then the labelled questions in
+`benchmarks/fixtures/questions.json` are run against the index. A question is recalled at k
+when one of its top k chunks contains the labelled evidence passage.
+
+Usage:
+    python benchmarks/retrieval.py
+    python benchmarks/retrieval.py -k 4 --chunk-size 800 --chunk-overlap 80 --separators '["\\n\\n", "\\n", " "]'
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.documents import Document
+
+from stubs import HashingEmbeddings
+from chunking import Chunker
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+PRESETS = {
+    'current': Chunker(),
+    'lines-500': Chunker(chunk_size=500, chunk_overlap=50, separators=["\n\n", "\n", ". ", " "]),
+    'paragraphs-1000': Chunker(chunk_size=1000, chunk_overlap=100, separators=["\n\n", "\n", ". ", " "]),
+}
+
+
+def load_corpus(scale: int) -> list:
+    documents = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, 'corpus', '*.md'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding='utf-8') as file:
+            text = file.read()
+        for copy in range(scale):
+            documents.append(Document(page_content=text, metadata={'doc': name, 'doc_id': f"{name}-{copy}"}))
+    return documents
+
+
+def evaluate(chunker: Chunker, documents: list, questions: list, k: int) -> dict:
+    embeddings = HashingEmbeddings()
+    started = time.perf_counter()
+    chunks, ids = [], []
+    for document in documents:
+        for number, chunk in enumerate(chunker.split(document.page_content)):
+            chunk.metadata.update(document.metadata)
+            chunks.append(chunk)
+            ids.append(f"{document.metadata['doc_id']}:{number}")
+    db = FAISS.from_documents(chunks, embeddings, ids=ids)
+    build_time = time.perf_counter() - started
+
+    latencies, recalled = [], 0
+    for question in questions:
+        started = time.perf_counter()
+        results = db.similarity_search(question['question'], k=k)
+        latencies.append(time.perf_counter() - started)
+        recalled += any(result.metadata['doc'] == question['doc'] and question['evidence'] in result.page_content
+                        for result in results)
+
+    return {
+        'chunks': len(chunks),
+        'avg_chars': statistics.mean(len(chunk.page_content) for chunk in chunks),
+        'index_kb': len(db.serialize_to_bytes()) / 1024,
+        'build_s': build_time,
+        'query_ms': statistics.mean(latencies) * 1000,
+        'recall': recalled / len(questions),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', type=int, default=4, help='number of chunks retrieved per question')
+    parser.add_argument('--scale', type=int, default=1, help='number of copies of the corpus to index')
+    parser.add_argument('--chunk-size', type=int, help='evaluate a custom setting with this chunk size')
+    parser.add_argument('--chunk-overlap', type=int, default=0)
+    parser.add_argument('--separators', type=json.loads, default=["\n\n", "\n", " "], help='JSON list')
+    parser.add_argument('--header-levels', type=int, default=2)
+    args = parser.parse_args()
+
+    presets = dict(PRESETS)
+    if args.chunk_size:
+        presets['custom'] = Chunker(args.chunk_size, args.chunk_overlap, args.separators, args.header_levels)
+
+    documents = load_corpus(args.scale)
+    with open(os.path.join(FIXTURES, 'questions.json'), encoding='utf-8') as file:
+        questions = json.load(file)
+
+    print(f"{len(documents)} documents, {len(questions)} questions, k={args.k}")
+    print(f"{'setting':>16} {'chunks':>7} {'avg chars':>10} {'index KB':>9} {'build s':>8} "
+          f"{'query ms':>9} {'recall@k':>9}")
+    for name, chunker in presets.items():
+        result = evaluate(chunker, documents, questions, args.k)
+        print(f"{name:>16} {result['chunks']:>7} {result['avg_chars']:>10.0f} {result['index_kb']:>9.1f} "
+              f"{result['build_s']:>8.2f} {result['query_ms']:>9.2f} {result['recall']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
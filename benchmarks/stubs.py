@@ -0,0 +1,159 @@
+"""
+Local stand-ins for the OpenAI API and the Drive-backed course index, used by the benchmarks.
+
+Run the benchmarks from the repository root so that `translations.json` is found, e.g.
+`python benchmarks/answer_concurrency.py`.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+import numpy as np  # noqa: E402
+from langchain_community.embeddings import FakeEmbeddings  # noqa: E402
+from langchain_core.embeddings import Embeddings  # noqa: E402
+from langchain_community.vectorstores.faiss import FAISS  # noqa: E402
+
+import openai_helper  # noqa: E402
+
+CORPUS = [
+    "Таргетированная реклама — это показ объявлений аудитории, отобранной по заданным критериям.",
+    "Пиксель позволяет отслеживать действия пользователей на сайте после клика по объявлению.",
+    "Look-alike аудитории строятся на основе уже существующих клиентов.",
+    "Бюджет кампании можно задавать на уровне группы объявлений или всей кампании.",
+]
+
+ANSWER = "Таргетированная реклама — это показ объявлений выбранной аудитории. Подробнее в уроке 1."
+
+
+def chat_completion(content: str) -> dict:
+    return {
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion',
+        'model': 'stub',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+    }
+
+
+class StubCompletions:
+    """
+    Synchronous chat completions endpoint that answers after `latency` seconds.
+    """
+
+    def __init__(self, latency: float, answer: str = ANSWER):
+        self.latency = latency
+        self.answer = answer
+
+    def create(self, messages, **kwargs):
+        time.sleep(self.latency)
+        return chat_completion(self.answer)
+
+
+def chat_completion_chunk(content: str, finish_reason: str = None) -> dict:
+    return {
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion.chunk',
+        'model': 'stub',
+        'choices': [{'index': 0, 'finish_reason': finish_reason, 'delta': {'role': 'assistant', 'content': content}}],
+    }
+
+
+class AsyncStubCompletions(StubCompletions):
+    """
+    Asynchronous chat completions endpoint that answers after `latency` seconds.
+    With `stream=True` the answer is streamed word by word, spread evenly over `latency`.
+    """
+
+    async def create(self, messages, stream: bool = False, **kwargs):
+        if stream:
+            return self.stream()
+        await asyncio.sleep(self.latency)
+        return chat_completion(self.answer)
+
+    async def stream(self):
+        words = self.answer.split(' ')
+        for number, word in enumerate(words):
+            await asyncio.sleep(self.latency / len(words))
+            yield chat_completion_chunk(word if number == 0 else ' ' + word)
+        yield chat_completion_chunk('', finish_reason='stop')
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic offline embedder: hashed word prefixes and character trigrams.
+
+    Texts that share vocabulary get similar vectors, which is enough for retrieval quality
+    comparisons on a fixture corpus without calling the embeddings API.
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+
+    def embed(self, text: str) -> list:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            features = [word[:5]] + [word[i:i + 3] for i in range(len(word) - 2)]
+            for feature in features:
+                digest = hashlib.md5(feature.encode('utf-8')).digest()
+                vector[int.from_bytes(digest[:4], 'little') % self.size] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list) -> list:
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list:
+        return self.embed(text)
+
+
+class StubDatabase:
+    """
+    Replaces `database_helper.Database`: in-memory shards over `CORPUS` with fake embeddings.
+    """
+
+    languages = ('ru', 'uz')
+
+    def __init__(self, config, embeddings=None, services=None):
+        self.config = config
+
+    def open_database(self):
+        return {language: FAISS.from_texts(CORPUS, FakeEmbeddings(size=64)) for language in self.languages}
+
+
+def make_openai(latency: float, max_concurrent_answers: int = 10,
+                stream_answers: bool = False) -> openai_helper.OpenAI:
+    """
+    Builds a real `OpenAI` helper whose chat model is served by the stubs above.
+    """
+    openai_helper.Database = StubDatabase
+    helper = openai_helper.OpenAI(config={
+        'api_key': 'sk-stub',
+        'model': 'gpt-3.5-turbo',
+        'temperature': 0,
+        'embedding_model': 'text-embedding-ada-002',
+        'embedding_batch_size': 2048,
+        'max_connections': max_concurrent_answers,
+        'keepalive_expiry': 60,
+        'request_timeout': 60,
+        'max_concurrent_answers': max_concurrent_answers,
+        'index_wait_timeout': 60,
+        'stream_answers': stream_answers,
+        'retrieval_candidates': 6,
+        'context_token_budget': 1000,
+        'context_token_budgets': {},
+        'context_duplicate_threshold': 0.8,
+        'answer_cache_size': 0,
+        'answer_cache_threshold': 0.95,
+        'answer_cache_ttl': 86400,
+        'coalesce_questions': False,
+    })
+    helper.client = SimpleNamespace(chat=SimpleNamespace(completions=StubCompletions(latency)))
+    helper.async_client = SimpleNamespace(chat=SimpleNamespace(completions=AsyncStubCompletions(latency)))
+    helper.refresh_database()
+    return helper
@@ -0,0 +1,109 @@
+"""
+Update delivery latency of polling vs. the webhook server, with a fake Bot API pushing updates.
+
+N students send /start at once. An update's latency is the time from the fake Bot API receiving it
+to the bot's reply reaching the fake Bot API, so it covers getUpdates long polling or the webhook
+request plus the real /start handler. The webhook is also checked to reject updates that do not
+carry its secret token.
+
+Usage:
+    python benchmarks/update_delivery.py --users 10,100,500 --max-connections 40
+"""
+import argparse
+import asyncio
+import logging
+import socket
+import tempfile
+import time
+
+from load_benchmark import FakeServers, Student, add_bot_arguments, offline_tiktoken, percentile, start_bot
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def push_all(fake, users: int, ramp: float, timeout: float = 60) -> list:
+    """
+    Pushes a /start from every student and returns the seconds each waited for the reply.
+    Runs on the fake servers' event loop.
+    """
+    loop = asyncio.get_running_loop()
+    replies = {}
+
+    def on_call(method, params):
+        reply = replies.get(int(params.get('chat_id') or 0))
+        if method == 'sendMessage' and reply is not None and not reply.done():
+            reply.set_result(time.perf_counter())
+
+    async def push(number: int) -> float:
+        student = Student(number)
+        replies[student.user_id] = loop.create_future()
+        await asyncio.sleep(ramp * number / users)
+        started = time.perf_counter()
+        status = await fake.push(student.message('/start', command=True))
+        if status != 200:
+            raise RuntimeError(f"Update rejected with HTTP {status}")
+        return await asyncio.wait_for(replies[student.user_id], timeout) - started
+
+    fake.on_call = on_call
+    try:
+        return await asyncio.gather(*(push(number) for number in range(users)))
+    finally:
+        fake.on_call = None
+
+
+async def measure(bot, servers: FakeServers, mode: str, users: int, args) -> None:
+    application = bot.build_application()
+    await application.initialize()
+    if mode == 'webhook':
+        port = free_port()
+        bot.config.update(webhook_url=f"http://127.0.0.1:{port}", webhook_port=port,
+                          webhook_max_connections=args.max_connections)
+        await application.updater.start_webhook(**bot.webhook_options())
+    else:
+        await application.updater.start_polling(timeout=10, poll_interval=0)
+    await application.start()
+
+    started = time.perf_counter()
+    latencies = await servers.run(push_all(servers.bot_api, users, args.ramp))
+    elapsed = time.perf_counter() - started
+    rejected = ''
+    if mode == 'webhook':
+        status = await servers.run(servers.bot_api.push(Student(0).message('/start', command=True), 'wrong-token'))
+        rejected = 'yes' if status == 403 else f"no (HTTP {status})"
+
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    print(f"{users:>6} {mode:>8} {percentile(latencies, 0.5):>8.3f} {percentile(latencies, 0.95):>8.3f} "
+          f"{percentile(latencies, 0.99):>8.3f} {max(latencies):>8.3f} {users / elapsed:>10.1f} {rejected:>14}")
+
+
+async def main(args) -> None:
+    logging.getLogger().setLevel(args.log_level)
+    offline_tiktoken()
+    servers = FakeServers(args, [f"student{number}" for number in range(max(args.users))])
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            bot, _ = await start_bot(args, servers, directory)
+            print(f"Telegram latency {args.telegram_latency:.3f}s, webhook max connections {args.max_connections}")
+            print(f"{'users':>6} {'mode':>8} {'p50, s':>8} {'p95, s':>8} {'p99, s':>8} {'max, s':>8} "
+                  f"{'updates/s':>10} {'bad secret 403':>14}")
+            for users in args.users:
+                for mode in ('polling', 'webhook'):
+                    await measure(bot, servers, mode, users, args)
+            bot.user_store.close()
+    finally:
+        servers.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=lambda value: [int(n) for n in value.split(',')], default=[10, 100, 500])
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which the updates arrive')
+    parser.add_argument('--max-connections', type=int, default=40, help='WEBHOOK_MAX_CONNECTIONS')
+    add_bot_arguments(parser)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,60 @@
+import logging
+from datetime import datetime
+from typing import FrozenSet, Optional
+
+from database_helper import Database
+
+
+class AccessControl:
+    """
+    Whitelist of Telegram usernames allowed to use the bot, loaded from the users spreadsheet.
+
+    Lookups are O(1) on normalized usernames. `refresh` re-reads the spreadsheet and swaps the
+    new set in with a single assignment, so handlers never see a half-built list and never wait
+    for Sheets. If the spreadsheet cannot be read, the last good list keeps being served.
+
+    Attributes:
+        db (Database): Database used to read the spreadsheet.
+        file_id_users (str): ID of the users spreadsheet.
+        usernames (frozenset): Normalized usernames from the last successful refresh.
+        last_refresh (datetime): Time of the last successful refresh, None before the first one.
+    """
+
+    def __init__(self, db: Database, file_id_users: str):
+        self.db = db
+        self.file_id_users = file_id_users
+        self.usernames: FrozenSet[str] = frozenset()
+        self.last_refresh: Optional[datetime] = None
+
+    @staticmethod
+    def normalize(username: Optional[str]) -> Optional[str]:
+        """
+        Returns the username without the leading '@', stray BOMs and whitespace, in lower case,
+        as Telegram usernames are case-insensitive.
+        """
+        if not username:
+            return None
+        return username.replace('\ufeff', '').strip().lstrip('@').lower() or None
+
+    def is_allowed(self, username: Optional[str]) -> bool:
+        return self.normalize(username) in self.usernames
+
+    def refresh(self) -> bool:
+        """
+        Reloads the whitelist from the spreadsheet. Blocking, meant to run off the event loop.
+
+        Returns:
+            True if the whitelist was reloaded, False if the last good list is kept.
+        """
+        try:
+            rows = self.db.get_usernames(self.file_id_users)
+        except Exception:
+            logging.warning(f"Keeping the whitelist from {self.last_refresh or 'never'}, "
+                            f"the users spreadsheet could not be read")
+            return False
+
+        usernames = frozenset(filter(None, (self.normalize(row) for row in rows)))
+        self.usernames = usernames
+        self.last_refresh = datetime.now()
+        logging.info(f"Whitelist refreshed: {len(usernames)} users")
+        return True
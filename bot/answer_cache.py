@@ -0,0 +1,114 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from metrics import ANSWER_CACHE_LOOKUPS
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers by question embedding, so near-identical questions are answered without
+    retrieval or a completion.
+
+    Entries are kept per language. A lookup returns the answer of the most similar recent
+    question when its cosine similarity reaches `threshold`. Each language holds at most
+    `max_entries` questions, evicted least recently used first, and entries older than `ttl`
+    seconds are dropped. An answer generated while the cache was invalidated is not stored,
+    see `store`.
+
+    Attributes:
+        threshold (float): Minimum cosine similarity for a hit.
+        max_entries (int): Maximum number of cached questions per language.
+        ttl (float): Lifetime of an entry, in seconds.
+        hits (int): Number of lookups answered from the cache.
+        misses (int): Number of lookups that found no similar question.
+        generation (int): Number of times the cache was invalidated.
+    """
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 500, ttl: float = 86400):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.entries: Dict[str, OrderedDict] = {}
+        self.next_key = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, language: str, embedding: List[float]) -> Optional[str]:
+        """
+        Returns the cached answer for the most similar question in `language`, or None.
+        """
+        vector = self.normalize(embedding)
+        with self.lock:
+            entries = self.entries.get(language)
+            if entries:
+                self.expire(entries)
+            if not entries:
+                self.misses += 1
+                ANSWER_CACHE_LOOKUPS.labels('miss').inc()
+                return None
+
+            keys = list(entries)
+            similarities = np.vstack([entries[key][0] for key in keys]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                ANSWER_CACHE_LOOKUPS.labels('miss').inc()
+                return None
+
+            entries.move_to_end(keys[best])
+            self.hits += 1
+            ANSWER_CACHE_LOOKUPS.labels('hit').inc()
+            logging.info(f"Answer cache hit (similarity {similarities[best]:.3f}, "
+                         f"{self.hits} hits / {self.misses} misses)")
+            return entries[keys[best]][1]
+
+    def store(self, language: str, embedding: List[float], answer: str, generation: int) -> None:
+        """
+        Caches the answer to a question, evicting the least recently used entry when full.
+        `generation` is the cache's `generation` from before the answer was generated: if the
+        cache was invalidated since, the answer may come from the old index and is not stored.
+        """
+        vector = self.normalize(embedding)
+        with self.lock:
+            if generation != self.generation:
+                return
+            entries = self.entries.setdefault(language, OrderedDict())
+            entries[self.next_key] = (vector, answer, time.monotonic())
+            self.next_key += 1
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """
+        Drops every cached answer, e.g. after the course index was rebuilt.
+        """
+        with self.lock:
+            self.entries = {}
+            self.generation += 1
+        logging.info("Answer cache invalidated")
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': sum(len(entries) for entries in self.entries.values()),
+            }
+
+    def expire(self, entries: OrderedDict) -> None:
+        deadline = time.monotonic() - self.ttl
+        for key in [key for key, (_, _, created_at) in entries.items() if created_at < deadline]:
+            del entries[key]
+
+    @staticmethod
+    def normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
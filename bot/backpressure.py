@@ -0,0 +1,117 @@
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+# Words and numbers with their inner punctuation ("2.5", "look-alike"), and operators
+TOKEN_PATTERN = re.compile(r'\w+(?:[.,:/\'-]\w+)*|[-+*/=<>%^&|~@#$№]')
+
+
+def normalize_question(question: str) -> str:
+    """
+    Returns the words, numbers and operators of a question in lower case, separated by single
+    spaces, so resends that only differ in case, spacing or sentence punctuation compare equal.
+    Returns an empty string for a question without any, e.g. only emoji.
+    """
+    return ' '.join(TOKEN_PATTERN.findall(question.lower()))
+
+
+class UserQuestionLimiter:
+    """
+    Caps the questions each user has in flight: up to `max_in_flight` are answered at once and
+    up to `max_queued` more wait for their turn. Further questions are refused until one of
+    the user's questions finishes.
+
+    Attributes:
+        max_in_flight (int): Questions of one user answered at the same time.
+        max_queued (int): Questions of one user waiting for their turn.
+        users (dict): User id -> [admitted questions, semaphore of the in-flight slots], for
+            users with questions admitted.
+    """
+
+    def __init__(self, max_in_flight: int = 1, max_queued: int = 1):
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.users: Dict[int, list] = {}
+
+    @asynccontextmanager
+    async def admit(self, user_id: int):
+        """
+        Admits a question of the user for the duration of the block, yielding False if they
+        already have as many questions in flight and queued as allowed.
+        """
+        user = self.users.setdefault(user_id, [0, asyncio.Semaphore(self.max_in_flight)])
+        if user[0] >= self.max_in_flight + self.max_queued:
+            yield False
+            return
+
+        user[0] += 1
+        try:
+            yield True
+        finally:
+            user[0] -= 1
+            if not user[0]:
+                del self.users[user_id]
+
+    @asynccontextmanager
+    async def turn(self, user_id: int):
+        """
+        Waits for one of the user's in-flight slots and holds it for the duration of the block.
+        Only valid inside `admit`.
+        """
+        async with self.users[user_id][1]:
+            yield
+
+
+class LeaderCancelled(Exception):
+    """
+    Tells the callers waiting in `SingleFlight.run` that the call they waited for was cancelled.
+    """
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time: a caller asking for a key that is already being
+    computed waits for that call and shares its result, or its exception. If the caller running
+    the call is cancelled, one of the waiting callers runs it again.
+
+    Attributes:
+        calls (dict): Futures of the calls in flight, by key.
+        coalesced (int): Number of callers that shared another caller's result.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def run(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Returns the result of `function()`, or of the call already in flight for `key`, and
+        whether the result was shared.
+        """
+        while key in self.calls:
+            future = self.calls[key]
+            try:
+                result = await asyncio.shield(future)
+            except LeaderCancelled:
+                # The caller running the call was cancelled, take over
+                continue
+            self.coalesced += 1
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        # Nobody may wait for this call, its exception is retrieved here
+        future.add_done_callback(lambda done: done.exception())
+        self.calls[key] = future
+        try:
+            result = await function()
+        except asyncio.CancelledError:
+            future.set_exception(LeaderCancelled())
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self.calls[key]
+        future.set_result(result)
+        return result, False
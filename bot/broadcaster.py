@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, TypeVar
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from metrics import BROADCAST_SEND_SECONDS, BROADCAST_SENDS
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket: allows `rate` acquisitions per second on average, with bursts of up
+    to `capacity`. `pause` stops all acquisitions for a while, e.g. after a flood-control error.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """
+    Sends Telegram requests to many chats concurrently while staying inside the Bot API limits.
+
+    Every request waits for a token from a global bucket (about 30 messages per second are
+    allowed overall) and keeps at least `per_chat_interval` seconds between two requests to
+    the same chat. On `RetryAfter` every request is paused for the time Telegram asks for.
+    Network errors are retried with exponential backoff. Requests Telegram refused for
+    good (blocked bot, bad request) are not retried.
+
+    Attributes:
+        max_concurrency (int): Maximum number of chats served at the same time.
+        bucket (TokenBucket): Global rate limit.
+        per_chat_interval (float): Minimum delay between two requests to one chat, in seconds.
+        max_retries (int): Retries of a request after the first attempt.
+        backoff (float): Delay before the first retry, doubled on each further retry.
+    """
+
+    def __init__(self, max_concurrency: int = 20, global_rate: float = 25, per_chat_interval: float = 1.0,
+                 max_retries: int = 3, backoff: float = 1.0):
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(global_rate)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.next_chat_slot: Dict[int, float] = {}
+
+    async def call(self, chat_id: int, request: Callable[[], Awaitable[T]]) -> T:
+        """
+        Performs one request to a chat within the rate limits, retrying transient failures.
+
+        Args:
+            chat_id (int): The chat the request goes to.
+            request (Callable): Starts the request, called again on every attempt.
+
+        Returns:
+            The result of the request.
+        """
+        started = time.perf_counter()
+        outcome = 'failed'
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self.wait_for_chat(chat_id)
+                await self.bucket.acquire()
+                try:
+                    result = await request()
+                    outcome = 'sent'
+                    return result
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    BROADCAST_SENDS.labels('retried').inc()
+                    logging.warning(f"Flood control exceeded, pausing the broadcast for {e.retry_after}s")
+                    self.bucket.pause(float(e.retry_after))
+                except (BadRequest, Forbidden):
+                    raise
+                except NetworkError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    BROADCAST_SENDS.labels('retried').inc()
+                    delay = self.backoff * 2 ** attempt
+                    logging.warning(f"Request to chat {chat_id} failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        finally:
+            BROADCAST_SEND_SECONDS.observe(time.perf_counter() - started)
+            BROADCAST_SENDS.labels(outcome).inc()
+
+    async def wait_for_chat(self, chat_id: int) -> None:
+        now = time.monotonic()
+        slot = max(now, self.next_chat_slot.get(chat_id, 0.0))
+        self.next_chat_slot[chat_id] = slot + self.per_chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def run(self, chat_ids: Iterable[int], deliver: Callable[[int], Awaitable[bool]]) -> Dict[str, float]:
+        """
+        Runs `deliver` for every chat, at most `max_concurrency` at a time.
+
+        Args:
+            chat_ids (Iterable[int]): The chats to deliver to.
+            deliver (Callable): Delivers everything to one chat, returns True on full success.
+
+        Returns:
+            Run statistics: chats delivered, chats failed, duration and throughput.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        started = time.monotonic()
+
+        async def deliver_one(chat_id):
+            async with semaphore:
+                try:
+                    return await deliver(chat_id)
+                except Exception as e:
+                    logging.error(f"Broadcast to chat {chat_id} failed: {e}")
+                    return False
+
+        results = await asyncio.gather(*(deliver_one(chat_id) for chat_id in chat_ids))
+        duration = time.monotonic() - started
+        self.next_chat_slot.clear()
+        sent = sum(1 for result in results if result)
+        return {
+            'sent': sent,
+            'failed': len(results) - sent,
+            'duration': duration,
+            'throughput': len(results) / duration if duration else 0.0,
+        }
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import threading
+from typing import Optional
+
+from celery import Celery
+from celery.signals import worker_process_init
+from dotenv import load_dotenv
+from telegram import Message
+
+from metrics import RequestTrace
+from openai_helper import IndexUnavailable
+
+load_dotenv()
+
+task_always_eager = os.environ.get('CELERY_TASK_ALWAYS_EAGER', 'false').lower() == 'true'
+app = Celery(
+    'tgbot_neuro',
+    # Only eager tasks may go without a broker: no worker could consume the in-memory one
+    broker=os.environ.get('CELERY_BROKER_URL', 'memory://' if task_always_eager else None),
+    backend=os.environ.get('CELERY_RESULT_BACKEND', 'rpc://'),
+)
+app.conf.update(
+    task_serializer='json',
+    result_serializer='json',
+    accept_content=['json'],
+    # Tasks run for tens of seconds, a worker should not hold more than it is working on
+    worker_prefetch_multiplier=1,
+    task_always_eager=task_always_eager,
+    broker_connection_retry_on_startup=True,
+)
+
+# State of this worker process, built on first use
+worker = None
+worker_lock = threading.Lock()
+
+
+class Worker:
+    """
+    What the tasks of a worker process run with: the bot's components, and an event loop on a
+    background thread that runs the tasks' coroutines. The async clients and locks of the
+    components are bound to that one loop, whichever pool thread executes a task.
+
+    The bot process owns every file the bot writes: it builds the course index and the
+    embedding cache, and keeps the user store and the file_id and folder listing caches.
+    Workers only load the index it saved, get the users to serve and the caches with each
+    broadcast, and return the caches updated.
+
+    Attributes:
+        telegram_bot (ChatGPTTelegramBot): Answers questions and sends the checklists.
+        openai (OpenAI): The bot's OpenAI helper, with the course index.
+        loop (AbstractEventLoop): Loop the tasks' coroutines run on.
+    """
+
+    def __init__(self, telegram_bot):
+        self.telegram_bot = telegram_bot
+        self.openai = telegram_bot.openai
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='celery-tasks', daemon=True).start()
+
+    @classmethod
+    def from_environment(cls) -> 'Worker':
+        """
+        Builds the bot from the same environment variables as `main.py`, without the files
+        that the bot process owns.
+        """
+        # main imports the bot, which imports this module
+        from google_services import GoogleServices
+        from main import load_config
+        from openai_helper import OpenAI
+        from telegram_bot import ChatGPTTelegramBot
+
+        openai_config, telegram_config = load_config()
+        openai_config['index_readonly'] = True
+        telegram_config.update(user_store_path=None, file_id_cache_path=None, folder_listing_cache_path=None)
+        services = GoogleServices(openai_config['service_account'], openai_config['google_api_workers'],
+                                  openai_config['drive_chunk_size'])
+        openai = OpenAI(config=openai_config, services=services)
+        return cls(ChatGPTTelegramBot(config=telegram_config, openai=openai))
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def refresh_index(self) -> None:
+        """
+        Loads the course index the bot process saved last, if it changed. Eager tasks share
+        the bot process's own index, which is refreshed by its scheduler.
+        """
+        if not self.openai.config.get('index_readonly'):
+            return
+        try:
+            self.openai.refresh_database()
+        except Exception as e:
+            # Вопросы дождутся индекса с таймаутом, см. OpenAI.wait_for_database
+            logging.warning(f"Could not load the saved course index: {e}")
+
+
+def get_worker() -> Worker:
+    global worker
+    with worker_lock:
+        if worker is None:
+            worker = Worker.from_environment()
+        return worker
+
+
+@worker_process_init.connect
+def init_worker(**kwargs) -> None:
+    # Prefork workers load the course index before taking tasks
+    get_worker().refresh_index()
+
+
+@app.task(name='answer_question')
+def answer_question(question: str, language: str, placeholder: dict) -> Optional[str]:
+    """
+    Answers a user's question and sends the answer to them.
+
+    Args:
+        question (str): The user's question.
+        language (str): The language of the question and the answer.
+        placeholder (dict): The message sent to the user while the answer is prepared, as Bot API JSON.
+
+    Returns:
+        The answer sent, for the bot process to share with identical questions, or None if the
+        course index is not loaded.
+    """
+    current = get_worker()
+    current.refresh_index()
+    message = Message.de_json(placeholder, current.telegram_bot.bot)
+    trace = RequestTrace(f"queued question from user {message.chat_id}",
+                         current.telegram_bot.config['slow_request_threshold'])
+    try:
+        response = current.run(current.telegram_bot.send_answer(question, language, message, trace))
+    except IndexUnavailable:
+        trace.finish('index_unavailable')
+        return None
+    except Exception:
+        trace.finish('error')
+        logging.exception(f"Error answering a question from user {message.chat_id}")
+        raise
+    trace.finish('answered')
+    return response
+
+
+@app.task(name='broadcast_checklists')
+def broadcast_checklists(counter: int, users_by_language: dict, file_ids: dict, folder_listing: dict) -> dict:
+    """
+    Sends checklist `counter` to the given users.
+
+    Args:
+        counter (int): Number of the checklist to send.
+        users_by_language (dict): Ids of the users to serve, by language.
+        file_ids (dict): The bot process's file_id cache entries.
+        folder_listing (dict): The bot process's folder listing cache, as a snapshot.
+
+    Returns:
+        A dict with the ids of the users who received all their files (`served`), and the
+        file_id cache entries and folder listing snapshot after the broadcast, for the bot
+        process to save.
+    """
+    current = get_worker()
+    telegram_bot = current.telegram_bot
+    telegram_bot.file_id_cache.entries = file_ids
+    telegram_bot.folder_listing.restore(folder_listing)
+    served = current.run(telegram_bot.deliver_checklists(telegram_bot.service, counter, users_by_language))
+    return {
+        'served': served,
+        'file_ids': telegram_bot.file_id_cache.entries,
+        'folder_listing': telegram_bot.folder_listing.snapshot(),
+    }
@@ -0,0 +1,60 @@
+from typing import List, Sequence
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
+from langchain_core.documents import Document
+
+
+class Chunker:
+    """
+    Splits course documents into the chunks that are embedded and retrieved.
+
+    Documents are first split on Markdown headers, up to `header_levels` deep, and the sections
+    are then split recursively on `separators` into chunks of at most `chunk_size` characters
+    that overlap by `chunk_overlap` characters. Separators are tried in the given order, so
+    coarser boundaries (paragraphs, lines) should come before finer ones (spaces).
+
+    Attributes:
+        chunk_size (int): Maximum chunk length, in characters.
+        chunk_overlap (int): Number of characters consecutive chunks share.
+        separators (list): Separators to split sections on, in order of preference.
+        headers_to_split_on (list): Markdown header prefixes and the metadata keys they are stored under.
+    """
+
+    def __init__(self, chunk_size: int = 250, chunk_overlap: int = 0,
+                 separators: Sequence[str] = (" ", ",", "\n"), header_levels: int = 2):
+        if chunk_overlap >= chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = list(separators)
+        self.headers_to_split_on = [("#" * level, f"Header {level}") for level in range(1, header_levels + 1)]
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'Chunker':
+        return cls(
+            chunk_size=config.get('chunk_size', 250),
+            chunk_overlap=config.get('chunk_overlap', 0),
+            separators=config.get('chunk_separators', (" ", ",", "\n")),
+            header_levels=config.get('chunk_header_levels', 2),
+        )
+
+    def settings(self) -> dict:
+        """
+        Returns the settings the chunks depend on, as stored in the index manifest.
+        """
+        return {
+            'headers_to_split_on': [list(header) for header in self.headers_to_split_on],
+            'chunk_size': self.chunk_size,
+            'chunk_overlap': self.chunk_overlap,
+            'separators': self.separators,
+        }
+
+    def split(self, text: str) -> List[Document]:
+        if self.headers_to_split_on:
+            sections = MarkdownHeaderTextSplitter(headers_to_split_on=self.headers_to_split_on).split_text(text)
+        else:
+            sections = [Document(page_content=text)]
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=self.chunk_size,
+                                                       chunk_overlap=self.chunk_overlap,
+                                                       separators=self.separators)
+        return text_splitter.split_documents(sections)
@@ -0,0 +1,153 @@
+import logging
+import re
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+import tiktoken
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+WORD_PATTERN = re.compile(r'\w+')
+PIECE_PATTERN = re.compile(r'\w{1,4}|\s+|[^\w\s]')
+
+# (question, embedding) of the question being answered, when the caller already embedded it
+query_embedding: ContextVar[Optional[Tuple[str, List[float]]]] = ContextVar('query_embedding', default=None)
+
+
+class ApproximateEncoding:
+    """
+    Stand-in for a `tiktoken` encoding when its BPE ranks can not be loaded (e.g. no network on
+    first use): splits text into word pieces of up to four characters, close to BPE token counts
+    for Cyrillic and Latin text.
+    """
+
+    def encode(self, text: str) -> List[str]:
+        return PIECE_PATTERN.findall(text)
+
+    def decode(self, pieces: List[str]) -> str:
+        return ''.join(pieces)
+
+
+class ContextBuilder:
+    """
+    Packs retrieved chunks into a prompt context that fits a token budget.
+
+    Candidates are taken best score first; a chunk that mostly repeats one already packed
+    (word trigram Jaccard similarity of at least `duplicate_threshold`) is dropped, and packing
+    stops at the first chunk that would exceed the budget. Tokens are counted with the
+    model's `tiktoken` encoding.
+
+    Attributes:
+        model_name (str): The chat model the context is built for.
+        max_tokens (int): Token budget of the context.
+        duplicate_threshold (float): Similarity above which a chunk counts as a near-duplicate.
+        separator (str): Text chunks are joined with, as in the "stuff" chain.
+    """
+
+    def __init__(self, model_name: str, max_tokens: int, duplicate_threshold: float = 0.8, separator: str = '\n\n'):
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.separator = separator
+        try:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            logging.warning(f"Could not load the tiktoken encoding for {model_name}, "
+                            f"token counts are approximate: {e}")
+            self.encoding = ApproximateEncoding()
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    @staticmethod
+    def shingles(text: str) -> set:
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) < 3:
+            return {tuple(words)}
+        return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+    def is_duplicate(self, shingles: set, packed: List[set]) -> bool:
+        for other in packed:
+            union = len(shingles | other)
+            if union and len(shingles & other) / union >= self.duplicate_threshold:
+                return True
+        return False
+
+    def pack(self, scored_documents: List[Tuple[Document, float]]) -> List[Document]:
+        """
+        Selects the documents to stuff into the prompt.
+
+        Args:
+            scored_documents: (document, distance) pairs, a lower distance is a better match.
+
+        Returns:
+            The packed documents, best first. The best document is truncated if it alone
+            exceeds the budget.
+        """
+        documents, packed_shingles = [], []
+        used_tokens = 0
+        separator_tokens = self.count_tokens(self.separator)
+        for document, _ in sorted(scored_documents, key=lambda pair: pair[1]):
+            shingles = self.shingles(document.page_content)
+            if self.is_duplicate(shingles, packed_shingles):
+                continue
+            tokens = self.count_tokens(document.page_content) + (separator_tokens if documents else 0)
+            if used_tokens + tokens > self.max_tokens:
+                if not documents:
+                    truncated = self.encoding.decode(self.encoding.encode(document.page_content)[:self.max_tokens])
+                    documents.append(Document(page_content=truncated, metadata=document.metadata))
+                break
+            documents.append(document)
+            packed_shingles.append(shingles)
+            used_tokens += tokens
+        return documents
+
+
+class TokenBudgetRetriever(BaseRetriever):
+    """
+    Retrieves `k` candidate chunks from a FAISS index and returns what `context_builder` packs of them.
+    The query is searched by the embedding in `query_embedding` if it was set for this query,
+    so a question is not embedded twice.
+    """
+
+    vectorstore: FAISS
+    context_builder: ContextBuilder
+    k: int = 6
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.known_embedding(query)
+        if embedding is not None:
+            return self.context_builder.pack(self.vectorstore.similarity_search_with_score_by_vector(embedding, k=self.k))
+        return self.context_builder.pack(self.vectorstore.similarity_search_with_score(query, k=self.k))
+
+    async def _aget_relevant_documents(self, query: str, *,
+                                       run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        embedding = self.known_embedding(query)
+        if embedding is not None:
+            return self.context_builder.pack(
+                await self.vectorstore.asimilarity_search_with_score_by_vector(embedding, k=self.k))
+        return self.context_builder.pack(await self.vectorstore.asimilarity_search_with_score(query, k=self.k))
+
+    @staticmethod
+    def known_embedding(query: str) -> Optional[List[float]]:
+        known = query_embedding.get()
+        return known[1] if known is not None and known[0] == query else None
+
+
+def context_budget(budgets: Dict[str, int], model_name: str, default: int) -> int:
+    """
+    Returns the context budget of a model: an exact match in `budgets`, else the longest
+    prefix match (e.g. 'gpt-4' for 'gpt-4-0613'), else `default`.
+    """
+    if model_name in budgets:
+        return budgets[model_name]
+    prefixes = [name for name in budgets if model_name.startswith(name)]
+    return budgets[max(prefixes, key=len)] if prefixes else default
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List
+
+from database_helper import Database
+from utils import split_text
+
+NOT_FOUND_MESSAGE = "Содержимое курса не найдено."
+EMPTY_MESSAGE = "Содержимое файла не найдено или пусто."
+ERROR_MESSAGE = "Ошибка при получении содержимого курса."
+
+
+class CourseContentCache:
+    """
+    Course content per language, split once into Telegram-sized pages.
+
+    Drive is asked for the document's revision at most once per `ttl` seconds, and the
+    document is only downloaded again when its revision changed. All Drive calls run in the
+    default executor, and concurrent requests for the same language share one fetch.
+    If Drive fails, the last pages fetched keep being served.
+
+    Attributes:
+        db (Database): Database used to reach Drive.
+        ttl (float): How long pages are served without checking the revision, in seconds.
+        page_size (int): Maximum length of a page.
+        entries (dict): Cached pages per language, with their revision and check time.
+    """
+
+    def __init__(self, db: Database, ttl: float = 600, page_size: int = 4096):
+        self.db = db
+        self.ttl = ttl
+        self.page_size = page_size
+        self.entries: Dict[str, dict] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    async def get_pages(self, language: str) -> List[str]:
+        """
+        Returns the course content for `language` as a list of pages.
+        """
+        entry = self.entries.get(language)
+        if entry and time.monotonic() - entry['checked_at'] < self.ttl:
+            return entry['pages']
+
+        async with self.locks.setdefault(language, asyncio.Lock()):
+            entry = self.entries.get(language)
+            if entry and time.monotonic() - entry['checked_at'] < self.ttl:
+                return entry['pages']
+
+            file_id = self.db.language_file_ids.get(language)
+            if not file_id:
+                logging.error(f"No course content file configured for language {language}")
+                return [NOT_FOUND_MESSAGE]
+
+            loop = asyncio.get_running_loop()
+            try:
+                revision = await loop.run_in_executor(None, self.db.get_file_revision, file_id)
+                if entry and revision == entry['revision']:
+                    entry['checked_at'] = time.monotonic()
+                    return entry['pages']
+
+                content = await loop.run_in_executor(None, self.db.load_document_text, file_id)
+            except Exception as e:
+                logging.exception(f"Failed to fetch the course content for language {language}: {e}")
+                return entry['pages'] if entry else [ERROR_MESSAGE]
+
+            pages = split_text(content or '', self.page_size) or [EMPTY_MESSAGE]
+            self.entries[language] = {'pages': pages, 'revision': revision, 'checked_at': time.monotonic()}
+            return pages
@@ -1,96 +1,522 @@
+import hashlib
 import json
+import os
+import tempfile
+import time
+from collections import Counter
 
-from langchain_community.document_loaders import GoogleDriveLoader
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
 import openai
-from langchain_community.vectorstores.faiss import FAISS
 import logging
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
+from pypdf import PdfReader
+from pypdf.errors import PyPdfError
+from chunking import Chunker
+from embedding_cache import CachedEmbeddings, EmbeddingStore
+from google_services import GoogleServices
+from language_detector import LanguageDetector
+from metrics import INDEX_REFRESH_SECONDS
+from vector_index import VectorIndex
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+MANIFEST_FILE = 'manifest.json'
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+GOOGLE_SHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+PDF_MIME_TYPE = 'application/pdf'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# Links to the indexed file types, as `source` of their chunks
+SOURCE_URLS = {
+    GOOGLE_DOC_MIME_TYPE: "https://docs.google.com/document/d/{}/edit",
+    GOOGLE_SHEET_MIME_TYPE: "https://docs.google.com/spreadsheets/d/{}/edit",
+    PDF_MIME_TYPE: "https://drive.google.com/file/d/{}/view",
+}
+
+
 class Database:
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, embeddings=None, services: GoogleServices = None):
         self.embeddings_folder_id = config['embeddings_folder_id']
+        self.index_path = config.get('index_path', 'faiss_index')
+        self.embedding_model = config.get('embedding_model', 'text-embedding-ada-002')
+        self.chunker = Chunker.from_config(config)
+        self.vector_index = VectorIndex.from_config(config)
         self.service_account = config['service_account']
-        with open(self.service_account, 'r') as file:
-            service_account_info = json.load(file)
-
-        self.creds = Credentials.from_service_account_info(service_account_info)
-        self.service = build('sheets', 'v4', credentials=self.creds)
+        services = services or GoogleServices(self.service_account)
+        self.creds = services.creds
+        self.service = services.sheets
+        self.drive_service = services.drive
+        self.google = services.client
         self.language_file_ids = {
             'ru': config['content_id_rus'],
             'uz': config['content_id_uz']
         }
+        self.languages = tuple(self.language_file_ids)
+        self.language_detector = LanguageDetector(config.get('model_ft', 'lid.176.bin'), labels=self.languages)
+        self.chunk_language_threshold = config.get('chunk_language_threshold', 0.9)
+        self.chunk_language_detector = LanguageDetector(config.get('model_ft', 'lid.176.bin'), labels=self.languages,
+                                                        threshold=self.chunk_language_threshold)
         self.range_name = "A2:A"
+        self.embeddings = embeddings
+        self.embedding_store = EmbeddingStore(config.get('embedding_cache_path', 'embedding_cache'),
+                                              self.embedding_model)
+        self.index = None
+        self.manifest = None
+        self.manifest_mtime = None
 
     def open_database(self):
+        """
+        Returns the FAISS index shards for the embeddings folder, one per course language,
+        doing as little work as possible.
+
+        Every chunk is tagged with its language (`language` in its metadata) and stored in that
+        language's shard, so a question is only searched against content in the user's language.
+
+        - If the folder is unchanged since the shards currently held in memory were built, they
+          are returned as is.
+        - If the shards saved in `index_path` match the folder (same document ids and revisions,
+          splitter, index and language settings and embedding model), they are loaded from disk.
+        - If only some documents were added, edited or removed, the saved shards are updated
+          incrementally: the old chunks of those documents are deleted and only their new
+          chunks are embedded.
+        - Otherwise (no saved index, or different settings) the shards are rebuilt from scratch.
+          So is an index type that can not delete chunks (HNSW) when chunks have to go, and an
+          IVF-PQ index with a shard that was built flat and now has enough vectors to be trained.
+
+        Saved shards are served memory-mapped read-only when the index `mmap` setting is on.
+
+        Returns:
+            A dict of FAISS indexes by language. Whenever the index changes, a new dict is returned
+            and the previous one is left untouched, so it can keep serving queries until the
+            caller swaps it out.
+        """
+        started = time.perf_counter()
+        result = 'error'
         try:
-            loader = GoogleDriveLoader(
-                folder_id=self.embeddings_folder_id,
-                service_account_key=self.service_account)
-
-            docs = loader.load()
-            texts = []
-            for doc in docs:
-                headers_to_split_on = [("#", "Header 1"), ("##", "Header 2")]
-                markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
-                markdown_splits = markdown_splitter.split_text(doc.page_content)
-
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=250, chunk_overlap=0, separators=[" ", ",", "\n"])
-                split_docs = text_splitter.split_documents(markdown_splits)
-                texts.extend(split_docs)
-
-            embeddings = OpenAIEmbeddings(openai_api_key=openai.api_key)
-            db = FAISS.from_documents(texts, embeddings)
-            db.as_retriever()
-            db.save_local('faiss_index')
-
-            return db
+            manifest = self.build_manifest(self.list_embedding_documents())
+            if self.index is not None and self.manifest['fingerprint'] == manifest['fingerprint']:
+                result = 'unchanged'
+                return self.index
+
+            embeddings = CachedEmbeddings(
+                self.embeddings or OpenAIEmbeddings(openai_api_key=openai.api_key, model=self.embedding_model),
+                self.embedding_store,
+            )
+            saved_manifest = self.read_manifest()
+            shards = None
+            unchanged = False
+            if saved_manifest and saved_manifest.get('settings') == manifest['settings']:
+                unchanged = saved_manifest['fingerprint'] == manifest['fingerprint']
+                shards = self.load_index(embeddings, saved_manifest, writable=not unchanged)
+
+            if shards is None:
+                logger.info("Индекс FAISS отсутствует или устарел, выполняется полная пересборка")
+                shards = self.build_index(manifest, embeddings)
+                result = 'rebuilt'
+            elif unchanged:
+                logger.info("Индекс FAISS загружен с диска: %s", self.index_path)
+                manifest = saved_manifest
+                result = 'loaded'
+            elif not self.update_index(shards, saved_manifest, manifest, embeddings):
+                logger.info("Индекс FAISS типа %s не поддерживает удаление чанков, выполняется полная пересборка",
+                            self.vector_index.index_type)
+                shards = self.build_index(manifest, embeddings)
+                result = 'rebuilt'
+            elif any(self.vector_index.needs_training(shard) for shard in shards.values()):
+                logger.info("Чанков стало достаточно для обучения индекса IVF-PQ, выполняется полная пересборка")
+                shards = self.build_index(manifest, embeddings)
+                result = 'rebuilt'
+            else:
+                result = 'updated'
+
+            if manifest is not saved_manifest:
+                self.save_index(shards, manifest)
+                if self.vector_index.mmap:
+                    shards = self.load_index(embeddings, manifest) or shards
+
+            self.index, self.manifest = shards, manifest
+            return shards
         except Exception as e:
             logger.exception("Произошла ошибка при обновлении базы данных: %s", e)
             raise
+        finally:
+            INDEX_REFRESH_SECONDS.labels(result).observe(time.perf_counter() - started)
+
+    def load_saved_index(self):
+        """
+        Returns the shards last saved in `index_path`, for processes that only serve the index
+        (the celery workers) while another process builds it with `open_database`.
 
-    def get_course_content(self, language='ru'):
-        file_id = self.language_file_ids.get(language)
-        if not file_id:
-            logger.error(f"Не найден ID файла для языка: {language}")
-            return "Содержимое курса не найдено."
+        Nothing is listed, embedded or written here. The shards are loaded again only when the
+        saved manifest changed, and a load that overlapped a save (the manifest changed or
+        disappeared meanwhile) is discarded in favour of the shards already held.
 
+        Raises:
+            FileNotFoundError: If no complete index has been saved yet.
+        """
+        manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
         try:
-            loader = GoogleDriveLoader(document_ids=[file_id], service_account_key=self.service_account)
-            docs = loader.load()
-            if docs:
-                return docs[0].page_content
+            mtime = os.stat(manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if self.index is not None and (mtime is None or mtime == self.manifest_mtime):
+            # Индекс не менялся или как раз сохраняется заново
+            return self.index
+
+        manifest = self.read_manifest()
+        if (manifest is not None and self.manifest is not None
+                and manifest['fingerprint'] == self.manifest['fingerprint']):
+            self.manifest_mtime = mtime
+            return self.index
+        shards = None
+        if manifest is not None:
+            embeddings = self.embeddings or OpenAIEmbeddings(openai_api_key=openai.api_key, model=self.embedding_model)
+            shards = self.load_index(embeddings, manifest)
+            saved_manifest = self.read_manifest()
+            if saved_manifest is None or saved_manifest['fingerprint'] != manifest['fingerprint']:
+                shards = None
+        if shards is None:
+            if self.index is not None:
+                return self.index
+            raise FileNotFoundError(f"No complete course index saved in {self.index_path} yet")
+
+        logger.info("Индекс FAISS загружен с диска: %s", self.index_path)
+        self.index, self.manifest, self.manifest_mtime = shards, manifest, mtime
+        return shards
+
+    def build_index(self, manifest, embeddings):
+        """
+        Builds the shards from scratch for every document listed in `manifest`.
+        """
+        chunks_by_language = {}
+        for doc_id, doc in self.load_documents(manifest['documents']):
+            for language, (chunk_ids, chunks) in self.split_document(doc_id, doc, manifest['documents'][doc_id]).items():
+                ids, texts = chunks_by_language.setdefault(language, ([], []))
+                ids.extend(chunk_ids)
+                texts.extend(chunks)
+
+        return {language: self.vector_index.build(texts, embeddings, ids)
+                for language, (ids, texts) in chunks_by_language.items()}
+
+    def update_index(self, shards, saved_manifest, manifest, embeddings):
+        """
+        Brings `shards`, built for `saved_manifest`, up to date with `manifest` in place.
+
+        Documents whose revision did not change keep their chunks. Changed documents are
+        downloaded and, if their content hash differs, their chunks are replaced.
+        Documents that left the folder have their chunks deleted.
+
+        Returns:
+            False if chunks had to be deleted but the index type does not support it, True otherwise.
+        """
+        saved_documents = saved_manifest['documents']
+        changed_ids = []
+        for doc_id, entry in manifest['documents'].items():
+            saved_entry = saved_documents.get(doc_id)
+            if saved_entry and self.same_revision(saved_entry, entry):
+                entry['content_hash'] = saved_entry['content_hash']
+                entry['chunk_ids'] = saved_entry['chunk_ids']
             else:
-                return "Содержимое файла не найдено или пусто."
-        except Exception as e:
-            logger.exception(f"Произошла ошибка при загрузке содержимого курса для языка {language}: {e}")
-            return "Ошибка при получении содержимого курса."
+                changed_ids.append(doc_id)
+
+        stale_chunk_ids = {}
+        for doc_id, saved_entry in saved_documents.items():
+            if doc_id not in manifest['documents']:
+                for language, chunk_ids in saved_entry['chunk_ids'].items():
+                    stale_chunk_ids.setdefault(language, []).extend(chunk_ids)
+
+        new_chunks = {}
+        for doc_id, doc in self.load_documents({doc_id: manifest['documents'][doc_id] for doc_id in changed_ids}):
+            entry = manifest['documents'][doc_id]
+            saved_entry = saved_documents.get(doc_id)
+            if saved_entry and saved_entry['content_hash'] == self.content_hash(doc.page_content):
+                entry['content_hash'] = saved_entry['content_hash']
+                entry['chunk_ids'] = saved_entry['chunk_ids']
+                continue
+            if saved_entry:
+                for language, chunk_ids in saved_entry['chunk_ids'].items():
+                    stale_chunk_ids.setdefault(language, []).extend(chunk_ids)
+            for language, (chunk_ids, chunks) in self.split_document(doc_id, doc, entry).items():
+                ids, texts = new_chunks.setdefault(language, ([], []))
+                ids.extend(chunk_ids)
+                texts.extend(chunks)
+
+        if stale_chunk_ids and not self.vector_index.supports_delete:
+            return False
+        for language, chunk_ids in stale_chunk_ids.items():
+            shards[language].delete(chunk_ids)
+        for language, (ids, texts) in new_chunks.items():
+            if language in shards:
+                shards[language].add_documents(texts, ids=ids)
+            else:
+                shards[language] = self.vector_index.build(texts, embeddings, ids)
+
+        logger.info("Индекс FAISS обновлён: изменено документов %s, удалено чанков %s, добавлено чанков %s",
+                    len(changed_ids), sum(map(len, stale_chunk_ids.values())),
+                    sum(len(ids) for ids, _ in new_chunks.values()))
+        return True
+
+    def load_documents(self, entries):
+        """
+        Downloads the documents with the given manifest entries (by id) as plain text, several at
+        a time on the Google API pool, yielding (document id, document) pairs in order.
+        """
+        document_ids = list(entries)
+        mime_types = [entries[doc_id].get('mime_type', GOOGLE_DOC_MIME_TYPE) for doc_id in document_ids]
+        texts = self.google.executor.map(self.load_text, document_ids, mime_types)
+        for doc_id, mime_type, text in zip(document_ids, mime_types, texts):
+            yield doc_id, Document(page_content=text, metadata={'source': SOURCE_URLS[mime_type].format(doc_id)})
+
+    def load_text(self, file_id, mime_type=GOOGLE_DOC_MIME_TYPE):
+        """
+        Returns the plain text of a Google Doc, a Google Sheet or a PDF file. Errors are raised.
+        """
+        if mime_type == GOOGLE_SHEET_MIME_TYPE:
+            return self.export_sheet_text(file_id)
+        if mime_type == PDF_MIME_TYPE:
+            return self.extract_pdf_text(file_id)
+        return self.export_text(file_id)
 
-    def list_files_in_folder(self, service, checklists_folder_id):
+    def export_text(self, file_id):
+        request = self.drive_service.files().export_media(fileId=file_id, mimeType='text/plain')
+        return self.google.download_sync(request).getvalue().decode('utf-8-sig')
+
+    def export_sheet_text(self, file_id):
+        """
+        Returns every tab of a Google Sheet as text: each row as "header: value" lines, rows
+        separated by blank lines.
+        """
+        spreadsheet = self.google.execute_sync(self.service.spreadsheets().get(
+            spreadsheetId=file_id, fields='sheets.properties.title'))
+        rows = []
+        for sheet in spreadsheet.get('sheets', []):
+            values = self.google.execute_sync(self.service.spreadsheets().values().get(
+                spreadsheetId=file_id, range=sheet['properties']['title'])).get('values', [])
+            if not values:
+                continue
+            header = values[0]
+            for row in values[1:]:
+                rows.append('\n'.join(f"{header[i].strip() if i < len(header) else ''}: {value.strip()}"
+                                      for i, value in enumerate(row)))
+        return '\n\n'.join(rows)
+
+    def extract_pdf_text(self, file_id):
+        """
+        Returns the text of the pages of a PDF file, or an empty string if it can not be parsed.
+        """
+        content = self.google.download_sync(self.drive_service.files().get_media(fileId=file_id))
+        try:
+            return '\n\n'.join(page.extract_text() for page in PdfReader(content).pages)
+        except PyPdfError as e:
+            logger.warning("Не удалось извлечь текст из PDF %s: %s", file_id, e)
+            return ''
+
+    def split_document(self, doc_id, doc, entry):
+        """
+        Splits a document into chunks, tags each chunk with its language and records the content
+        hash and the chunk ids by language in the document's manifest entry.
+
+        A chunk gets the document's prevailing language (by characters of the chunks detected in
+        each language), unless its own language is detected with a confidence of at least
+        `chunk_language_threshold`. So a Russian chunk that is mostly Latin-script jargon stays
+        in the Russian shard.
+
+        Returns:
+            A dict of (chunk ids, chunks) by language.
+        """
+        chunks = self.chunker.split(doc.page_content)
+        counts = Counter()
+        for chunk in chunks:
+            language = self.language_detector.detect(chunk.page_content)
+            if language:
+                counts[language] += len(chunk.page_content)
+        document_language = counts.most_common(1)[0][0] if counts else self.languages[0]
+
+        chunks_by_language = {}
+        for number, chunk in enumerate(chunks):
+            language = self.chunk_language_detector.detect(chunk.page_content) or document_language
+            chunk.metadata['doc_id'] = doc_id
+            chunk.metadata['language'] = language
+            chunk_ids, language_chunks = chunks_by_language.setdefault(language, ([], []))
+            chunk_ids.append(f"{doc_id}:{number}")
+            language_chunks.append(chunk)
+
+        entry['content_hash'] = self.content_hash(doc.page_content)
+        entry['chunk_ids'] = {language: chunk_ids for language, (chunk_ids, _) in chunks_by_language.items()}
+        return chunks_by_language
+
+    @staticmethod
+    def content_hash(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def same_revision(saved_entry, entry):
+        return (saved_entry.get('modified_time') == entry.get('modified_time')
+                and saved_entry.get('version') == entry.get('version'))
+
+    def list_embedding_documents(self):
+        """
+        Lists the Google Docs, Google Sheets and PDF files in the embeddings folder together with
+        their revisions. Files of other types are logged and skipped.
+        """
+        documents = []
+        page_token = None
+        while True:
+            results = self.google.execute_sync(self.drive_service.files().list(
+                q=f"'{self.embeddings_folder_id}' in parents and trashed=false "
+                  f"and mimeType!='{FOLDER_MIME_TYPE}'",
+                pageSize=1000,
+                pageToken=page_token,
+                fields="nextPageToken, files(id, name, mimeType, modifiedTime, version)"
+            ))
+            for file in results.get('files', []):
+                if file.get('mimeType', GOOGLE_DOC_MIME_TYPE) in SOURCE_URLS:
+                    documents.append(file)
+                else:
+                    logger.warning("Файл %s (%s) пропущен: индексируются только Google Docs, Google Sheets и PDF",
+                                   file.get('name'), file.get('mimeType'))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return documents
+
+    def build_manifest(self, documents):
+        """
+        Builds the manifest describing an index built from `documents` with the current settings.
+
+        The fingerprint only covers the settings and the document revisions, so it can be
+        computed from a folder listing without downloading anything.
+        """
+        manifest = {
+            'settings': {
+                'embedding_model': self.embedding_model,
+                'splitter': self.chunker.settings(),
+                'index': self.vector_index.settings(),
+                'languages': list(self.languages),
+                'chunk_language_threshold': self.chunk_language_threshold,
+            },
+            'documents': {
+                document['id']: {
+                    'name': document.get('name'),
+                    'mime_type': document.get('mimeType', GOOGLE_DOC_MIME_TYPE),
+                    'modified_time': document.get('modifiedTime'),
+                    'version': document.get('version'),
+                }
+                for document in documents
+            },
+        }
+        manifest['fingerprint'] = self.manifest_fingerprint(manifest)
+        return manifest
+
+    @staticmethod
+    def manifest_fingerprint(manifest):
+        payload = {
+            'settings': manifest['settings'],
+            'documents': {
+                doc_id: [entry.get('modified_time'), entry.get('version')]
+                for doc_id, entry in manifest['documents'].items()
+            },
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def read_manifest(self):
+        """
+        Returns the manifest of the saved index, or None if there is no usable one.
+        """
+        manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
         try:
-            results = service.files().list(
-                q=f"'{checklists_folder_id}' in parents and trashed=false",
-                pageSize=100,
-                fields="nextPageToken, files(id, name)"
-            ).execute()
-            return results.get('files', [])
+            with open(manifest_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Не удалось прочитать манифест индекса %s: %s", manifest_path, e)
+            return None
+
+    def load_index(self, embeddings, manifest, writable=False):
+        """
+        Loads a fresh copy of the shards listed in a saved manifest, or returns None if they cannot be loaded.
+        Pass `writable` for copies that are going to be updated, rather than memory-mapped.
+        """
+        try:
+            return {language: self.vector_index.load(os.path.join(self.index_path, language), embeddings,
+                                                     writable=writable)
+                    for language in manifest['shards']}
         except Exception as e:
-            logger.exception(f"An error occurred while listing files in folder: {e}")
-            return []
+            logger.warning("Не удалось загрузить индекс FAISS из %s: %s", self.index_path, e)
+            return None
+
+    def save_index(self, shards, manifest):
+        """
+        Saves the shards, one directory per language, and then their manifest, so an interrupted
+        save never looks up to date.
+
+        The index files are written next to the old ones and renamed over them, so an index
+        that is still memory-mapped from the old files keeps reading valid data.
+        """
+        os.makedirs(self.index_path, exist_ok=True)
+        manifest_path = os.path.join(self.index_path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        for language, db in shards.items():
+            shard_path = os.path.join(self.index_path, language)
+            os.makedirs(shard_path, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=shard_path) as tmp_dir:
+                db.save_local(tmp_dir)
+                for name in os.listdir(tmp_dir):
+                    os.replace(os.path.join(tmp_dir, name), os.path.join(shard_path, name))
+
+        manifest['shards'] = sorted(shards)
+        # Тип индекса каждого шарда: IVF-PQ строится плоским, пока векторов мало для обучения
+        manifest['shard_types'] = {language: self.vector_index.built_type(db.index) for language, db in shards.items()}
+        tmp_path = manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    def load_document_text(self, file_id):
+        """
+        Returns the plain text of a Google Doc, or None if it is empty. Errors are raised.
+        """
+        return self.export_text(file_id) or None
+
+    def get_file_revision(self, file_id):
+        """
+        Returns the Drive modification time of a file, a cheap way to tell whether it changed.
+        """
+        request = self.drive_service.files().get(fileId=file_id, fields='modifiedTime')
+        return self.google.execute_sync(request).get('modifiedTime')
+
+    async def alist_files_in_folder(self, service, checklists_folder_id):
+        """
+        Lists every file in a folder, following all result pages, without blocking the event loop.
+        Errors are raised.
+        """
+        files = []
+        page_token = None
+        while True:
+            results = await self.google.execute(self.folder_request(service, checklists_folder_id, page_token))
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return files
+
+    def folder_request(self, service, folder_id, page_token=None):
+        return service.files().list(
+            q=f"'{folder_id}' in parents and trashed=false",
+            pageSize=1000,
+            pageToken=page_token,
+            fields="nextPageToken, files(id, name, modifiedTime)"
+        )
 
     def get_usernames(self, file_id_users):
         try:
             # Вызов API для чтения данных из таблицы
-            result = self.service.spreadsheets().values().get(
+            result = self.google.execute_sync(self.service.spreadsheets().values().get(
                 spreadsheetId=file_id_users,
                 range=self.range_name
-            ).execute()
+            ))
             rows = result.get('values', [])
 
             if not rows:
@@ -101,5 +527,5 @@ class Database:
 
         except Exception as e:
             logger.exception(f"Произошла ошибка при загрузке списка пользователей: {e}")
-            return []
+            raise
 
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, List, Optional
+
+from googleapiclient.errors import HttpError
+
+from database_helper import Database
+
+
+class FolderListingCache:
+    """
+    Keeps the listings of Google Drive folders in memory and on disk, and keeps them current
+    through the Drive changes feed instead of listing the folders again.
+
+    A folder is listed in full (all result pages) the first time it is requested. After that,
+    `sync` fetches only the changes made since the stored page token and applies them to every
+    cached folder, so a broadcast costs one delta request instead of a listing per folder.
+    If the page token is rejected, the cache is dropped and folders are listed again.
+
+    Attributes:
+        db (Database): Provides the Drive service and the API client.
+        path (str): JSON file the listings and the page token are stored in, None to keep them in memory only.
+        page_token (str): Drive changes page token the listings are current as of.
+        folders (dict): Folder id -> list of files (id, name, modifiedTime).
+    """
+
+    CHANGE_FIELDS = "nextPageToken, newStartPageToken, " \
+                    "changes(fileId, removed, file(id, name, modifiedTime, parents, trashed))"
+
+    def __init__(self, db: Database, path: Optional[str]):
+        self.db = db
+        self.path = path
+        self.page_token: Optional[str] = None
+        self.folders: Dict[str, List[dict]] = {}
+        self.lock = asyncio.Lock()
+        if path is None:
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            self.page_token = state['page_token']
+            self.folders = state['folders']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable folder listing cache {path}: {e}")
+
+    async def list(self, folder_id: str) -> List[dict]:
+        """
+        Returns the files of a folder, listing it in full only if it is not cached yet.
+        """
+        async with self.lock:
+            if folder_id not in self.folders:
+                if self.page_token is None:
+                    # Taken before listing, so changes made while listing are not missed
+                    self.page_token = await self.start_page_token()
+                self.folders[folder_id] = await self.db.alist_files_in_folder(self.db.drive_service, folder_id)
+                logging.info(f"Listed Drive folder {folder_id}: {len(self.folders[folder_id])} files")
+                self.save()
+            return list(self.folders[folder_id])
+
+    async def sync(self) -> int:
+        """
+        Applies the Drive changes made since the last sync to the cached folders.
+
+        Returns:
+            The number of changes read.
+        """
+        async with self.lock:
+            if self.page_token is None or not self.folders:
+                return 0
+            page_token = self.page_token
+            count = 0
+            try:
+                while True:
+                    results = await self.db.google.execute(self.db.drive_service.changes().list(
+                        pageToken=page_token, pageSize=1000, spaces='drive', fields=self.CHANGE_FIELDS))
+                    for change in results.get('changes', []):
+                        self.apply(change)
+                    count += len(results.get('changes', []))
+                    if 'newStartPageToken' in results:
+                        self.page_token = results['newStartPageToken']
+                        break
+                    page_token = results['nextPageToken']
+            except HttpError as e:
+                if e.resp.status in (400, 404, 410):
+                    logging.warning(f"Drive changes page token was rejected ({e.resp.status}), "
+                                    f"folders will be listed again")
+                    self.page_token = None
+                    self.folders = {}
+                    self.save()
+                    return count
+                raise
+            if count:
+                self.save()
+            return count
+
+    def apply(self, change: dict) -> None:
+        file_id = change['fileId']
+        for files in self.folders.values():
+            files[:] = [file for file in files if file['id'] != file_id]
+        file = change.get('file')
+        if change.get('removed') or not file or file.get('trashed'):
+            return
+        entry = {'id': file['id'], 'name': file['name'], 'modifiedTime': file.get('modifiedTime')}
+        for parent in file.get('parents', []):
+            if parent in self.folders:
+                self.folders[parent].append(entry)
+
+    async def start_page_token(self) -> str:
+        result = await self.db.google.execute(self.db.drive_service.changes().getStartPageToken())
+        return result['startPageToken']
+
+    def snapshot(self) -> dict:
+        return {'page_token': self.page_token, 'folders': self.folders}
+
+    def restore(self, state: dict) -> None:
+        """
+        Replaces the listings and the page token with a `snapshot`, e.g. the one a celery worker
+        returned after a broadcast.
+        """
+        self.page_token = state['page_token']
+        self.folders = state['folders']
+        self.save()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(tmp_path, self.path)
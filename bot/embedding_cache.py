@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+KEYS_FILE = 'keys.txt'
+VECTORS_FILE = 'vectors.f32'
+META_FILE = 'meta.json'
+
+
+class EmbeddingStore:
+    """
+    Append-only on-disk store of embedding vectors for one embedding model, keyed by the
+    SHA-256 of the embedded text.
+
+    Vectors are stored as raw little-endian float32 rows in `vectors.f32`, the key of
+    row i is line i of `keys.txt` and the vector length is recorded in `meta.json`. Lookups read all requested rows in one memory-mapped
+    batch. Rows are written before their keys, so an interrupted write at worst leaves
+    rows that are ignored on the next open. A store whose `meta.json` can not be read is
+    emptied, and the vectors are embedded again.
+
+    Attributes:
+        path (str): Directory holding the files of this model.
+        rows (dict): Row number of every stored key.
+        dimension (int): Length of the stored vectors, None while the store is empty.
+    """
+
+    def __init__(self, root: str, model: str):
+        self.path = os.path.join(root, re.sub(r'[^\w.-]', '_', model))
+        self.rows: Dict[str, int] = {}
+        self.dimension = None
+        self.lock = threading.Lock()
+        self.opened = False
+
+    def open(self) -> None:
+        if self.opened:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        keys_path = os.path.join(self.path, KEYS_FILE)
+        vectors_path = os.path.join(self.path, VECTORS_FILE)
+        meta_path = os.path.join(self.path, META_FILE)
+        keys = []
+        if os.path.exists(meta_path) and os.path.exists(vectors_path):
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as file:
+                    self.dimension = int(json.load(file)['dimension'])
+                if self.dimension <= 0:
+                    raise ValueError(f"invalid dimension {self.dimension}")
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Embedding cache {self.path} is unreadable, starting it over: {e}")
+                self.reset()
+                self.opened = True
+                return
+            if os.path.exists(keys_path):
+                with open(keys_path, 'r', encoding='ascii') as file:
+                    keys = [line.strip() for line in file if line.strip()]
+            available_rows = os.path.getsize(vectors_path) // 4 // self.dimension
+            keys = keys[:available_rows]
+            self.truncate(keys)
+
+        self.rows = {key: row for row, key in enumerate(keys)}
+        self.opened = True
+        logger.info(f"Embedding cache {self.path}: {len(self.rows)} vectors")
+
+    def reset(self) -> None:
+        """
+        Empties the store.
+        """
+        for name in (META_FILE, VECTORS_FILE, KEYS_FILE):
+            path = os.path.join(self.path, name)
+            if os.path.exists(path):
+                os.remove(path)
+        self.rows = {}
+        self.dimension = None
+
+    def truncate(self, keys: List[str]) -> None:
+        """
+        Rewrites the store to hold exactly `keys`, dropping rows or keys left behind by an
+        interrupted write.
+        """
+        with open(os.path.join(self.path, VECTORS_FILE), 'r+b') as file:
+            file.truncate(len(keys) * self.dimension * 4)
+        with open(os.path.join(self.path, KEYS_FILE), 'w', encoding='ascii') as file:
+            file.writelines(key + '\n' for key in keys)
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Returns the stored vectors for the keys that are present.
+        """
+        with self.lock:
+            self.open()
+            found = [key for key in dict.fromkeys(keys) if key in self.rows]
+            if not found:
+                return {}
+            vectors = np.memmap(os.path.join(self.path, VECTORS_FILE), dtype='<f4', mode='r',
+                                shape=(len(self.rows), self.dimension))
+            batch = np.array(vectors[[self.rows[key] for key in found]])
+            return dict(zip(found, batch))
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]) -> None:
+        """
+        Appends vectors for keys that are not stored yet.
+        """
+        with self.lock:
+            self.open()
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+
+            batch = np.asarray(list(new.values()), dtype='<f4')
+            if self.dimension is None:
+                self.dimension = batch.shape[1]
+                meta_path = os.path.join(self.path, META_FILE)
+                with open(meta_path + '.tmp', 'w', encoding='utf-8') as file:
+                    json.dump({'dimension': self.dimension}, file)
+                os.replace(meta_path + '.tmp', meta_path)
+            with open(os.path.join(self.path, VECTORS_FILE), 'ab') as file:
+                file.write(batch.tobytes())
+            with open(os.path.join(self.path, KEYS_FILE), 'a', encoding='ascii') as file:
+                file.writelines(key + '\n' for key in new)
+            for key in new:
+                self.rows[key] = len(self.rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model so that document texts already embedded once are read from an
+    `EmbeddingStore` instead of being sent to the API again.
+
+    Only unseen texts are embedded, all in a single call to the wrapped model, which splits
+    them into requests of its own maximum batch size. Queries are not cached.
+    """
+
+    def __init__(self, embeddings: Embeddings, store: EmbeddingStore):
+        self.embeddings = embeddings
+        self.store = store
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.key(text) for text in texts]
+        vectors = self.store.get_many(keys)
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            embedded = self.embeddings.embed_documents(list(missing.values()))
+            self.store.put_many(list(missing), embedded)
+            vectors.update(zip(missing, embedded))
+
+        logger.info(f"Embedded {len(missing)} of {len(texts)} chunks, {len(texts) - len(missing)} read from cache")
+        return [list(map(float, vectors[key])) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.embeddings.aembed_query(text)
@@ -1,40 +1,28 @@
 import io
+import json
+import logging
+import os
 import re
-from typing import Dict
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from typing import Dict, Optional
+
+from google_services import GoogleApiClient
 
 
 class FileSender:
     """
     A utility class to handle file downloads and content extraction from Google Drive.
 
+    Attributes:
+        google (GoogleApiClient): Runs the downloads off the event loop, several at a time.
+
     Methods:
-        oauth: Establishes a connection to the Google Drive API.
         download_file: Downloads a file from Google Drive.
         extract_sections: Extracts sections from a text based on a specific pattern.
     """
 
-    def oauth(self, scopes: list, service_account_file: str):
-        """
-        Authenticate and create a Google Drive API service instance.
+    def __init__(self, google: GoogleApiClient):
+        self.google = google
 
-        Args:
-            scopes (list): A list of strings representing the scopes (permissions) the service needs.
-            service_account_file (str): Path to the service account credentials file.
-
-        Returns:
-            A Google Drive API service instance.
-        """
-
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_file, scopes=scopes)
-
-        service = build('drive', 'v3', credentials=credentials)
-
-        return service
-    
     async def download_file(self, service, file_id: str, is_google_doc: bool = False) -> io.BytesIO:
         """
         Asynchronously downloads a file from Google Drive and returns its content.
@@ -53,14 +41,7 @@ class FileSender:
         else:
             request = service.files().get_media(fileId=file_id)
 
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
-
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-
-        fh.seek(0)
+        fh = await self.google.download(request)
 
         if is_google_doc:
             text_content = fh.read().decode('utf-8')
@@ -81,4 +62,62 @@ class FileSender:
 
         pattern = r"(\d+)\)(.+?)(?=\d+\)|$)"
         sections = re.findall(pattern, text, re.DOTALL)
-        return {section[0]: section[1].strip() for section in sections}
\ No newline at end of file
+        return {section[0]: section[1].strip() for section in sections}
+
+class FileIdCache:
+    """
+    Persistent map from Google Drive files to the Telegram `file_id` they got when first uploaded,
+    so a file is uploaded once and then sent to everyone by `file_id`.
+
+    An entry is only valid for the Drive revision it was uploaded from, so replacing a file
+    on Drive triggers a new upload.
+
+    Attributes:
+        path (str): JSON file the map is stored in, None to keep it in memory only.
+        entries (dict): Drive file id -> {'modified_time': ..., 'file_id': ...}.
+    """
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries: Dict[str, Dict[str, str]] = {}
+        if path is None:
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable file_id cache {path}: {e}")
+
+    def get(self, file: dict) -> Optional[str]:
+        """
+        Returns the Telegram file_id of a Drive file, or None if it was not uploaded yet.
+        """
+        entry = self.entries.get(file['id'])
+        if entry and entry.get('modified_time') == file.get('modifiedTime'):
+            return entry['file_id']
+        return None
+
+    def set(self, file: dict, file_id: str) -> None:
+        self.entries[file['id']] = {'modified_time': file.get('modifiedTime'), 'file_id': file_id}
+        self.save()
+
+    def discard(self, file: dict) -> None:
+        if self.entries.pop(file['id'], None) is not None:
+            self.save()
+
+    def replace(self, entries: Dict[str, Dict[str, str]]) -> None:
+        """
+        Replaces every entry, e.g. with the ones a celery worker returned after a broadcast.
+        """
+        self.entries = entries
+        self.save()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(self.entries, file, indent=2)
+        os.replace(tmp_path, self.path)
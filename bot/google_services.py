@@ -0,0 +1,98 @@
+import asyncio
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import httplib2
+from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaIoBaseDownload
+
+from metrics import DRIVE_DOWNLOAD_BYTES, DRIVE_DOWNLOAD_SECONDS
+
+
+class GoogleServices:
+    """
+    Service account credentials and the Google API clients built from them, created once and
+    shared by every component of the bot.
+
+    Attributes:
+        service_account_file (str): Path to the service account credentials file.
+        creds (Credentials): Service account credentials.
+        sheets (Resource): Google Sheets API service.
+        drive (Resource): Google Drive API service.
+        client (GoogleApiClient): Executes requests built with `sheets` and `drive`.
+    """
+
+    SCOPES = [
+        'https://www.googleapis.com/auth/drive',
+        'https://www.googleapis.com/auth/spreadsheets.readonly',
+    ]
+
+    def __init__(self, service_account_file: str, max_workers: int = 8, chunk_size: int = 10 * 1024 * 1024):
+        self.service_account_file = service_account_file
+        self.creds = Credentials.from_service_account_file(service_account_file, scopes=self.SCOPES)
+        self.sheets = build('sheets', 'v4', credentials=self.creds)
+        self.drive = build('drive', 'v3', credentials=self.creds)
+        self.client = GoogleApiClient(self.creds, max_workers=max_workers, chunk_size=chunk_size)
+
+
+class GoogleApiClient:
+    """
+    Executes Google API requests on a dedicated, bounded thread pool.
+
+    The API client libraries are blocking and their HTTP connections are not thread-safe, so
+    every worker thread gets its own authorized connection, kept alive and reused across
+    requests. Async callers await `execute`/`download` without blocking the event loop,
+    code that already runs in a worker thread can use the `*_sync` variants.
+
+    Attributes:
+        creds (Credentials): Credentials used to authorize the connections.
+        chunk_size (int): Size of the chunks files are downloaded in, in bytes.
+        executor (ThreadPoolExecutor): Pool the requests run on.
+    """
+
+    def __init__(self, creds: Credentials, max_workers: int = 8, chunk_size: int = 10 * 1024 * 1024):
+        self.creds = creds
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='google-api')
+        self.local = threading.local()
+
+    def http(self) -> AuthorizedHttp:
+        """
+        Returns the authorized connection of the calling thread.
+        """
+        if not hasattr(self.local, 'http'):
+            self.local.http = AuthorizedHttp(self.creds, http=httplib2.Http(timeout=60))
+        return self.local.http
+
+    def execute_sync(self, request) -> Any:
+        return request.execute(http=self.http(), num_retries=2)
+
+    def download_sync(self, request) -> io.BytesIO:
+        started = time.perf_counter()
+        request.http = self.http()
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request, chunksize=self.chunk_size)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=2)
+        DRIVE_DOWNLOAD_SECONDS.observe(time.perf_counter() - started)
+        DRIVE_DOWNLOAD_BYTES.inc(fh.tell())
+        fh.seek(0)
+        return fh
+
+    async def execute(self, request) -> Any:
+        """
+        Executes an API request, e.g. `drive.files().list(...)`, and returns its result.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.execute_sync, request)
+
+    async def download(self, request) -> io.BytesIO:
+        """
+        Downloads the media of a `get_media`/`export_media` request.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.download_sync, request)
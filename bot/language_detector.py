@@ -0,0 +1,102 @@
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+import fasttext
+
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+|@\w+')
+NOISE_PATTERN = re.compile(r'[\d_]+|[^\w\s\'‘’ʻʼ-]')
+SPACE_PATTERN = re.compile(r'\s+')
+
+# Loaded models by path, shared by every detector using the same model
+MODELS = {}
+MODELS_LOCK = threading.Lock()
+
+
+class LanguageDetector:
+    """
+    fastText language identification with lazy model loading and an LRU cache of predictions.
+
+    Any fastText language-id model can be used, e.g. the full `lid.176.bin` or the much smaller
+    compressed `lid.176.ftz`. The model is loaded on first use, once per process for all detectors
+    using the same file. Input is normalized (links,
+    mentions, digits and punctuation removed, whitespace collapsed) and truncated before
+    prediction, which also makes repeated questions hit the cache.
+
+    With `labels` set, only those languages are compared (e.g. 'ru' vs 'uz'): the best of them
+    wins if its share of their combined probability reaches `threshold`, otherwise the result is
+    unknown. Without `labels`, the top language is returned if its probability reaches `threshold`.
+
+    Attributes:
+        model_path (str): Path to the fastText model.
+        labels (tuple): Languages to choose from, empty to consider every language of the model.
+        threshold (float): Minimum confidence for a prediction.
+        max_chars (int): Input is truncated to this many characters.
+        cache_size (int): Number of predictions kept in the LRU cache.
+    """
+
+    def __init__(self, model_path: str = 'lid.176.bin', labels: Sequence[str] = (), threshold: float = 0.0,
+                 max_chars: int = 200, cache_size: int = 4096):
+        self.model_path = model_path
+        self.labels = tuple(labels)
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self.cache_size = cache_size
+        self.model = None
+        self.cache: OrderedDict = OrderedDict()
+
+    def load(self) -> None:
+        """
+        Loads the model if it is not loaded yet. Blocking, call it off the event loop to warm up.
+        """
+        if self.model is not None:
+            return
+        with MODELS_LOCK:
+            if self.model_path not in MODELS:
+                MODELS[self.model_path] = fasttext.load_model(self.model_path)
+                logging.info(f"Language identification model loaded from {self.model_path}")
+            self.model = MODELS[self.model_path]
+
+    def normalize(self, text: str) -> str:
+        text = URL_PATTERN.sub(' ', text)
+        text = NOISE_PATTERN.sub(' ', text)
+        text = SPACE_PATTERN.sub(' ', text).strip().lower()
+        return text[:self.max_chars]
+
+    def detect(self, text: str) -> Optional[str]:
+        """
+        Returns the language code of `text` (e.g. 'ru'), or None if it cannot be told with enough confidence.
+        """
+        text = self.normalize(text)
+        if not text:
+            return None
+
+        if text in self.cache:
+            self.cache.move_to_end(text)
+            return self.cache[text]
+
+        language = self.predict(text)
+        self.cache[text] = language
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return language
+
+    def predict(self, text: str) -> Optional[str]:
+        self.load()
+        if not self.labels:
+            labels, probabilities = self.model.predict(text, k=1)
+            if not labels or probabilities[0] < self.threshold:
+                return None
+            return labels[0].replace('__label__', '')
+
+        # k=-1 returns the probability of every language of the model
+        labels, probabilities = self.model.predict(text, k=-1)
+        scores = {label.replace('__label__', ''): probability for label, probability in zip(labels, probabilities)}
+        scores = {language: scores.get(language, 0.0) for language in self.labels}
+        total = sum(scores.values())
+        language = max(scores, key=scores.get)
+        if total <= 0 or scores[language] / total < self.threshold:
+            return None
+        return language
@@ -1,56 +1,155 @@
+import json
 import logging
 import os
 from dotenv import load_dotenv
 
+import celery_app
+from google_services import GoogleServices
+from metrics import start_metrics_server
 from openai_helper import OpenAI
+from startup import StartupOrchestrator
 from telegram_bot import ChatGPTTelegramBot
 
 
-def main():
-    # Read .env file
-    load_dotenv()
-
-    # Setup logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
-
-    # Setup configurations
+def load_config():
+    """
+    Reads the OpenAI and Telegram configurations from the environment.
+    """
     model = os.environ.get('OPENAI_MODEL')
+    stream_answers = os.environ.get('STREAM_ANSWERS', 'false').lower() == 'true'
     openai_config = {
         'embeddings_folder_id': os.environ['EMBEDDINGS_FOLDER_ID'],
         'api_key': os.environ['OPENAI_API_KEY'],
+        'api_base': os.environ.get('OPENAI_BASE_URL'),
         'temperature': float(os.environ.get('TEMPERATURE', 0)),
         'model': model,
         'service_account': os.environ['SERVICE_ACCOUNT_FILE'],
         'content_id_rus': os.environ['CONTENT_FOLDER_ID_RU'],
         'content_id_uz': os.environ['CONTENT_FOLDER_ID_UZ'],
+        'index_path': os.environ.get('FAISS_INDEX_PATH', 'faiss_index'),
+        'embedding_model': os.environ.get('EMBEDDING_MODEL', 'text-embedding-ada-002'),
+        'embedding_cache_path': os.environ.get('EMBEDDING_CACHE_PATH', 'embedding_cache'),
+        'chunk_size': int(os.environ.get('CHUNK_SIZE', 250)),
+        'chunk_overlap': int(os.environ.get('CHUNK_OVERLAP', 0)),
+        'chunk_separators': json.loads(os.environ.get('CHUNK_SEPARATORS', '[" ", ",", "\\n"]')),
+        'chunk_header_levels': int(os.environ.get('CHUNK_HEADER_LEVELS', 2)),
+        'model_ft': os.environ.get('MODEL_FT', 'lid.176.bin'),
+        'chunk_language_threshold': float(os.environ.get('CHUNK_LANGUAGE_THRESHOLD', 0.9)),
+        'index_type': os.environ.get('FAISS_INDEX_TYPE', 'flat'),
+        'hnsw_m': int(os.environ.get('FAISS_HNSW_M', 32)),
+        'hnsw_ef_construction': int(os.environ.get('FAISS_HNSW_EF_CONSTRUCTION', 200)),
+        'hnsw_ef_search': int(os.environ.get('FAISS_HNSW_EF_SEARCH', 64)),
+        'ivf_nlist': int(os.environ.get('FAISS_IVF_NLIST', 256)),
+        'pq_m': int(os.environ.get('FAISS_PQ_M', 64)),
+        'pq_nbits': int(os.environ.get('FAISS_PQ_NBITS', 8)),
+        'nprobe': int(os.environ.get('FAISS_NPROBE', 16)),
+        'index_mmap': os.environ.get('FAISS_MMAP', 'true').lower() == 'true',
+        'embedding_batch_size': int(os.environ.get('EMBEDDING_BATCH_SIZE', 2048)),
+        'max_connections': int(os.environ.get('OPENAI_MAX_CONNECTIONS', 20)),
+        'keepalive_expiry': float(os.environ.get('OPENAI_KEEPALIVE_EXPIRY', 60)),
+        'request_timeout': float(os.environ.get('OPENAI_REQUEST_TIMEOUT', 120)),
+        'max_concurrent_answers': int(os.environ.get('MAX_CONCURRENT_ANSWERS', 10)),
+        'index_wait_timeout': float(os.environ.get('INDEX_WAIT_TIMEOUT', 60)),
+        'stream_answers': stream_answers,
+        'retrieval_candidates': int(os.environ.get('RETRIEVAL_CANDIDATES', 6)),
+        'context_token_budget': int(os.environ.get('CONTEXT_TOKEN_BUDGET', 1000)),
+        'context_token_budgets': json.loads(os.environ.get('CONTEXT_TOKEN_BUDGETS', '{}')),
+        'context_duplicate_threshold': float(os.environ.get('CONTEXT_DUPLICATE_THRESHOLD', 0.8)),
+        'answer_cache_size': int(os.environ.get('ANSWER_CACHE_SIZE', 500)),
+        'answer_cache_threshold': float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+        'answer_cache_ttl': float(os.environ.get('ANSWER_CACHE_TTL', 86400)),
+        'coalesce_questions': os.environ.get('COALESCE_QUESTIONS', 'true').lower() == 'true',
+        'google_api_workers': int(os.environ.get('GOOGLE_API_WORKERS', 8)),
+        'drive_chunk_size': int(os.environ.get('DRIVE_CHUNK_SIZE', 10 * 1024 * 1024)),
 
     }
 
     telegram_config = {
         'users': os.environ.get('FILE_XLS_USERS'),
         'token': os.environ['TELEGRAM_BOT_TOKEN'],
+        'bot_api_url': os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org/bot'),
         'bot_language': os.environ.get('BOT_LANGUAGE', 'ru'),
         'embeddings_folder_id': os.environ['EMBEDDINGS_FOLDER_ID'],
         'content_id_rus': os.environ['CONTENT_FOLDER_ID_RU'],
         'content_id_uz': os.environ['CONTENT_FOLDER_ID_UZ'],
         'service_account': os.environ['SERVICE_ACCOUNT_FILE'],
         'stickers_ids': os.environ['STICKERS_IDS'],
-        'model_ft': os.environ.get('MODEL_FT'),
+        'model_ft': os.environ.get('MODEL_FT', 'lid.176.bin'),
+        'language_labels': [label for label in os.environ.get('LANGUAGE_LABELS', '').split(',') if label],
+        'language_threshold': float(os.environ.get('LANGUAGE_THRESHOLD', 0)),
         'checklists_folder_jpg_rus': os.environ.get('CHECKLISTS_FOLDER_JPG_RUS'),
         'checklists_folder_jpg_uz': os.environ.get('CHECKLISTS_FOLDER_JPG_UZ'),
         'checklists_folder_pdf_rus': os.environ.get('CHECKLISTS_FOLDER_PDF_RUS'),
         'checklists_folder_pdf_uz': os.environ.get('CHECKLISTS_FOLDER_PDF_UZ'),
         'checklists_file_id_text_rus': os.environ.get('CHECKLISTS_FILE_ID_TEXT_RUS'),
         'checklists_file_id_text_uz': os.environ.get('CHECKLISTS_FILE_ID_TEXT_UZ'),
+        'index_refresh_interval': int(os.environ.get('INDEX_REFRESH_INTERVAL', 900)),
+        'access_refresh_interval': int(os.environ.get('ACCESS_REFRESH_INTERVAL', 300)),
+        'course_content_ttl': float(os.environ.get('COURSE_CONTENT_TTL', 600)),
+        'file_id_cache_path': os.environ.get('FILE_ID_CACHE_PATH', 'file_id_cache.json'),
+        'folder_listing_cache_path': os.environ.get('FOLDER_LISTING_CACHE_PATH', 'folder_listing_cache.json'),
+        'broadcast_concurrency': int(os.environ.get('BROADCAST_CONCURRENCY', 20)),
+        'broadcast_rate': float(os.environ.get('BROADCAST_RATE', 25)),
+        'broadcast_per_chat_interval': float(os.environ.get('BROADCAST_PER_CHAT_INTERVAL', 1.0)),
+        'broadcast_max_retries': int(os.environ.get('BROADCAST_MAX_RETRIES', 3)),
+        'user_store_path': os.environ.get('USER_STORE_PATH', 'users.sqlite3'),
+        'user_store_flush_interval': float(os.environ.get('USER_STORE_FLUSH_INTERVAL', 2)),
+        'stream_answers': stream_answers,
+        'stream_edit_interval': float(os.environ.get('STREAM_EDIT_INTERVAL', 1.5)),
+        'slow_request_threshold': float(os.environ.get('SLOW_REQUEST_THRESHOLD', 30)),
+        'user_max_in_flight': int(os.environ.get('USER_MAX_IN_FLIGHT', 1)),
+        'user_max_queued': int(os.environ.get('USER_MAX_QUEUED', 1)),
+        'webhook_url': os.environ.get('WEBHOOK_URL'),
+        'webhook_listen': os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+        'webhook_port': int(os.environ.get('WEBHOOK_PORT', 8443)),
+        'webhook_path': os.environ.get('WEBHOOK_PATH', 'telegram'),
+        'webhook_secret_token': os.environ.get('WEBHOOK_SECRET_TOKEN'),
+        'webhook_max_connections': int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40)),
+        'task_queue': os.environ.get('TASK_QUEUE', 'false').lower() == 'true',
+        'task_timeout': float(os.environ.get('TASK_TIMEOUT', 300)),
+        'broadcast_timeout': float(os.environ.get('BROADCAST_TIMEOUT', 900)),
 
     }
+    if telegram_config['task_queue'] and not celery_app.app.conf.task_always_eager \
+            and not os.environ.get('CELERY_BROKER_URL'):
+        # Без брокера задачи не дошли бы до воркеров, и пользователи не получили бы ответов
+        raise ValueError('TASK_QUEUE=true needs CELERY_BROKER_URL, the broker the celery workers consume')
+    return openai_config, telegram_config
+
+
+def main():
+    # Read .env file
+    load_dotenv()
+
+    # Setup logging
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    # Setup configurations
+    openai_config, telegram_config = load_config()
+
+    # Setup and run ChatGPT and Telegram bot. Google credentials and services are created once and
+    # shared; the whitelist is needed before accepting updates, the course index and the language
+    # model finish loading in the background.
+    metrics_port = int(os.environ.get('METRICS_PORT', 9108))
+    if metrics_port:
+        start_metrics_server(metrics_port, os.environ.get('METRICS_ADDR', '127.0.0.1'))
 
-    # Setup and run ChatGPT and Telegram bot
-    openai = OpenAI(config=openai_config)
+    startup = StartupOrchestrator()
+    services = startup.run('google services', GoogleServices, openai_config['service_account'],
+                           openai_config['google_api_workers'], openai_config['drive_chunk_size'])
+    openai = OpenAI(config=openai_config, services=services)
     telegram_bot = ChatGPTTelegramBot(config=telegram_config, openai=openai)
+    startup.submit('access list', telegram_bot.access_control.refresh)
+    # This process builds the course index even with the task queue on: the celery workers only
+    # load the index it saves. Eager tasks run in this process, with the bot's own components
+    startup.submit('course index', openai.refresh_database, critical=False)
+    if telegram_config['task_queue'] and celery_app.app.conf.task_always_eager:
+        celery_app.worker = celery_app.Worker(telegram_bot)
+    startup.submit('language model', telegram_bot.language_detector.load, critical=False)
+    startup.wait_critical()
     telegram_bot.run()
 
 
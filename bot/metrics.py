@@ -0,0 +1,127 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List
+from uuid import UUID
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from prometheus_client import CollectorRegistry, Counter, Histogram, multiprocess, start_http_server
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+REQUEST_SECONDS = Histogram('bot_request_seconds', 'Time to handle a question, end to end',
+                            buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('bot_requests_total', 'Questions handled, by outcome', ['outcome'])
+STAGE_SECONDS = Histogram('bot_stage_seconds', 'Time spent in each stage of handling a question',
+                          ['stage'], buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram('bot_prompt_tokens', 'Prompt size of the questions sent to the model',
+                          buckets=(250, 500, 750, 1000, 1500, 2000, 3000, 4000, 6000, 8000))
+INDEX_REFRESH_SECONDS = Histogram('bot_index_refresh_seconds', 'Time to open or refresh the course index',
+                                  ['result'], buckets=LATENCY_BUCKETS)
+DRIVE_DOWNLOAD_SECONDS = Histogram('bot_drive_download_seconds', 'Time to download a file from Google Drive',
+                                   buckets=LATENCY_BUCKETS)
+DRIVE_DOWNLOAD_BYTES = Counter('bot_drive_download_bytes_total', 'Bytes downloaded from Google Drive')
+BROADCAST_SEND_SECONDS = Histogram('bot_broadcast_send_seconds', 'Time of a broadcast request, retries included',
+                                   buckets=LATENCY_BUCKETS)
+BROADCAST_SENDS = Counter('bot_broadcast_sends_total', 'Broadcast requests, by outcome', ['outcome'])
+ANSWER_CACHE_LOOKUPS = Counter('bot_answer_cache_lookups_total', 'Answer cache lookups, by result', ['result'])
+
+
+def start_metrics_server(port: int, addr: str = '127.0.0.1') -> None:
+    """
+    Serves the metrics for Prometheus on http://addr:port/metrics, from a background thread.
+
+    With `PROMETHEUS_MULTIPROC_DIR` set (in every process, before it starts), the metrics of all
+    the processes writing to that directory are served, so the stages of questions answered by
+    celery workers on the same host are included.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, addr=addr, registry=registry)
+    else:
+        start_http_server(port, addr=addr)
+    logging.info(f"Metrics are served on http://{addr}:{port}/metrics")
+
+
+class RequestTrace:
+    """
+    Times the stages of one request, feeding the stage histograms, and logs the breakdown of
+    requests slower than `slow_threshold` seconds.
+
+    Attributes:
+        name (str): What the request is, shown in the slow-request log.
+        slow_threshold (float): Requests taking longer are logged, 0 to disable.
+        stages (dict): Seconds spent per stage so far, in the order the stages started.
+    """
+
+    def __init__(self, name: str, slow_threshold: float = 0.0):
+        self.name = name
+        self.slow_threshold = slow_threshold
+        self.stages: Dict[str, float] = {}
+        self.started = time.perf_counter()
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        STAGE_SECONDS.labels(stage).observe(seconds)
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def callback(self) -> 'StageCallback':
+        """
+        Returns a callback handler that times the retrieval and completion stages of a chain run.
+        """
+        return StageCallback(self)
+
+    def finish(self, outcome: str = 'answered') -> float:
+        total = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(total)
+        REQUESTS.labels(outcome).inc()
+        if self.slow_threshold and total >= self.slow_threshold:
+            breakdown = ', '.join(f"{stage} {seconds:.2f}s" for stage, seconds in self.stages.items())
+            logging.warning(f"Slow request ({self.name}, {outcome}): {total:.2f}s total; {breakdown}")
+        return total
+
+
+class StageCallback(AsyncCallbackHandler):
+    """
+    Records the time between the start and end events of retrievers and LLMs in a `RequestTrace`.
+    """
+
+    def __init__(self, trace: RequestTrace):
+        self.trace = trace
+        self.started: Dict[UUID, float] = {}
+
+    async def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID, **kwargs) -> None:
+        self.started[run_id] = time.perf_counter()
+
+    async def on_retriever_end(self, documents: List[Any], *, run_id: UUID, **kwargs) -> None:
+        self.finish_stage('retrieval', run_id)
+
+    async def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self.finish_stage('retrieval', run_id)
+
+    async def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *,
+                                  run_id: UUID, **kwargs) -> None:
+        self.started[run_id] = time.perf_counter()
+
+    async def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs) -> None:
+        self.started[run_id] = time.perf_counter()
+
+    async def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs) -> None:
+        self.finish_stage('completion', run_id)
+
+    async def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs) -> None:
+        self.finish_stage('completion', run_id)
+
+    def finish_stage(self, stage: str, run_id: UUID) -> None:
+        started = self.started.pop(run_id, None)
+        if started is not None:
+            self.trace.record(stage, time.perf_counter() - started)
@@ -1,14 +1,23 @@
+import asyncio
 import logging
 import os
+import threading
+import time
 from typing import Dict
 
+import httpx
 import openai
 import json
 
 from langchain.chains import RetrievalQA
-from langchain_openai import ChatOpenAI
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.prompts import PromptTemplate
+from answer_cache import SemanticAnswerCache
+from backpressure import SingleFlight, normalize_question
+from context_builder import ContextBuilder, TokenBudgetRetriever, context_budget, query_embedding
+from metrics import PROMPT_TOKENS, RequestTrace
 from database_helper import Database
+from google_services import GoogleServices
 
 
 # Load translations
@@ -36,6 +45,16 @@ def localized_text(key, bot_language):
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Seconds between attempts to load the course index while it has never loaded
+INDEX_RETRY_INTERVAL = 30
+
+
+class IndexUnavailable(Exception):
+    """
+    Raised when a question can not be answered because the course index is not loaded.
+    """
+
+
 class OpenAI:
     """
     A class to interact with OpenAI's API, specifically for generating text responses
@@ -47,35 +66,294 @@ class OpenAI:
         db_instance (Database): An instance of the Database class for accessing course content.
         db: Database object initialized from the db_instance.
         temperature (float): Sampling temperature for the model's response generation.
+        client (openai.OpenAI): API client shared by every chain and the embeddings, so all requests
+            reuse one pool of keep-alive connections.
+        async_client (openai.AsyncOpenAI): Asynchronous counterpart of `client` with its own pool.
+        chains (dict): RetrievalQA chains built so far, keyed by (language, model name).
+        answer_semaphore (asyncio.Semaphore): Caps how many questions are answered at the same time.
+        questions_in_flight (SingleFlight): Answers being generated, by language and normalized question.
+        answer_cache (SemanticAnswerCache): Answers to recent questions, None when disabled.
+        database_ready (threading.Event): Set once the course index is loaded.
+        database_error (Exception): Why the course index failed to load, None if it is loaded or loading.
+        database_retry (asyncio.Future): Load of the course index retried by a waiting question, if any.
     """
 
-    def __init__(self, config: Dict[str, any]):
+    def __init__(self, config: Dict[str, any], services: GoogleServices = None):
         """
         Initializes the OpenAI class with necessary configurations.
+        The course index is not loaded here, call `refresh_database` to load it.
 
         Args:
             config (Dict[str, any]): A configuration dictionary containing necessary keys like API key, model, etc.
+            services (GoogleServices): Shared Google API clients, created from the config if not given.
         """
 
         openai.api_key = config['api_key']
         self.config = config
         self.model_name = config['model']
-        self.db_instance = Database(config)
-        self.db = self.db_instance.open_database()
         self.temperature = config['temperature']
 
-    def initialize_chat(self):
+        limits = httpx.Limits(
+            max_connections=config['max_connections'],
+            max_keepalive_connections=config['max_connections'],
+            keepalive_expiry=config['keepalive_expiry'],
+        )
+        timeout = httpx.Timeout(config['request_timeout'], connect=10.0)
+        self.client = openai.OpenAI(
+            api_key=config['api_key'],
+            base_url=config.get('api_base'),
+            http_client=httpx.Client(limits=limits, timeout=timeout),
+        )
+        self.async_client = openai.AsyncOpenAI(
+            api_key=config['api_key'],
+            base_url=config.get('api_base'),
+            http_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+        )
+        self.embeddings = OpenAIEmbeddings(
+            openai_api_key=config['api_key'],
+            model=config['embedding_model'],
+            chunk_size=config['embedding_batch_size'],
+            client=self.client.embeddings,
+            async_client=self.async_client.embeddings,
+        )
+
+        self.chains = {}
+        self.chains_lock = threading.Lock()
+        self.answer_semaphore = asyncio.Semaphore(config['max_concurrent_answers'])
+        self.questions_in_flight = SingleFlight()
+        self.answer_cache = None
+        if config['answer_cache_size'] > 0:
+            self.answer_cache = SemanticAnswerCache(
+                threshold=config['answer_cache_threshold'],
+                max_entries=config['answer_cache_size'],
+                ttl=config['answer_cache_ttl'],
+            )
+        self.db_instance = Database(config, embeddings=self.embeddings, services=services)
+        self.db = None
+        self.database_lock = threading.Lock()
+        self.database_ready = threading.Event()
+        self.database_error = None
+        self.database_failed_at = None
+        self.database_retry = None
+
+    def refresh_database(self):
+        """
+        Picks up changes in the embeddings folder, re-embedding only the documents that changed.
+        Chains bound to the previous index are dropped and rebuilt on next use, and cached
+        answers are invalidated. If the index has never loaded, a failure is recorded in
+        `database_error` for the questions waiting for it.
+
+        With `index_readonly` (the celery workers), the embeddings folder is not read: only the
+        index the bot process saved is loaded, see `Database.load_saved_index`.
+        """
+        with self.database_lock:
+            try:
+                if self.config.get('index_readonly'):
+                    db = self.db_instance.load_saved_index()
+                else:
+                    db = self.db_instance.open_database()
+            except Exception as e:
+                if not self.database_ready.is_set():
+                    self.database_error = e
+                    self.database_failed_at = time.monotonic()
+                raise
+            if db is not self.db:
+                with self.chains_lock:
+                    self.db = db
+                    self.chains = {}
+                if self.answer_cache is not None:
+                    self.answer_cache.invalidate()
+            self.database_error = None
+            self.database_ready.set()
+
+    async def wait_for_database(self) -> None:
+        """
+        Waits up to `index_wait_timeout` seconds for the course index to load. While the last
+        attempt to load it failed, a waiting question retries the load, at most every
+        `INDEX_RETRY_INTERVAL` seconds, so the bot recovers without a scheduled refresh.
+
+        Raises:
+            IndexUnavailable: If the index is still not loaded after the timeout.
+        """
+        deadline = time.monotonic() + self.config['index_wait_timeout']
+        while not self.database_ready.is_set():
+            if (self.database_error is not None and self.database_retry is None
+                    and time.monotonic() - self.database_failed_at >= INDEX_RETRY_INTERVAL):
+                logging.info("Retrying to load the course index")
+                self.database_retry = asyncio.get_running_loop().run_in_executor(None, self.refresh_database)
+                self.database_retry.add_done_callback(self.retry_done)
+            if time.monotonic() >= deadline:
+                logging.warning(f"Course index not loaded after {self.config['index_wait_timeout']}s: "
+                                f"{self.database_error or 'still loading'}")
+                raise IndexUnavailable('The course index is not loaded') from self.database_error
+            await asyncio.sleep(0.5)
+
+    def retry_done(self, retry: asyncio.Future) -> None:
+        self.database_retry = None
+        if retry.exception() is not None:
+            logging.error(f"Retry to load the course index failed: {retry.exception()}")
+
+    def get_shard(self, language: str):
+        """
+        Returns the index shard of a language, or the first course language's one if it has no content.
+
+        Raises:
+            IndexUnavailable: If no course language has indexed content.
+        """
+        shard = self.db.get(language)
+        if shard is None:
+            fallback = next((language for language in self.db_instance.languages if language in self.db), None)
+            if fallback is None:
+                # Например, папка с материалами пуста
+                raise IndexUnavailable('The course index has no content')
+            logging.warning(f"No indexed content in language {language!r}, searching {fallback!r} instead")
+            shard = self.db[fallback]
+        return shard
+
+    def get_chain(self, language: str = 'ru', model_name: str = None):
+        """
+        Returns the long-lived RetrievalQA chain for a language and model, building it on first use.
+
+        Chains hold no per-question state, so one instance is safely shared by all concurrent requests.
+
+        Args:
+            language (str): The user's language.
+            model_name (str): The chat model to use, defaults to the configured model.
+        """
+        key = (language, model_name or self.model_name)
+        chain = self.chains.get(key)
+        if chain is not None:
+            return chain
+
+        with self.chains_lock:
+            if key not in self.chains:
+                self.chains[key] = self.initialize_chat(language=language, model_name=key[1])
+            return self.chains[key]
+
+    async def answer(self, question: str, language: str = 'ru', callbacks: list = None, usage: dict = None,
+                     trace: RequestTrace = None) -> str:
+        """
+        Answers a question about the course without blocking the event loop.
+
+        The chain runs through its async API: the LLM call goes over the async client and the
+        FAISS search runs in the default executor. At most `max_concurrent_answers` questions
+        are in flight at once, the rest wait for a free slot. Questions asked before the course
+        index is loaded wait for it, see `wait_for_database`. When the answer cache is enabled,
+        a question close enough to a recently answered one gets the stored answer instead.
+        With `coalesce_questions`, a question identical (after normalization) to one in the
+        same language that is still being answered shares that answer instead of a new run.
+
+        Args:
+            question (str): The user's question.
+            language (str): The user's language.
+            callbacks (list): Callback handlers for this run, e.g. a `TelegramAnswerStreamer`
+                that receives the answer token by token when `stream_answers` is enabled.
+            usage (dict): If given, filled with the prompt size of this request: `prompt_tokens`
+                and `context_chunks` (both 0 for a cached or shared answer).
+            trace (RequestTrace): The trace of the request this answer is part of. The time spent
+                waiting for the index and for a free slot, in the answer cache, in retrieval and in
+                the completion is recorded in it.
+
+        Returns:
+            The generated answer.
+
+        Raises:
+            IndexUnavailable: If the course index could not be loaded in time.
+        """
+        trace = trace or RequestTrace('answer')
+        with trace.stage('index_wait'):
+            if not self.database_ready.is_set():
+                # Индекс ещё загружается после старта бота, или его загрузка не удалась
+                await self.wait_for_database()
+
+        key = normalize_question(question)
+        if not self.config['coalesce_questions'] or not key:
+            # Вопросы без слов и чисел (например, только эмодзи) не считаются одинаковыми
+            return await self.generate_answer(question, language, callbacks, usage, trace)
+
+        started = time.perf_counter()
+        response, shared = await self.questions_in_flight.run(
+            (language, key),
+            lambda: self.generate_answer(question, language, callbacks, usage, trace))
+        if shared:
+            trace.record('coalesced', time.perf_counter() - started)
+            logging.info(f"Shared the answer to an identical {language} question in flight")
+            if usage is not None:
+                usage.update(prompt_tokens=0, context_chunks=0)
+        return response
+
+    async def generate_answer(self, question: str, language: str, callbacks: list, usage: dict,
+                              trace: RequestTrace) -> str:
+        """
+        Answers a question from the answer cache or the chain, see `answer`. The question embedding
+        computed for the cache lookup is reused for retrieval.
+        """
+        embedding = None
+        if self.answer_cache is not None:
+            # Ответ, подготовленный во время обновления индекса, не кэшируется
+            generation = self.answer_cache.generation
+            with trace.stage('answer_cache'):
+                embedding = await self.embeddings.aembed_query(question)
+                cached_answer = self.answer_cache.lookup(language, embedding)
+            if cached_answer is not None:
+                if usage is not None:
+                    usage.update(prompt_tokens=0, context_chunks=0)
+                return cached_answer
+
+        with trace.stage('queue'):
+            await self.answer_semaphore.acquire()
+        token = query_embedding.set((question, embedding) if embedding is not None else None)
+        try:
+            chain = self.get_chain(language)
+            callbacks = list(callbacks or []) + [trace.callback()]
+            result = await chain.ainvoke({'query': question}, config={'callbacks': callbacks})
+        finally:
+            query_embedding.reset(token)
+            self.answer_semaphore.release()
+
+        documents = result['source_documents']
+        prompt_tokens = self.count_prompt_tokens(chain, question, documents)
+        PROMPT_TOKENS.observe(prompt_tokens)
+        logging.info(f"Answered a {language} question with {len(documents)} context chunks, "
+                     f"{prompt_tokens} prompt tokens")
+        if usage is not None:
+            usage.update(prompt_tokens=prompt_tokens, context_chunks=len(documents))
+
+        if embedding is not None:
+            self.answer_cache.store(language, embedding, result['result'], generation)
+        return result['result']
+
+    @staticmethod
+    def count_prompt_tokens(chain: RetrievalQA, question: str, documents: list) -> int:
+        """
+        Returns the number of tokens of the prompt a chain sent for a question and its context.
+        """
+        context_builder = chain.retriever.context_builder
+        context = context_builder.separator.join(document.page_content for document in documents)
+        prompt = chain.combine_documents_chain.llm_chain.prompt.format(context=context, question=question)
+        return context_builder.count_tokens(prompt)
+
+    def initialize_chat(self, language: str = 'ru', model_name: str = None):
         """
         Initializes a chat instance using the OpenAI's model, setting up with the predefined template.
+        Use `get_chain` on the request path, it reuses the chains built here.
+
+        Args:
+            language (str): The user's language, only the index shard of this language is searched.
+            model_name (str): The chat model to use, defaults to the configured model.
 
         Returns:
             An instance of RetrievalQA chain, ready to be used for generating responses based on the course content.
         """
 
+        model_name = model_name or self.model_name
         llm = ChatOpenAI(
             temperature=self.temperature,
             openai_api_key=openai.api_key,
-            model_name=self.model_name,
+            model_name=model_name,
+            streaming=self.config['stream_answers'],
+            client=self.client.chat.completions,
+            async_client=self.async_client.chat.completions,
         )
         template = '''
             Вы — нейроконсультант на курсе по таргетированной рекламе. Ваша задача — предоставлять информацию, строго основываясь на предоставленном курсовом контенте. 
@@ -102,10 +380,24 @@ class OpenAI:
         )
         chain_type_kwargs = {"prompt": prompt, 'verbose': False}
 
+        # Кандидаты упаковываются в контекст в пределах бюджета токенов модели, без почти-дубликатов
+        context_builder = ContextBuilder(
+            model_name=model_name,
+            max_tokens=context_budget(self.config['context_token_budgets'], model_name,
+                                      self.config['context_token_budget']),
+            duplicate_threshold=self.config['context_duplicate_threshold'],
+        )
+        retriever = TokenBudgetRetriever(
+            vectorstore=self.get_shard(language),
+            context_builder=context_builder,
+            k=self.config['retrieval_candidates'],
+        )
+
         qa_chain = RetrievalQA.from_chain_type(
             llm=llm,
             chain_type="stuff",
-            retriever=self.db.as_retriever(),
+            retriever=retriever,
+            return_source_documents=True,
             chain_type_kwargs=chain_type_kwargs
         )
         return qa_chain
\ No newline at end of file
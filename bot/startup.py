@@ -0,0 +1,55 @@
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, List
+
+
+class StartupOrchestrator:
+    """
+    Runs independent startup stages concurrently in a thread pool and logs how long each took.
+
+    Critical stages must succeed before the bot starts accepting updates, `wait_critical` blocks
+    until they are done and re-raises their errors. Other stages keep running in the background
+    after that, their failures are only logged.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='startup')
+        self.started_at = time.perf_counter()
+        self.critical: List[Future] = []
+
+    def run(self, name: str, func: Callable, *args) -> Any:
+        """
+        Runs a stage synchronously, for stages everything else depends on.
+        """
+        return self.timed(name, func, *args)
+
+    def submit(self, name: str, func: Callable, *args, critical: bool = True) -> Future:
+        """
+        Starts a stage in the background.
+        """
+        future = self.executor.submit(self.timed, name, func, *args)
+        if critical:
+            self.critical.append(future)
+        else:
+            future.add_done_callback(lambda done: done.exception() and logging.error(
+                f"Startup stage '{name}' failed, continuing without it: {done.exception()}"))
+        return future
+
+    def wait_critical(self) -> None:
+        """
+        Waits for the critical stages and re-raises the first error among them.
+        """
+        wait(self.critical)
+        for future in self.critical:
+            future.result()
+        self.executor.shutdown(wait=False)
+        logging.info(f"Ready to accept updates {time.perf_counter() - self.started_at:.2f}s after startup")
+
+    @staticmethod
+    def timed(name: str, func: Callable, *args) -> Any:
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            logging.info(f"Startup stage '{name}' took {time.perf_counter() - started:.2f}s")
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackHandler
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from utils import split_text
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class TelegramAnswerStreamer(AsyncCallbackHandler):
+    """
+    Streams an answer into an already sent Telegram message by progressively editing it.
+
+    Tokens from the chat model are buffered and flushed with `edit_message_text` at most once
+    per `edit_interval` seconds, and only when at least `min_chars` new characters arrived,
+    to stay inside Telegram's edit limits. Edits run in the background, so a slow
+    Telegram request never holds up the token stream.
+
+    Attributes:
+        message (Message): The message to edit, e.g. the "processing" placeholder.
+        edit_interval (float): Minimum delay between two edits, in seconds.
+        min_chars (int): Minimum number of new characters that justifies an edit.
+        text (str): The answer received so far.
+    """
+
+    def __init__(self, message: Message, edit_interval: float = 1.5, min_chars: int = 40):
+        self.message = message
+        self.edit_interval = edit_interval
+        self.min_chars = min_chars
+        self.text = ''
+        self.sent_text = ''
+        self.next_edit_at = 0.0
+        self.pending_edit = None
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.text += token
+        if self.pending_edit is not None and not self.pending_edit.done():
+            return
+        if time.monotonic() < self.next_edit_at or len(self.text) - len(self.sent_text) < self.min_chars:
+            return
+        self.pending_edit = asyncio.create_task(self.edit(self.text))
+
+    async def edit(self, text: str) -> None:
+        """
+        Replaces the message text with the first Telegram-sized part of `text`.
+        """
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not text.strip() or text == self.sent_text:
+            return
+        self.next_edit_at = time.monotonic() + self.edit_interval
+        try:
+            await self.message.edit_text(text, disable_web_page_preview=True)
+            self.sent_text = text
+        except RetryAfter as e:
+            self.next_edit_at = time.monotonic() + float(e.retry_after)
+            logging.warning(f"Flood control while streaming an answer, next edit in {e.retry_after}s")
+        except BadRequest as e:
+            # Telegram rejects edits that do not change the text
+            if 'not modified' not in str(e):
+                logging.warning(f"Failed to edit the streamed answer: {e}")
+        except TelegramError as e:
+            logging.warning(f"Failed to edit the streamed answer: {e}")
+
+    async def finish(self, answer: str) -> None:
+        """
+        Shows the complete answer: edits the message with its first part and sends the rest as
+        follow-up messages.
+
+        Args:
+            answer (str): The final answer returned by the chain.
+        """
+        if self.pending_edit is not None:
+            await self.pending_edit
+
+        parts = split_text(answer, TELEGRAM_MESSAGE_LIMIT) or [answer]
+        delay = self.next_edit_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.edit(parts[0])
+        if self.sent_text != parts[0]:
+            # The final edit failed, fall back to a regular reply so the answer is never lost
+            await self.message.reply_text(parts[0], disable_web_page_preview=True)
+        for part in parts[1:]:
+            await self.message.reply_text(part, disable_web_page_preview=True)
@@ -1,16 +1,28 @@
+import asyncio
 import logging
 import random
-from typing import Dict, Set
+import secrets
+import time
+from typing import Dict
 import telegram
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import Message, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram.error import BadRequest
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, \
     filters, ContextTypes, CallbackContext, CallbackQueryHandler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from database_helper import Database
+from access_control import AccessControl
+from backpressure import SingleFlight, UserQuestionLimiter, normalize_question
+from broadcaster import Broadcaster
+from celery_app import answer_question, broadcast_checklists
+from course_content import CourseContentCache
 from utils import error_handler
-from openai_helper import localized_text, OpenAI
-import fasttext
-from file_sender import FileSender
+from openai_helper import IndexUnavailable, localized_text, OpenAI
+from file_sender import FileSender, FileIdCache
+from drive_listing import FolderListingCache
+from language_detector import LanguageDetector
+from metrics import RequestTrace
+from streaming import TelegramAnswerStreamer
+from user_store import UserStore
 
 
 class ChatGPTTelegramBot:
@@ -21,37 +33,59 @@ class ChatGPTTelegramBot:
         config (dict): Configuration dictionary containing necessary keys and tokens.
         openai (OpenAI): The OpenAI GPT instance for generating text responses.
         db (Database): Instance of the Database class for data retrieval and management.
-        allowed_usernames (list): List of Telegram usernames allowed to interact with the bot.
-        user_languages (dict): Dictionary to store users' language preferences.
+        access_control (AccessControl): Whitelist of Telegram usernames allowed to interact with the bot.
+        course_content_cache (CourseContentCache): Course content per language, split into pages.
+        user_store (UserStore): Persistent users' usernames, language preferences and delivered checklists,
+            plus the broadcast counter. None without `user_store_path`, in celery workers, which get
+            the users they serve with each task.
         stickers_ids (str): Path to a file containing sticker IDs for the bot to send.
+        language_detector (LanguageDetector): Detects the language of users' questions.
+        user_limiter (UserQuestionLimiter): Caps the questions each user has in flight and queued.
+        queued_questions (SingleFlight): Questions being answered by celery workers, by language and
+            normalized question.
         bot (Bot): The Telegram Bot instance.
         file_sender (FileSender): An instance of FileSender for handling file-related operations.
+        file_id_cache (FileIdCache): Telegram file_ids of the checklist files uploaded so far.
+        folder_listing (FolderListingCache): Checklist folder listings, kept current via Drive changes.
+        broadcaster (Broadcaster): Sends the scheduled checklists within Telegram's rate limits.
         service (Resource): Google API service resource for accessing Drive API.
-        active_users (set): A set of active user IDs that have interacted with the bot.
-        counter (int): A counter used for iterating through files to send.
     """
 
     def __init__(self, config: Dict, openai: OpenAI):
         self.config = config
         self.openai = openai
-        self.db = Database(config)
+        self.db = openai.db_instance
         self.file_id_users = config['users']
-        self.allowed_usernames = self.db.get_usernames(self.file_id_users)
-        self.user_languages: Dict[int, str] = {}
+        self.access_control = AccessControl(self.db, self.file_id_users)
+        self.course_content_cache = CourseContentCache(self.db, ttl=config['course_content_ttl'])
+        self.user_store = UserStore(config['user_store_path']) if config['user_store_path'] else None
         self.stickers_ids = config['stickers_ids']
-        self.model = fasttext.load_model('lid.176.bin')
-        self.bot = telegram.Bot(token=config['token'])
-        self.file_sender = FileSender()
-        self.scopes = ['https://www.googleapis.com/auth/drive']
-        self.service = self.file_sender.oauth(self.scopes, self.config['service_account'])
+        self.language_detector = LanguageDetector(
+            model_path=config['model_ft'],
+            labels=config['language_labels'],
+            threshold=config['language_threshold'],
+        )
+        self.bot = telegram.Bot(token=config['token'], base_url=config['bot_api_url'])
+        self.file_sender = FileSender(self.db.google)
+        self.file_id_cache = FileIdCache(config['file_id_cache_path'])
+        self.folder_listing = FolderListingCache(self.db, config['folder_listing_cache_path'])
+        self.user_limiter = UserQuestionLimiter(config['user_max_in_flight'], config['user_max_queued'])
+        self.queued_questions = SingleFlight()
+        self.upload_locks: Dict[str, asyncio.Lock] = {}
+        self.broadcaster = Broadcaster(
+            max_concurrency=config['broadcast_concurrency'],
+            global_rate=config['broadcast_rate'],
+            per_chat_interval=config['broadcast_per_chat_interval'],
+            max_retries=config['broadcast_max_retries'],
+        )
+        self.broadcast_lock = asyncio.Lock()
+        self.service = self.db.drive_service
         self.checklists_folder_jpg_rus = config['checklists_folder_jpg_rus']
         self.checklists_folder_jpg_uz = config['checklists_folder_jpg_uz']
         self.checklists_folder_pdf_rus = config['checklists_folder_pdf_rus']
         self.checklists_folder_pdf_uz = config['checklists_folder_pdf_uz']
         self.checklists_file_id_text_rus = config['checklists_file_id_text_rus']
         self.checklists_file_id_text_uz = config['checklists_file_id_text_uz']
-        self.active_users: Set[int] = set()
-        self.counter = 1
 
     async def start(self, update: Update, context: CallbackContext) -> None:
         """
@@ -63,12 +97,12 @@ class ChatGPTTelegramBot:
         """
 
         user_id = update.effective_user.id
-        self.active_users.add(user_id)
+        self.user_store.register(user_id, update.effective_user.username)
         bot_language = self.config['bot_language']
         username = "@" + update.message.from_user.username if update.message.from_user.username else None
         disallowed = (
             localized_text('disallowed', bot_language))
-        if username not in self.allowed_usernames:
+        if not self.access_control.is_allowed(username):
             await update.message.reply_text(disallowed, disable_web_page_preview=True)
             return
 
@@ -96,8 +130,9 @@ class ChatGPTTelegramBot:
         language = query.data  # 'ru' или 'uz'
         user_id = update.effective_user.id
 
-        # Сохраняем выбранный язык в словаре user_languages
-        self.user_languages[user_id] = language
+        # Сохраняем выбранный язык в хранилище пользователей
+        self.user_store.register(user_id, update.effective_user.username)
+        self.user_store.set_language(user_id, language)
         welcome_message_rus = ''' 
           Вы выбрали русский язык.\n\nА теперь расскажем про возможности бота. 🧙‍♂️ Это ваш персональный нейро-тьютор. Ему можно задавать вопросы по урокам. \n\nКаждый понедельник в 12:00 вам будут приходить подарки от бота с полезными памятками и чек-листами🌸 \n\nПопробуйте сейчас спросить, что такое таргетированная реклама.\n\nВот доступные Вам команды:\n\n🔘Начать: Нажмите, чтобы начать заново использовать бота.\n\n🔘Помощь: Получите справочное сообщение.\n\n🔘Содержание курса: Просмотрите доступные разделы и материалы курса.
           '''
@@ -139,12 +174,13 @@ class ChatGPTTelegramBot:
         """
 
         user_id = update.message.from_user.id
+        self.user_store.register(user_id, update.message.from_user.username)
         username = "@" + update.message.from_user.username if update.message.from_user.username else None
 
         # Получаем язык пользователя; используем язык по умолчанию, если для пользователя не установлен язык
-        user_language = self.user_languages.get(user_id, self.config.get('default_language', 'ru'))
+        user_language = self.user_store.get_language(user_id, self.config.get('default_language', 'ru'))
 
-        if username not in self.allowed_usernames:
+        if not self.access_control.is_allowed(username):
             disallowed = localized_text('disallowed', user_language)
             await update.message.reply_text(disallowed, disable_web_page_preview=True)
             return
@@ -164,8 +200,11 @@ class ChatGPTTelegramBot:
 
         user_id = update.message.from_user.id
         user_message = update.message.text
+        trace = RequestTrace(f"question from user {user_id}", self.config['slow_request_threshold'])
+        self.user_store.register(user_id, update.message.from_user.username)
 
-        user_language = self.user_languages.get(user_id, self.config.get('default_language', 'ru'))
+        with trace.stage('user_lookup'):
+            user_language = self.user_store.get_language(user_id, self.config.get('default_language', 'ru'))
 
         if user_language == 'ru':
             if user_message == '/Начать':
@@ -187,22 +226,50 @@ class ChatGPTTelegramBot:
             return
 
         try:
-            predictions = self.model.predict(user_message, k=1)  # k=1 возвращает самый вероятный язык
-            detected_language = predictions[0][0].replace("__label__", "")
+            with trace.stage('language_detection'):
+                if self.language_detector.model is None:
+                    # Модель загружается при первом использовании, не блокируя цикл событий
+                    await asyncio.get_running_loop().run_in_executor(None, self.language_detector.load)
+                detected_language = self.language_detector.detect(user_message)
         except Exception as e:
             logging.error(f"Ошибка при определении языка: {e}")
             await update.message.reply_text("Ошибка при определении языка сообщения.")
+            trace.finish('error')
             return
 
         # Проверка соответствия языка сообщения и выбранного пользователем языка
-        if detected_language != user_language:
+        # (если язык определить не удалось, вопрос принимается)
+        if detected_language is not None and detected_language != user_language:
             error_message = "Пожалуйста, задавайте вопросы на русском языке." if user_language == 'ru' else "Iltimos, savollaringizni o'zbek tilida bering."
             await update.message.reply_text(error_message)
+            trace.finish('wrong_language')
             return
 
+        async with self.user_limiter.admit(user_id) as admitted:
+            if not admitted:
+                # Пользователь ещё ждёт ответов на предыдущие вопросы, новый не принимаем
+                await update.message.reply_text(localized_text('still_working', user_language))
+                trace.finish('busy')
+                return
+            await self.process_question(update, user_message, user_language, trace)
+
+    async def process_question(self, update: Update, user_message: str, user_language: str,
+                               trace: RequestTrace) -> None:
+        """
+        Acknowledges an admitted question with a placeholder message and a sticker, then answers it
+        once the user has a free in-flight slot.
+
+        Args:
+            update (Update): The incoming update.
+            user_message (str): The question.
+            user_language (str): The user's language.
+            trace (RequestTrace): Times the stages of the request.
+        """
+
         processing_message = "Пока ваш запрос обрабатывается, ловите котика \n\n*Обращаем внимание, что подготовка ответа может занимать время до 1 минуты " if user_language == 'ru' \
             else "Hozircha so’rovingiz ko’rib chiqilmoqda, mushukchani tuting \n\n*Diqqat qiling, javobni tayyorlash bir daqiqagacha vaqt olishi mumkin"
-        processing_message_id = await update.message.reply_text(processing_message)
+        with trace.stage('placeholder'):
+            processing_message_id = await update.message.reply_text(processing_message)
 
         # Отправка случайного стикера
         try:
@@ -213,13 +280,111 @@ class ChatGPTTelegramBot:
         except Exception as e:
             logging.error(f"Ошибка при чтении файла стикеров: {e}")
             await update.message.reply_text("Произошла ошибка при обработке вашего запроса.")
+            trace.finish('error')
             return
 
-        await update.message.reply_sticker(sticker=sticker_file_id)
+        with trace.stage('sticker'):
+            await update.message.reply_sticker(sticker=sticker_file_id)
+
+        started = time.perf_counter()
+        async with self.user_limiter.turn(update.message.from_user.id):
+            trace.record('user_queue', time.perf_counter() - started)
+            try:
+                if self.config['task_queue']:
+                    # Ответ готовит и отправляет воркер celery, слот пользователя занят до конца задачи
+                    await self.answer_in_worker(user_message, user_language, processing_message_id, trace)
+                else:
+                    await self.send_answer(user_message, user_language, processing_message_id, trace)
+            except IndexUnavailable:
+                trace.finish('index_unavailable')
+                return
+            except Exception:
+                trace.finish('error')
+                raise
+            trace.finish('answered')
+
+    async def answer_in_worker(self, question: str, language: str, placeholder: Message,
+                               trace: RequestTrace) -> None:
+        """
+        Has a celery worker answer a question and send the answer to the chat of the `placeholder`
+        message, and waits for the task, so the question holds its user's in-flight slot until
+        it is answered.
+
+        With `coalesce_questions`, a question identical (after normalization) to one in the same
+        language that a worker is still answering does not start another task: this process
+        sends it the other task's answer. Workers only coalesce the questions they run themselves.
+
+        Args:
+            question (str): The user's question.
+            language (str): The language of the question and the answer.
+            placeholder (Message): The message sent to the user while the answer is prepared.
+            trace (RequestTrace): Times the stages of the request.
+
+        Raises:
+            IndexUnavailable: If the course index is not loaded, after telling the user so.
+        """
 
-        qa_chain = self.openai.initialize_chat()
-        response = qa_chain.run(user_message)
-        await update.message.reply_text(response)
+        def run_task():
+            # delay и get в одном потоке: ответ rpc:// приходит в соединение, отправившее задачу
+            result = answer_question.delay(question, language, placeholder.to_dict())
+            # Бот не задача celery: проверка на get() внутри задачи ложно срабатывает, пока
+            # в другом потоке идёт eager-задача
+            return result.get(timeout=self.config['task_timeout'], disable_sync_subtasks=False)
+
+        def run_in_executor():
+            return asyncio.get_running_loop().run_in_executor(None, run_task)
+
+        key = normalize_question(question)
+        with trace.stage('worker'):
+            if not self.openai.config['coalesce_questions'] or not key:
+                response, shared = await run_in_executor(), False
+            else:
+                response, shared = await self.queued_questions.run((language, key), run_in_executor)
+        if response is None:
+            # Воркер не дождался индекса и уже ответил пользователю
+            if shared:
+                with trace.stage('reply'):
+                    await placeholder.reply_text(localized_text('index_unavailable', language))
+            raise IndexUnavailable('The course index is not loaded')
+        if shared:
+            logging.info(f"Shared the answer to an identical {language} question in a worker")
+            with trace.stage('reply'):
+                await placeholder.reply_text(response)
+
+    async def send_answer(self, question: str, language: str, placeholder: Message, trace: RequestTrace) -> str:
+        """
+        Answers a question and sends the answer to the chat of the `placeholder` message,
+        streaming it into the placeholder when answers are streamed.
+
+        Args:
+            question (str): The user's question.
+            language (str): The language of the question and the answer.
+            placeholder (Message): The message sent to the user while the answer is prepared.
+            trace (RequestTrace): Times the stages of the request.
+
+        Returns:
+            The answer sent.
+
+        Raises:
+            IndexUnavailable: If the course index is not loaded, after telling the user so.
+        """
+
+        try:
+            if self.config['stream_answers']:
+                # Стримим ответ в сообщение-заглушку по мере генерации
+                streamer = TelegramAnswerStreamer(placeholder, edit_interval=self.config['stream_edit_interval'])
+                response = await self.openai.answer(question, language, callbacks=[streamer], trace=trace)
+                with trace.stage('reply'):
+                    await streamer.finish(response)
+            else:
+                response = await self.openai.answer(question, language, trace=trace)
+                with trace.stage('reply'):
+                    await placeholder.reply_text(response)
+        except IndexUnavailable:
+            with trace.stage('reply'):
+                await placeholder.reply_text(localized_text('index_unavailable', language))
+            raise
+        return response
 
     async def course_content(self, update: Update, context: CallbackContext) -> None:
         """
@@ -231,61 +396,203 @@ class ChatGPTTelegramBot:
         """
 
         user_id = update.effective_user.id
-        user_language = self.user_languages.get(user_id, self.config.get('default_language', 'ru'))
+        self.user_store.register(user_id, update.effective_user.username)
+        user_language = self.user_store.get_language(user_id, self.config.get('default_language', 'ru'))
         username = "@" + update.message.from_user.username if update.message.from_user.username else None
 
         # Проверяем, разрешён ли доступ пользователю
-        if username not in self.allowed_usernames:
+        if not self.access_control.is_allowed(username):
             disallowed_message = localized_text('disallowed', self.config['bot_language'])
             await update.message.reply_text(disallowed_message, disable_web_page_preview=True)
             return
 
-        # Получаем контент курса из базы данных
-        content = self.db.get_course_content(language=user_language)
-        # Отправляем контент, учитывая ограничение Telegram на размер сообщения
-        await update.message.reply_text(content[:4096])
+        # Контент курса разбит на страницы по ограничению Telegram на размер сообщения
+        pages = await self.course_content_cache.get_pages(user_language)
+        await update.message.reply_text(pages[0], reply_markup=self.course_content_keyboard(user_language, 0, len(pages)))
 
-    async def send_files_by_counter(self, service) -> None:
-        global counter
+    async def course_content_page(self, update: Update, context: CallbackContext) -> None:
+        """
+        Shows another page of the course content when a paginator button is pressed.
 
-        if self.counter > 8:  # Если счетчик превысил количество файлов, прекратить выполнение
+        Args:
+            update (Update): The incoming update.
+            context (CallbackContext): The context of the callback.
+        """
+
+        query = update.callback_query
+        username = "@" + query.from_user.username if query.from_user.username else None
+        if not self.access_control.is_allowed(username):
+            await query.answer(localized_text('disallowed', self.config['bot_language']), show_alert=True)
             return
 
-        for user_id in self.active_users:
-            try:
-                chat = await self.bot.get_chat(user_id)
-                username = "@" + chat.username if chat.username else None
+        _, language, page = query.data.split(':')
+        pages = await self.course_content_cache.get_pages(language)
+        # Содержимое могло измениться с момента отправки сообщения
+        page = min(int(page), len(pages) - 1)
+        await query.answer()
+        try:
+            await query.edit_message_text(pages[page],
+                                          reply_markup=self.course_content_keyboard(language, page, len(pages)))
+        except BadRequest as e:
+            # Нажатие на номер текущей страницы не меняет сообщение
+            if 'not modified' not in str(e):
+                raise
+
+    @staticmethod
+    def course_content_keyboard(language, page, pages_count):
+        if pages_count < 2:
+            return None
+
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton("◀️", callback_data=f"course_content:{language}:{page - 1}"))
+        buttons.append(InlineKeyboardButton(f"{page + 1}/{pages_count}", callback_data=f"course_content:{language}:{page}"))
+        if page < pages_count - 1:
+            buttons.append(InlineKeyboardButton("▶️", callback_data=f"course_content:{language}:{page + 1}"))
+        return InlineKeyboardMarkup([buttons])
+
+    async def send_files_by_counter(self, service) -> None:
+        """
+        Sends the checklist files for the current counter to every allowed active user.
+
+        The checklist folders are only listed once; each run then applies the Drive changes made
+        since the previous one. Each language's checklist text is downloaded once per run. Every file
+        is uploaded to Telegram once, and everyone else receives it by its cached `file_id`.
+        Users are served concurrently through the broadcaster, within Telegram's rate limits.
+        A run that starts while the previous one is still going is skipped.
+
+        Users, their languages and the counter come from the user store, so no Telegram requests
+        are needed to find out who gets what. Users who already received the current checklist,
+        e.g. before a restart, are skipped. With the task queue on, the files are sent by a celery
+        worker and this process records who received them and saves the caches the worker updated.
+        """
 
-                if username not in self.allowed_usernames:
+        counter = self.user_store.get_state('counter', 1)
+        if counter > 8:  # Если счетчик превысил количество файлов, прекратить выполнение
+            return
+        if self.broadcast_lock.locked():
+            logging.warning(f"Broadcast for counter {counter} is still running, skipping this run")
+            return
+
+        async with self.broadcast_lock:
+            users_by_language: Dict[str, list] = {}
+            for user in self.user_store.get_users():
+                username = "@" + user['username'] if user['username'] else None
+                if user['last_checklist'] >= counter or not self.access_control.is_allowed(username):
                     continue
+                user_language = user['language'] or self.config.get('default_language', 'ru')
+                users_by_language.setdefault(user_language, []).append(user['user_id'])
+
+            if self.config['task_queue']:
+                # Рассылку выполняет воркер celery: он получает кэши file_id и списков файлов
+                # и возвращает их обновлёнными вместе с обслуженными пользователями
+                file_ids, folder_listing = self.file_id_cache.entries, self.folder_listing.snapshot()
+
+                def run_task():
+                    # delay и get в одном потоке: ответ rpc:// приходит в соединение, отправившее задачу
+                    result = broadcast_checklists.delay(counter, users_by_language, file_ids, folder_listing)
+                    return result.get(timeout=self.config['broadcast_timeout'], disable_sync_subtasks=False)
+
+                try:
+                    outcome = await asyncio.get_running_loop().run_in_executor(None, run_task)
+                except Exception as e:
+                    logging.error(f"Broadcast for counter {counter} did not complete in the worker: {e}")
+                    return
+                self.file_id_cache.replace(outcome['file_ids'])
+                self.folder_listing.restore(outcome['folder_listing'])
+                served = outcome['served']
+            else:
+                served = await self.deliver_checklists(service, counter, users_by_language)
+
+            for user_id in served:
+                self.user_store.set_last_checklist(user_id, counter)
+
+            # Инкрементировать счетчик после обработки всех пользователей
+            self.user_store.set_state('counter', counter + 1)
+
+    async def deliver_checklists(self, service, counter, users_by_language):
+        """
+        Sends the checklist files for `counter` to the given users.
 
-                user_language = self.user_languages.get(user_id, self.config.get('default_language', 'ru'))
-                jpg_folder_id, pdf_folder_id = self.get_folder_ids(user_language)
-                checklists_text = self.get_checklists_text(user_language)
-                jpg_files, pdf_files = self.get_files(service, jpg_folder_id, pdf_folder_id)
+        Args:
+            service (Resource): Google Drive API service.
+            counter (int): Number of the checklist to send.
+            users_by_language (dict): Ids of the users to serve, by language.
 
-                text = await self.file_sender.download_file(service, checklists_text, is_google_doc=True)
-                caption_text_dict = self.file_sender.extract_sections(text) if text else {}
-                caption_text = caption_text_dict.get(str(self.counter), "Текст не найден")
+        Returns:
+            The ids of the users who received all their files.
+        """
 
-                selected_files = [f for f in jpg_files + pdf_files if f['name'].startswith(str(self.counter))]
+        if users_by_language:
+            try:
+                changes = await self.folder_listing.sync()
+                logging.info(f"Applied {changes} Drive changes to the checklist folder listings")
+            except Exception as e:
+                logging.exception(f"Error syncing Drive changes, using cached folder listings: {e}")
 
+        served = []
+        files_sent = 0
+        files_failed = 0
+        stats = {'sent': 0, 'failed': 0, 'duration': 0.0}
+        for user_language, user_ids in users_by_language.items():
+            try:
+                caption_text, selected_files, streams = await self.get_checklist_assets(service, user_language,
+                                                                                        counter)
+            except Exception as e:
+                logging.exception(f"Error preparing files for counter {counter} "
+                                  f"in language {user_language}: {e}")
+                stats['failed'] += len(user_ids)
+                continue
+
+            async def deliver(user_id):
+                nonlocal files_sent, files_failed
                 all_files_sent = True  # Флаг для отслеживания успешности отправки всех файлов
                 for file in selected_files:
-                    file_stream = await self.file_sender.download_file(service, file['id'], is_google_doc=False)
-                    success = await self.send_file(user_id, file, file_stream, caption_text)
-                    if not success:
+                    success = await self.send_file(service, user_id, file, caption_text,
+                                                   streams.get(file['id']))
+                    if success:
+                        files_sent += 1
+                    else:
+                        files_failed += 1
                         all_files_sent = False  # Если файл не отправлен, устанавливаем флаг в False
-
                 if all_files_sent:
-                    print(f"Files for counter {self.counter} were successfully sent to user {user_id}.")
-                else:
-                    print(f"Not all files for counter {self.counter} were sent successfully to user {user_id}.")
+                    served.append(user_id)
+                return all_files_sent
 
-            except Exception as e:
-                print(f"Error processing user {user_id}: {e}")
+            language_stats = await self.broadcaster.run(user_ids, deliver)
+            for key in ('sent', 'failed', 'duration'):
+                stats[key] += language_stats[key]
+
+        duration = stats['duration']
+        logging.info(f"Broadcast for counter {counter}: {stats['sent']} users served, "
+                     f"{stats['failed']} users failed, {files_sent} files sent, {files_failed} files failed "
+                     f"in {duration:.1f}s ({files_sent / duration if duration else 0:.1f} files/s)")
+        return served
 
-        self.counter += 1  # Инкрементировать счетчик после обработки всех пользователей
+    async def get_checklist_assets(self, service, user_language, counter):
+        """
+        Resolves the caption and the files to send for checklist `counter` in one language, and
+        downloads the files that have no Telegram file_id yet.
+
+        Returns:
+            The caption, the Drive files and a dict of downloaded streams by Drive file id.
+        """
+        jpg_folder_id, pdf_folder_id = self.get_folder_ids(user_language)
+        checklists_text = self.get_checklists_text(user_language)
+        jpg_files, pdf_files, text = await asyncio.gather(
+            self.folder_listing.list(jpg_folder_id),
+            self.folder_listing.list(pdf_folder_id),
+            self.file_sender.download_file(service, checklists_text, is_google_doc=True),
+        )
+        caption_text_dict = self.file_sender.extract_sections(text) if text else {}
+        caption_text = caption_text_dict.get(str(counter), "Текст не найден")
+
+        selected_files = [f for f in jpg_files + pdf_files if f['name'].startswith(str(counter))]
+        missing = [file for file in selected_files if self.file_id_cache.get(file) is None]
+        downloads = await asyncio.gather(
+            *(self.file_sender.download_file(service, file['id'], is_google_doc=False) for file in missing))
+        streams = {file['id']: stream for file, stream in zip(missing, downloads)}
+        return caption_text, selected_files, streams
 
     def get_folder_ids(self, user_language):
         jpg_folder_id = self.checklists_folder_jpg_rus if user_language == 'ru' else self.checklists_folder_jpg_uz
@@ -295,49 +602,145 @@ class ChatGPTTelegramBot:
     def get_checklists_text(self, user_language):
         return self.checklists_file_id_text_rus if user_language == 'ru' else self.checklists_file_id_text_uz
 
-    def get_files(self, service, jpg_folder_id, pdf_folder_id):
-        jpg_files = self.db.list_files_in_folder(service, jpg_folder_id)
-        pdf_files = self.db.list_files_in_folder(service, pdf_folder_id)
-        return jpg_files, pdf_files
+    async def send_file(self, service, user_id, file, caption_text, file_stream=None):
+        """
+        Sends a Drive file to a user by its cached Telegram file_id, uploading it only if there is none.
+        The upload uses `file_stream` when the file was already downloaded. Concurrent sends of a file
+        that is not uploaded yet wait for the first upload and then reuse its file_id.
+
+        Returns:
+            True if the file was sent, False otherwise.
+        """
+        file_id = self.file_id_cache.get(file)
+        if file_id is None:
+            async with self.upload_locks.setdefault(file['id'], asyncio.Lock()):
+                file_id = self.file_id_cache.get(file)
+                if file_id is None:
+                    return await self.upload_file(service, user_id, file, caption_text, file_stream)
 
-    async def send_file(self, user_id, file, file_stream, caption_text):
         try:
-            if file['name'].endswith('.jpg'):
-                file_stream.seek(0)
-                await self.bot.send_photo(chat_id=user_id, photo=file_stream, caption=caption_text)
-            elif file['name'].endswith('.pdf'):
-                file_stream.seek(0)
-                await self.bot.send_document(chat_id=user_id, document=file_stream, filename=file['name'])
+            await self.broadcaster.call(user_id, lambda: self.send_media(user_id, file, file_id, caption_text))
+            return True
+        except BadRequest as e:
+            if 'file identifier' not in str(e).lower():
+                logging.warning(f"Failed to send file {file['name']} to user {user_id}: {e}")
+                return False
+            # file_id может стать недействительным, например после смены токена бота
+            logging.warning(f"Cached file_id for {file['name']} was rejected, uploading again: {e}")
+        except Exception as e:
+            logging.warning(f"Failed to send file {file['name']} to user {user_id}: {e}")
+            return False
+
+        async with self.upload_locks.setdefault(file['id'], asyncio.Lock()):
+            # Пока мы ждали блокировку, файл мог уже загрузить другой получатель
+            new_file_id = self.file_id_cache.get(file)
+            if new_file_id is None or new_file_id == file_id:
+                self.file_id_cache.discard(file)
+                return await self.upload_file(service, user_id, file, caption_text, file_stream)
+
+        try:
+            await self.broadcaster.call(user_id, lambda: self.send_media(user_id, file, new_file_id, caption_text))
+            return True
+        except Exception as e:
+            logging.warning(f"Failed to send file {file['name']} to user {user_id}: {e}")
+            return False
+
+    async def upload_file(self, service, user_id, file, caption_text, file_stream=None):
+        """
+        Uploads a Drive file to a user and caches the file_id Telegram assigned to it.
+        """
+        try:
+            if file_stream is None:
+                file_stream = await self.file_sender.download_file(service, file['id'], is_google_doc=False)
+            message = await self.broadcaster.call(
+                user_id, lambda: self.send_media(user_id, file, file_stream, caption_text))
+            if message is not None:
+                media = message.photo[-1] if message.photo else message.document
+                self.file_id_cache.set(file, media.file_id)
             return True  # Возвращает True, если файл успешно отправлен
         except Exception as e:
-            print(f"Failed to send file {file['name']} to user {user_id}: {e}")
+            logging.warning(f"Failed to send file {file['name']} to user {user_id}: {e}")
             return False  # Возвращает False, если во время отправки произошла ошибка
 
+    async def send_media(self, user_id, file, media, caption_text):
+        """
+        Sends a photo or a PDF given as a file_id or a stream, returning the sent message.
+        """
+        if hasattr(media, 'seek'):
+            media.seek(0)
+        if file['name'].endswith('.jpg'):
+            return await self.bot.send_photo(chat_id=user_id, photo=media, caption=caption_text)
+        elif file['name'].endswith('.pdf'):
+            return await self.bot.send_document(chat_id=user_id, document=media, filename=file['name'])
+        return None
+
     def start_scheduler(self) -> None:
         """
         Starts the APScheduler to periodically execute tasks.
         """
 
         scheduler = AsyncIOScheduler()
-        scheduler.add_job(self.send_files_by_counter, 'interval', seconds=120, args=[self.service])
+        scheduler.add_job(self.send_files_by_counter, 'interval', seconds=120, args=[self.service],
+                          max_instances=1, coalesce=True)
+        scheduler.add_job(self.access_control.refresh, 'interval', seconds=self.config['access_refresh_interval'])
+        scheduler.add_job(self.user_store.flush, 'interval', seconds=self.config['user_store_flush_interval'])
+        if self.config['index_refresh_interval'] > 0:
+            scheduler.add_job(self.openai.refresh_database, 'interval', seconds=self.config['index_refresh_interval'])
         scheduler.start()
 
-    def run(self) -> None:
+    async def shutdown(self, application) -> None:
+        """
+        Writes the pending user state to disk when the bot stops.
+        """
+        self.user_store.close()
+
+    def build_application(self):
         """
-        Initiates the bot and starts polling for updates.
+        Builds the telegram application with all the handlers registered.
         """
 
         application = ApplicationBuilder() \
             .token(self.config['token']) \
+            .base_url(self.config['bot_api_url']) \
             .concurrent_updates(True) \
+            .post_shutdown(self.shutdown) \
             .build()
 
         application.add_handler(CommandHandler('start', self.start))
         application.add_handler(CommandHandler('help', self.help))
         application.add_handler(CommandHandler('course_content', self.course_content))
-        application.add_handler(CallbackQueryHandler(self.button))
+        application.add_handler(CallbackQueryHandler(self.course_content_page, pattern=r'^course_content:'))
+        application.add_handler(CallbackQueryHandler(self.button, pattern=r'^(ru|uz)$'))
         application.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), self.message_handler))
         application.add_error_handler(error_handler)
-        self.start_scheduler()
+        return application
+
+    def webhook_options(self) -> Dict:
+        """
+        Returns the webhook server settings: where it listens, the public URL Telegram posts
+        updates to, the secret token Telegram sends with every update (updates without it are
+        rejected) and how many connections Telegram may open at once.
+        """
+
+        url_path = self.config['webhook_path'].strip('/')
+        return {
+            'listen': self.config['webhook_listen'],
+            'port': self.config['webhook_port'],
+            'url_path': url_path,
+            'webhook_url': f"{self.config['webhook_url'].rstrip('/')}/{url_path}",
+            'secret_token': self.config['webhook_secret_token'] or secrets.token_urlsafe(32),
+            'max_connections': self.config['webhook_max_connections'],
+        }
 
-        application.run_polling()
+    def run(self) -> None:
+        """
+        Initiates the bot and starts receiving updates: through a webhook if a webhook URL is
+        configured, by polling otherwise.
+        """
+
+        application = self.build_application()
+        self.start_scheduler()
+        if self.config['webhook_url']:
+            application.run_webhook(**self.webhook_options())
+        else:
+            application.run_polling()
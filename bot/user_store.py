@@ -0,0 +1,128 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    language TEXT,
+    last_checklist INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class UserStore:
+    """
+    File-backed store of the bot's users and broadcast state, kept in SQLite in WAL mode.
+
+    All rows are loaded into memory at startup and every read is served from there, so handlers
+    and the broadcaster never wait on disk or the network. Changes are applied to memory
+    immediately and written to SQLite in batches by `flush`, which is meant to run periodically
+    off the event loop.
+
+    Attributes:
+        path (str): Path of the SQLite database.
+        users (dict): User id -> {'username', 'language', 'last_checklist'}.
+        state (dict): Named integer values, e.g. the broadcast counter.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        self.users: Dict[int, dict] = {}
+        for user_id, username, language, last_checklist in self.connection.execute(
+                'SELECT user_id, username, language, last_checklist FROM users'):
+            self.users[user_id] = {'username': username, 'language': language, 'last_checklist': last_checklist}
+        self.state: Dict[str, int] = dict(self.connection.execute('SELECT key, value FROM state'))
+        self.dirty_users = set()
+        self.dirty_state = set()
+        logging.info(f"User store {path}: {len(self.users)} users")
+
+    def register(self, user_id: int, username: Optional[str]) -> None:
+        """
+        Records a user on any interaction with the bot, or updates their username if it changed.
+        """
+        with self.lock:
+            user = self.users.get(user_id)
+            if user is None:
+                self.users[user_id] = {'username': username, 'language': None, 'last_checklist': 0}
+                self.dirty_users.add(user_id)
+            elif user['username'] != username:
+                user['username'] = username
+                self.dirty_users.add(user_id)
+
+    def set_language(self, user_id: int, language: str) -> None:
+        with self.lock:
+            user = self.users.setdefault(user_id, {'username': None, 'language': None, 'last_checklist': 0})
+            user['language'] = language
+            self.dirty_users.add(user_id)
+
+    def set_last_checklist(self, user_id: int, number: int) -> None:
+        with self.lock:
+            if user_id in self.users:
+                self.users[user_id]['last_checklist'] = number
+                self.dirty_users.add(user_id)
+
+    def get_language(self, user_id: int, default: str = None) -> str:
+        user = self.users.get(user_id)
+        return user['language'] if user and user['language'] else default
+
+    def get_users(self) -> List[dict]:
+        """
+        Returns a snapshot of all users, each with its 'user_id'.
+        """
+        with self.lock:
+            return [{'user_id': user_id, **user} for user_id, user in self.users.items()]
+
+    def get_state(self, key: str, default: int = None) -> int:
+        return self.state.get(key, default)
+
+    def set_state(self, key: str, value: int) -> None:
+        with self.lock:
+            self.state[key] = value
+            self.dirty_state.add(key)
+
+    def flush(self) -> None:
+        """
+        Writes all pending changes to SQLite in one transaction.
+        """
+        with self.lock:
+            if not self.dirty_users and not self.dirty_state:
+                return
+            now = time.time()
+            user_rows = [
+                (user_id, user['username'], user['language'], user['last_checklist'], now)
+                for user_id, user in ((user_id, self.users[user_id]) for user_id in self.dirty_users)
+            ]
+            state_rows = [(key, self.state[key]) for key in self.dirty_state]
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT INTO users (user_id, username, language, last_checklist, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET '
+                    'username = excluded.username, language = excluded.language, '
+                    'last_checklist = excluded.last_checklist, updated_at = excluded.updated_at',
+                    user_rows)
+                self.connection.executemany(
+                    'INSERT INTO state (key, value) VALUES (?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                    state_rows)
+            self.dirty_users.clear()
+            self.dirty_state.clear()
+
+    def close(self) -> None:
+        self.flush()
+        with self.lock:
+            self.connection.close()
@@ -35,4 +35,26 @@ def get_thread_id(update: Update) -> int | None:
     """
     if update.effective_message and update.effective_message.is_topic_message:
         return update.effective_message.message_thread_id
-    return None
\ No newline at end of file
+    return None
+
+
+def split_text(text: str, limit: int = 4096) -> list[str]:
+    """
+    Splits a text into parts of at most `limit` characters, preferably on paragraph boundaries,
+    then on line breaks and spaces.
+    """
+    parts = []
+    text = text.strip()
+    while len(text) > limit:
+        cut = -1
+        for separator in ('\n\n', '\n', ' '):
+            cut = text.rfind(separator, 0, limit + 1)
+            if cut > 0:
+                break
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
@@ -0,0 +1,170 @@
+import logging
+import os
+import pickle
+from typing import List
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.faiss import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivfpq')
+
+
+class VectorIndex:
+    """
+    Builds, loads and tunes the FAISS index behind the course database.
+
+    - `flat` is exact search over all vectors held in memory, the right choice for one course.
+    - `hnsw` is a graph index: fast approximate search, but chunks can not be removed from it,
+      so any change that deletes chunks rebuilds the index.
+    - `ivfpq` clusters the vectors into `ivf_nlist` lists and compresses them with product
+      quantization (`pq_m` sub-vectors of `pq_nbits` bits). It is trained on the corpus and
+      takes a fraction of the memory of the other two. A shard with fewer than `2 ** pq_nbits`
+      vectors can not be trained and is built flat until it grows, see `needs_training`.
+
+    Saved indexes are memory-mapped read-only when loaded with `mmap`, so their vectors are
+    paged in from disk on demand instead of being copied into memory.
+
+    Attributes:
+        index_type (str): One of `INDEX_TYPES`.
+        hnsw_m (int): Number of graph neighbours per vector of an HNSW index.
+        hnsw_ef_construction (int): Search depth while building an HNSW index.
+        hnsw_ef_search (int): Search depth while querying an HNSW index.
+        ivf_nlist (int): Maximum number of inverted lists of an IVF-PQ index.
+        pq_m (int): Number of sub-vectors each vector is compressed into.
+        pq_nbits (int): Bits per sub-vector code.
+        nprobe (int): Number of inverted lists searched per query.
+        mmap (bool): Whether saved indexes are memory-mapped read-only.
+    """
+
+    def __init__(self, index_type: str = 'flat', hnsw_m: int = 32, hnsw_ef_construction: int = 200,
+                 hnsw_ef_search: int = 64, ivf_nlist: int = 256, pq_m: int = 64, pq_nbits: int = 8,
+                 nprobe: int = 16, mmap: bool = True):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown FAISS index type {index_type!r}, expected one of {INDEX_TYPES}")
+        self.index_type = index_type
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+        self.ivf_nlist = ivf_nlist
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.nprobe = nprobe
+        self.mmap = mmap
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'VectorIndex':
+        return cls(
+            index_type=config.get('index_type', 'flat'),
+            hnsw_m=config.get('hnsw_m', 32),
+            hnsw_ef_construction=config.get('hnsw_ef_construction', 200),
+            hnsw_ef_search=config.get('hnsw_ef_search', 64),
+            ivf_nlist=config.get('ivf_nlist', 256),
+            pq_m=config.get('pq_m', 64),
+            pq_nbits=config.get('pq_nbits', 8),
+            nprobe=config.get('nprobe', 16),
+            mmap=config.get('index_mmap', True),
+        )
+
+    @property
+    def supports_delete(self) -> bool:
+        return self.index_type != 'hnsw'
+
+    def settings(self) -> dict:
+        """
+        Returns the settings the saved index depends on, as stored in the index manifest.
+        Search-time parameters are left out, changing them does not need a rebuild.
+        """
+        settings = {'type': self.index_type}
+        if self.index_type == 'hnsw':
+            settings.update(m=self.hnsw_m, ef_construction=self.hnsw_ef_construction)
+        elif self.index_type == 'ivfpq':
+            settings.update(nlist=self.ivf_nlist, pq_m=self.pq_m, pq_nbits=self.pq_nbits)
+        return settings
+
+    def build(self, documents: List[Document], embeddings: Embeddings, ids: List[str]) -> FAISS:
+        """
+        Embeds `documents` and builds an index of the configured type over them.
+        """
+        vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+        index = self.create_index(vectors)
+        db = FAISS(embeddings, index, InMemoryDocstore(), {})
+        if len(documents):
+            db.add_embeddings(zip([doc.page_content for doc in documents], vectors.tolist()),
+                              metadatas=[doc.metadata for doc in documents], ids=ids)
+        self.configure(db.index)
+        return db
+
+    def create_index(self, vectors: np.ndarray) -> faiss.Index:
+        count, dimension = vectors.shape if vectors.size else (0, 0)
+        if self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(dimension, self.hnsw_m)
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+            return index
+        if self.index_type == 'ivfpq':
+            if dimension % self.pq_m:
+                raise ValueError(f"pq_m ({self.pq_m}) must divide the embedding dimension ({dimension})")
+            # k-means needs at least one training vector per centroid, ideally ~40
+            nlist = max(1, min(self.ivf_nlist, count // 39))
+            if count >= 2 ** self.pq_nbits:
+                index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dimension), dimension, nlist, self.pq_m, self.pq_nbits)
+                index.train(vectors)
+                return index
+            logging.warning(f"Only {count} vectors, too few to train IVF-PQ codes (need {2 ** self.pq_nbits}); "
+                            f"falling back to a flat index until there are enough")
+        return faiss.IndexFlatL2(dimension)
+
+    @staticmethod
+    def built_type(index: faiss.Index) -> str:
+        """
+        Returns the type a built or loaded index actually has, one of `INDEX_TYPES`.
+        """
+        if isinstance(index, faiss.IndexHNSW):
+            return 'hnsw'
+        if faiss.try_extract_index_ivf(index) is not None:
+            return 'ivfpq'
+        return 'flat'
+
+    def needs_training(self, db: FAISS) -> bool:
+        """
+        Returns whether a shard built flat for lack of IVF-PQ training vectors now has enough of
+        them, so it should be rebuilt.
+        """
+        return (self.index_type == 'ivfpq' and self.built_type(db.index) == 'flat'
+                and db.index.ntotal >= 2 ** self.pq_nbits)
+
+    def configure(self, index: faiss.Index) -> None:
+        """
+        Applies the search-time parameters to a built or loaded index.
+        """
+        parameters = faiss.ParameterSpace()
+        if isinstance(index, faiss.IndexHNSW):
+            parameters.set_index_parameter(index, 'efSearch', self.hnsw_ef_search)
+        elif faiss.try_extract_index_ivf(index) is not None:
+            parameters.set_index_parameter(index, 'nprobe', self.nprobe)
+
+    def load(self, path: str, embeddings: Embeddings, writable: bool = False) -> FAISS:
+        """
+        Loads an index saved with `FAISS.save_local`.
+
+        Unless `writable` is requested, the index is memory-mapped read-only when `mmap` is on,
+        falling back to a regular read for index types faiss can not map.
+        """
+        index_file = os.path.join(path, 'index.faiss')
+        index = None
+        if self.mmap and not writable:
+            try:
+                index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e:
+                logging.warning(f"Could not memory-map {index_file}, reading it into memory: {e}")
+        if index is None:
+            index = faiss.read_index(index_file)
+        self.configure(index)
+
+        # The docstore is only ever written by FAISS.save_local on our side, so it is trusted
+        with open(os.path.join(path, 'index.pkl'), 'rb') as file:
+            docstore, index_to_docstore_id = pickle.load(file)
+        return FAISS(embeddings, index, docstore, index_to_docstore_id)
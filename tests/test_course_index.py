@@ -0,0 +1,191 @@
+"""
+Incremental updates of the course index (`Database.open_database`) against an in-memory Drive
+folder and the benchmarks' offline embedder. Run from the repository root: `python -m pytest tests`.
+"""
+import io
+import os
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from database_helper import MANIFEST_FILE, Database
+from stubs import HashingEmbeddings
+
+LESSONS = {
+    'pixel': "# Пиксель\n\nПиксель отслеживает действия пользователей на сайте после клика по объявлению. "
+             "Его устанавливают на все страницы сайта и проверяют в диспетчере событий.",
+    'budget': "# Бюджет\n\nБюджет кампании задают на уровне группы объявлений или всей кампании. "
+              "Дневной бюджет расходуется равномерно в течение суток.",
+    'audiences': "# Аудитории\n\nLook-alike аудитории строятся на основе уже существующих клиентов. "
+                 "Чем больше исходная аудитория, тем точнее похожая.",
+}
+
+
+class ScriptDetector:
+    """
+    Russian if the text has Cyrillic letters, else Uzbek, instead of the fastText model.
+    """
+
+    def detect(self, text):
+        return 'ru' if re.search('[а-яё]', text, re.IGNORECASE) else 'uz'
+
+
+class CountingEmbeddings(HashingEmbeddings):
+    """
+    Offline embedder that records every text sent to it for embedding.
+    """
+
+    def __init__(self):
+        super().__init__(size=64)
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+class FakeDrive:
+    """
+    The embeddings folder on Drive, as far as `Database` reads it: a listing with revisions and
+    plain text exports.
+    """
+
+    def __init__(self, documents):
+        self.files = {}
+        for doc_id, text in documents.items():
+            self.put(doc_id, text)
+
+    def put(self, doc_id, text):
+        version = self.files[doc_id]['version'] + 1 if doc_id in self.files else 1
+        self.files[doc_id] = {'text': text, 'version': version}
+
+    def list(self, **kwargs):
+        files = [{'id': doc_id, 'name': doc_id, 'mimeType': 'application/vnd.google-apps.document',
+                  'modifiedTime': f"2024-03-{file['version']:02d}T00:00:00.000Z", 'version': str(file['version'])}
+                 for doc_id, file in self.files.items()]
+        return SimpleNamespace(result={'files': files})
+
+    def export_media(self, fileId, mimeType):
+        return SimpleNamespace(content=self.files[fileId]['text'].encode('utf-8'))
+
+
+@pytest.fixture
+def drive():
+    return FakeDrive(LESSONS)
+
+
+@pytest.fixture
+def open_database(drive, tmp_path):
+    """
+    Returns a function that opens the index of `drive` like a freshly started bot and returns
+    the shards and the texts it embedded.
+    """
+
+    def open_database(**settings):
+        embeddings = CountingEmbeddings()
+        google = SimpleNamespace(
+            execute_sync=lambda request: request.result,
+            download_sync=lambda request: io.BytesIO(request.content),
+            executor=SimpleNamespace(map=map),
+        )
+        services = SimpleNamespace(creds=None, sheets=None, client=google,
+                                   drive=SimpleNamespace(files=lambda: drive))
+        config = {
+            'embeddings_folder_id': 'embeddings',
+            'index_path': str(tmp_path / 'faiss_index'),
+            'embedding_cache_path': str(tmp_path / 'embedding_cache'),
+            'service_account': None,
+            'content_id_rus': 'content-ru',
+            'content_id_uz': 'content-uz',
+            'chunk_size': 80,
+            **settings,
+        }
+        db = Database(config, embeddings=embeddings, services=services)
+        db.language_detector = db.chunk_language_detector = ScriptDetector()
+        return db.open_database(), embeddings.embedded
+
+    return open_database
+
+
+def texts(shards):
+    return {document.page_content for shard in shards.values() for document in shard.docstore._dict.values()}
+
+
+def chunk_count(shards):
+    return sum(shard.index.ntotal for shard in shards.values())
+
+
+def test_unchanged_folder_is_loaded_from_disk(open_database):
+    shards, embedded = open_database()
+    assert embedded and chunk_count(shards) == len(embedded)
+
+    reloaded, embedded = open_database()
+    assert embedded == []
+    assert texts(reloaded) == texts(shards)
+
+
+def test_edited_document_replaces_its_chunks(drive, open_database):
+    shards, _ = open_database()
+    drive.put('budget', "# Бюджет\n\nСтратегия ставок с предельной ценой ограничивает стоимость результата.")
+
+    updated, embedded = open_database()
+    assert embedded
+    assert embedded == [text for text in texts(updated) if 'ставок' in text or 'результата' in text]
+    assert not any('Дневной бюджет' in text for text in texts(updated))
+    assert texts(updated) >= {text for text in texts(shards) if 'Пиксель' in text or 'Look-alike' in text}
+    assert chunk_count(updated) == len(texts(updated))
+
+
+def test_new_revision_with_the_same_text_keeps_its_chunks(drive, open_database):
+    shards, _ = open_database()
+    drive.put('pixel', LESSONS['pixel'])
+
+    updated, embedded = open_database()
+    assert embedded == []
+    assert texts(updated) == texts(shards)
+
+
+@pytest.mark.parametrize('index_type', ['flat', 'hnsw'])
+def test_deleted_document_drops_its_chunks(drive, open_database, index_type):
+    shards, _ = open_database(index_type=index_type)
+    del drive.files['audiences']
+
+    updated, embedded = open_database(index_type=index_type)
+    # HNSW can not delete chunks and is rebuilt, from the embedding cache
+    assert embedded == []
+    assert texts(updated) == {text for text in texts(shards) if 'Look-alike' not in text and 'похожая' not in text}
+    assert chunk_count(updated) == len(texts(updated))
+
+
+def test_added_document_is_embedded_alone(drive, open_database):
+    shards, _ = open_database()
+    drive.put('uz-lesson', "Target reklama - bu e'lonlarni tanlangan auditoriyaga ko'rsatish.")
+
+    updated, embedded = open_database()
+    assert embedded == ["Target reklama - bu e'lonlarni tanlangan auditoriyaga ko'rsatish."]
+    assert set(updated) == {'ru', 'uz'}
+    assert texts(updated) == texts(shards) | set(embedded)
+
+
+def test_interrupted_save_is_rebuilt_from_the_embedding_cache(tmp_path, open_database):
+    shards, _ = open_database()
+    os.remove(tmp_path / 'faiss_index' / MANIFEST_FILE)
+
+    rebuilt, embedded = open_database()
+    assert embedded == []
+    assert texts(rebuilt) == texts(shards)
+    assert (tmp_path / 'faiss_index' / MANIFEST_FILE).exists()
+
+
+def test_flat_fallback_is_trained_once_the_corpus_grows(drive, open_database):
+    settings = {'index_type': 'ivfpq', 'pq_m': 8, 'pq_nbits': 4}
+    shards, _ = open_database(**settings)
+    assert chunk_count(shards) < 2 ** 4
+    assert {type(shard.index).__name__ for shard in shards.values()} == {'IndexFlatL2'}
+
+    for number in range(16):
+        drive.put(f"lesson-{number}", f"# Урок {number}\n\nМатериалы урока номер {number} о настройке рекламы.")
+    updated, _ = open_database(**settings)
+    assert type(updated['ru'].index).__name__ == 'IndexIVFPQ'
+    assert texts(updated) >= texts(shards)
@@ -0,0 +1,63 @@
+"""
+Recovery of the embedding cache (`EmbeddingStore`) from writes that were cut short.
+"""
+import os
+
+import numpy as np
+import pytest
+
+from embedding_cache import META_FILE, VECTORS_FILE, EmbeddingStore
+
+
+def store_with(path, vectors):
+    store = EmbeddingStore(str(path), 'test-model')
+    store.put_many(list(vectors), list(vectors.values()))
+    return store
+
+
+def test_truncated_vector_file_drops_the_incomplete_row(tmp_path):
+    vectors = {f"key{number}": [float(number)] * 4 for number in range(3)}
+    store = store_with(tmp_path, vectors)
+    vectors_path = os.path.join(store.path, VECTORS_FILE)
+    with open(vectors_path, 'r+b') as file:
+        file.truncate(os.path.getsize(vectors_path) - 2)
+
+    reopened = EmbeddingStore(str(tmp_path), 'test-model')
+    found = reopened.get_many(list(vectors))
+    assert set(found) == {'key0', 'key1'}
+    assert os.path.getsize(vectors_path) == 2 * 4 * 4
+
+    # The dropped key is stored again, at the row right after the intact ones
+    reopened.put_many(['key2', 'key3'], [vectors['key2'], [3.0] * 4])
+    found = EmbeddingStore(str(tmp_path), 'test-model').get_many(['key0', 'key1', 'key2', 'key3'])
+    for key, vector in {**vectors, 'key3': [3.0] * 4}.items():
+        np.testing.assert_array_equal(found[key], vector)
+
+
+@pytest.mark.parametrize('meta', ['{"dimen', '{}', '{"dimension": 0}', '[2]'])
+def test_unreadable_meta_file_empties_the_store(tmp_path, meta):
+    store = store_with(tmp_path, {'key0': [1.0, 2.0], 'key1': [3.0, 4.0]})
+    with open(os.path.join(store.path, META_FILE), 'w', encoding='utf-8') as file:
+        file.write(meta)
+
+    reopened = EmbeddingStore(str(tmp_path), 'test-model')
+    assert reopened.get_many(['key0', 'key1']) == {}
+
+    # The store is rebuilt as the vectors are embedded again, with another dimension if need be
+    reopened.put_many(['key0'], [[5.0, 6.0, 7.0]])
+    found = EmbeddingStore(str(tmp_path), 'test-model').get_many(['key0', 'key1'])
+    assert list(found) == ['key0']
+    np.testing.assert_array_equal(found['key0'], [5.0, 6.0, 7.0])
+
+
+def test_rows_without_keys_are_dropped(tmp_path):
+    store = store_with(tmp_path, {'key0': [1.0, 2.0]})
+    # A write interrupted after its rows and before its keys
+    with open(os.path.join(store.path, VECTORS_FILE), 'ab') as file:
+        file.write(np.asarray([[9.0, 9.0]], dtype='<f4').tobytes())
+
+    reopened = EmbeddingStore(str(tmp_path), 'test-model')
+    reopened.put_many(['key1'], [[3.0, 4.0]])
+    found = EmbeddingStore(str(tmp_path), 'test-model').get_many(['key0', 'key1'])
+    np.testing.assert_array_equal(found['key0'], [1.0, 2.0])
+    np.testing.assert_array_equal(found['key1'], [3.0, 4.0])